@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import warnings
+from datetime import datetime
+
+import numpy as np
+
+from astropy import units as u
+from astropy.table import Table, vstack
+from astropy.wcs import FITSFixedWarning
+from astropy.utils.exceptions import AstropyUserWarning
+from astropy.utils.metadata import MergeConflictWarning
+
+from settings import parameters, RESULTS
+from library import read_sources, select_sources, remove_outsiders, find_duplicates, remove_scanner_artifacts
+from library import cross_match, split_matches, run_match_workers, get_background, get_image, image_cache
+from library import FitWorker, ProfileWorker, SharedColumns, NeighborhoodIndex, parallel_map, build_profile_bank
+from library import clean_bad_fits, add_flux_ratio, exceeds_criteria, SkyIndex
+from synthetic import write_sequence
+
+
+'''
+Benchmarks for the expensive parts of the pipeline, run over synthetic plate
+pairs (see synthetic.py) of several sizes, so they don't need the APPLAUSE
+scans.
+
+Timed, at each plate size (best of a number of repeats):
+
+ - Worker and Worker2: the old matching loops (see function run_match_workers),
+   on a fixed number of rows, since they run in O(N^2);
+ - remove_outsiders, on the selected sources of the first plate;
+ - background: function get_background, with an empty cache;
+ - FitWorker: Gaussian fits on a sample of the matched stars;
+ - ProfileWorker: profile and shape metrics on a sample of the fitted stars.
+
+The injected vanishing sources give a recall check: the fraction of them that
+survives each step of the pipeline (non-matched table, PSF fits, profiles, and
+the final candidate criteria), run with the same steps as in pipeline.py.
+
+Each run is appended to a history file in the RESULTS directory. Timings are
+compared with the median of the last runs made on the same host, with the same
+settings, and flagged when slower by more than a tolerance. Recall is flagged
+when it drops below the best previous value. The command exits with status 1
+if anything is flagged.
+
+Command line:
+
+    python benchmark.py [--sizes 1000 2000 4000] [--repeat 3] [--nproc N] [--density 2000]
+                        [--vanishing 20] [--seed 0] [--tolerance 0.2] [--window 5] [--no-save]
+'''
+
+HISTORYFILE = os.path.join(RESULTS, 'benchmark_history.jsonl')
+
+# steps where recall is checked
+recall_levels = ['non_matched', 'fitted', 'profiled', 'candidates']
+
+
+def timed(function, repeat=1):
+    '''
+    Calls function repeat times. Returns the result of the last call, and
+    the best wall time, in seconds.
+    '''
+    best = np.inf
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def recall(truth, table, tolerance=5./3600.):
+    '''
+    Fraction of the sources in the truth table that have a counterpart in
+    a table.
+    '''
+    if len(truth) == 0:
+        return float('nan')
+    if len(table) == 0:
+        return 0.
+
+    index = SkyIndex.from_table(table)
+    found = index.has_match(np.asarray(truth['ra']), np.asarray(truth['dec']), tolerance=tolerance)
+    return float(np.mean(found))
+
+
+def sample(table, n):
+    # evenly spaced rows, so samples are the same from run to run
+    step = max(len(table) // max(n, 1), 1)
+    return table[::step][:n]
+
+
+def fit_table(data, table, par, nproc):
+    def factory(name, row_start, row_end):
+        return FitWorker(name, data, table, row_start, row_end, par)
+
+    return vstack(parallel_map(factory, table, nproc=nproc))
+
+
+def profile_table(shared_image, table, neighborhood_index, profile_bank, wcs, par, nproc):
+    cutout_size = float(par['neighborhood_cutout_size']) / 60. * u.deg
+    edge_radii = profile_bank.edge_radii
+
+    def factory(name, row_start, row_end):
+        return ProfileWorker(name, table, neighborhood_index, shared_image, wcs,
+                             cutout_size, edge_radii, row_start, row_end,
+                             par['fwhm_init'], par['fit_shape'],
+                             circularity_cutout=par['tiny_cutout_size'],
+                             threshold=par['circularity_threshold'],
+                             profile_bank=profile_bank)
+
+    return vstack(parallel_map(factory, table, nproc=nproc))
+
+
+def benchmark_pair(directory, size, par, nproc=1, repeat=3, density=2000., n_vanishing=20, seed=0,
+                   match_rows=2000, fit_rows=1000, profile_rows=100):
+    '''
+    Writes a synthetic pair of plates, and runs the benchmarks and the recall
+    check on it.
+
+    Parameters:
+
+    directory    - directory for the synthetic plates
+    size         - plate side, in pixels
+    par          - parameter dict from settings.py
+    nproc        - number of processes
+    repeat       - each benchmark is run this many times, and the best time is kept
+    density, n_vanishing, seed - synthetic sequence parameters (see synthetic.write_sequence)
+    match_rows   - rows of each table matched by Worker and Worker2
+    fit_rows     - matched stars fitted by FitWorker
+    profile_rows - fitted stars handed to ProfileWorker
+
+    Returns:
+
+    list of dicts with the benchmark name, plate size, number of rows, and time
+    dict with the recall at each step in recall_levels
+    '''
+    images, truth = write_sequence(directory, plate_ids=[101, 102], size=size, density=density,
+                                   n_vanishing=n_vanishing, seed=seed)
+
+    par = dict(par)
+    par['image1'] = os.path.join(directory, images['101'])
+    par['image2'] = os.path.join(directory, images['102'])
+
+    table_1 = read_sources('101', cache=False, datapath=directory)
+    table_2 = read_sources('102', cache=False, datapath=directory)
+    wcs_1 = get_image(par['image1']).wcs
+    wcs_2 = get_image(par['image2']).wcs
+
+    results = []
+    recalls = {}
+
+    def add(name, rows, seconds):
+        results.append({'benchmark': name, 'size': size, 'rows': rows, 'time': seconds})
+        print("Benchmark ", name, " - size ", size, " - ", rows, " rows - ", "%.3f" % seconds, " s", flush=True)
+
+    # find_mismatches steps
+    table_selected = select_sources(table_1, par)
+
+    table_inside, seconds = timed(lambda: remove_outsiders(None, wcs_2, table_selected, wcs_table=wcs_1), repeat)
+    add('remove_outsiders', len(table_selected), seconds)
+
+    groups, _ = find_duplicates(table_inside)
+    table_clean = remove_scanner_artifacts(table_inside, groups=groups)
+
+    _, seconds = timed(lambda: run_match_workers(table_clean[:match_rows], table_2[:match_rows], nproc=nproc), repeat)
+    add('Worker', min(len(table_clean), match_rows), seconds)
+
+    _, seconds = timed(lambda: run_match_workers(table_inside[:match_rows], nproc=nproc), repeat)
+    add('Worker2', min(len(table_inside), match_rows), seconds)
+
+    matched, _ = cross_match(table_clean, table_2)
+    table_matched, table_non_matched = split_matches(table_clean, matched, '102')
+
+    recalls['non_matched'] = recall(truth, table_non_matched)
+
+    # background, computed from scratch every time
+    def background():
+        return get_background(par['image1'], nproc=nproc, cachepath=tempfile.mkdtemp(dir=directory))
+
+    (data, _), seconds = timed(background, repeat)
+    add('background', size * size, seconds)
+
+    # fits and profiles of matched stars
+    table_match = remove_outsiders(data, wcs_1, table_matched)
+    stars = sample(table_match, fit_rows)
+
+    table_fitted, seconds = timed(lambda: fit_table(data, stars, par, nproc), repeat)
+    add('FitWorker', len(stars), seconds)
+
+    neighborhood_index = NeighborhoodIndex(table_match)
+    profile_bank = build_profile_bank(data, table_match, np.arange(25) / 2., nproc=nproc)
+
+    with SharedColumns({'data': data}, ['data']) as shared_image:
+        targets = sample(clean_bad_fits(table_fitted, par), profile_rows)
+
+        _, seconds = timed(lambda: profile_table(shared_image, targets, neighborhood_index, profile_bank,
+                                                 wcs_1, par, nproc), repeat)
+        add('ProfileWorker', len(targets), seconds)
+
+        # the rest of the pipeline, on the non-matched objects
+        table_nomatch = remove_outsiders(data, wcs_1, table_non_matched)
+        t1 = clean_bad_fits(fit_table(data, table_nomatch, par, nproc), par)
+
+        mask = (t1['flux_max'] > par['min_acceptable_flux']) & (t1['fwhm_fit'] < par['max_fwhm']) & \
+               (t1['fwhm_fit'] > par['min_fwhm'])
+        t1 = t1[mask]
+        recalls['fitted'] = recall(truth, t1)
+
+        t1 = profile_table(shared_image, t1, neighborhood_index, profile_bank, wcs_1, par, nproc)
+        recalls['profiled'] = recall(truth, t1)
+
+    t1.sort('flux_max', reverse=True)
+    t1 = add_flux_ratio(t1[:par['plot_limit']], par)
+    table_candidates = t1[[row_index for row_index in range(len(t1)) if not exceeds_criteria(t1, row_index, par)]]
+    recalls['candidates'] = recall(truth, table_candidates)
+
+    print("Recall - size ", size, " - ", ", ".join([level + ": %.3f" % recalls[level] for level in recall_levels]),
+          flush=True)
+
+    # scans are kept open by the image cache
+    image_cache.clear()
+
+    return results, recalls
+
+
+def git_commit():
+    '''
+    Short hash of the current git commit, or None outside of a git repository.
+    '''
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def read_history(file_name=HISTORYFILE):
+    '''
+    Reads the benchmark history: one JSON entry per line, one line per run.
+    '''
+    history = []
+    try:
+        with open(file_name, 'r') as history_file:
+            for line in history_file:
+                try:
+                    history.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return history
+
+
+def append_history(entry, file_name=HISTORYFILE):
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    with open(file_name, 'a') as history_file:
+        history_file.write(json.dumps(entry) + '\n')
+
+
+def compare(entry, history, tolerance=0.2, window=5):
+    '''
+    Compares a benchmark run with the previous runs in the history made on
+    the same host, with the same number of processes and the same settings.
+
+    Parameters:
+
+    entry     - history entry for the run
+    history   - list of previous history entries
+    tolerance - timings are flagged when slower than the baseline by more than this fraction
+    window    - the baseline is the median time of this many previous runs
+
+    Returns:
+
+    table with the timings, their baselines, and flags
+    table with the recall at each step, the best previous recall, and flags
+    True if anything was flagged
+    '''
+    previous = [h for h in history if h.get('host') == entry['host'] and h.get('nproc') == entry['nproc'] and
+                h.get('settings') == entry['settings']][-window:]
+
+    timings = Table(names=['benchmark', 'size', 'rows', 'time', 'baseline', 'ratio', 'flag'],
+                    dtype=[str, int, int, float, float, float, str])
+    for result in entry['results']:
+        times = [r['time'] for h in previous for r in h['results']
+                 if r['benchmark'] == result['benchmark'] and r['size'] == result['size']]
+        baseline = np.median(times) if len(times) > 0 else np.nan
+        ratio = result['time'] / baseline
+        flag = 'SLOWER' if ratio > 1. + tolerance else ''
+        timings.add_row([result['benchmark'], result['size'], result['rows'], result['time'], baseline, ratio, flag])
+
+    recalls = Table(names=['size', 'level', 'recall', 'best', 'flag'], dtype=[int, str, float, float, str])
+    for size, levels in entry['recall'].items():
+        for level in recall_levels:
+            values = [h['recall'][size][level] for h in previous if size in h.get('recall', {})]
+            best = max(values) if len(values) > 0 else np.nan
+            flag = 'LOST' if levels[level] < best else ''
+            recalls.add_row([int(size), level, levels[level], best, flag])
+
+    for table in [timings, recalls]:
+        for name in ['time', 'baseline', 'ratio', 'recall', 'best']:
+            if name in table.colnames:
+                table[name].format = '.3f'
+
+    regression = bool(np.any(timings['flag'] != '')) or bool(np.any(recalls['flag'] != ''))
+
+    return timings, recalls, regression
+
+
+def run_benchmarks(sizes=[1000, 2000, 4000], nproc=None, repeat=3, density=2000., n_vanishing=20, seed=0,
+                   history_file=HISTORYFILE, tolerance=0.2, window=5, save=True):
+    '''
+    Runs the benchmarks at each plate size, compares them with the history,
+    and appends them to it.
+
+    Parameters:
+
+    sizes        - plate sides, in pixels
+    nproc        - number of processes; default is the 'nproc_analysis' parameter
+    repeat       - each benchmark is run this many times, and the best time is kept
+    density, n_vanishing, seed - synthetic sequence parameters (see synthetic.write_sequence)
+    history_file - history file
+    tolerance, window - regression test parameters (see function compare)
+    save         - append this run to the history
+
+    Returns:
+
+    True if any regression was flagged
+    '''
+    par = dict(parameters['default'])
+    if nproc is None:
+        nproc = par['nproc_analysis']
+
+    entry = {'date': datetime.now().isoformat(timespec='seconds'),
+             'commit': git_commit(),
+             'host': platform.node(),
+             'python': platform.python_version(),
+             'nproc': nproc,
+             'settings': {'density': density, 'n_vanishing': n_vanishing, 'seed': seed, 'repeat': repeat},
+             'results': [],
+             'recall': {}}
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            results, recalls = benchmark_pair(directory, size, par, nproc=nproc, repeat=repeat, density=density,
+                                              n_vanishing=n_vanishing, seed=seed)
+        entry['results'].extend(results)
+        entry['recall'][str(size)] = recalls
+
+    timings, recalls, regression = compare(entry, read_history(history_file), tolerance=tolerance, window=window)
+
+    timings.pprint_all()
+    print()
+    recalls.pprint_all()
+
+    if save:
+        append_history(entry, history_file)
+        print("Benchmark history: ", history_file)
+
+    if regression:
+        print("--------  REGRESSION: see flagged rows above")
+
+    return regression
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline over synthetic plates.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help="plate sides, in pixels")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark (the best time is kept)")
+    parser.add_argument('--nproc', type=int, default=None, help="number of processes")
+    parser.add_argument('--density', type=float, default=2000., help="sources per square megapixel")
+    parser.add_argument('--vanishing', type=int, default=20, help="vanishing sources injected in each pair")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic plates")
+    parser.add_argument('--history', default=HISTORYFILE, help="history file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="flag timings slower than the baseline by more than this fraction")
+    parser.add_argument('--window', type=int, default=5, help="number of previous runs in the baseline")
+    parser.add_argument('--no-save', action='store_true', help="don't append this run to the history")
+    args = parser.parse_args(argv)
+
+    # mostly to avoid clunky screen output
+    warnings.filterwarnings('ignore', category=AstropyUserWarning, message=".*One or more fit.*")
+    warnings.filterwarnings('ignore', category=MergeConflictWarning)
+    warnings.filterwarnings('ignore', category=FITSFixedWarning)
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+
+    regression = run_benchmarks(sizes=args.sizes, nproc=args.nproc, repeat=args.repeat, density=args.density,
+                                n_vanishing=args.vanishing, seed=args.seed, history_file=args.history,
+                                tolerance=args.tolerance, window=args.window, save=not args.no_save)
+
+    sys.exit(1 if regression else 0)
+
+
+if __name__ == '__main__':
+    main()
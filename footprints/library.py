@@ -1,42 +1,31 @@
+import os
+import sys
 import json
+import hashlib
 import warnings
 import math
-from importlib import reload
+import time
+import threading
+import shutil
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pool, shared_memory
+from multiprocessing.pool import ThreadPool
 
-import cv2
 import numpy as np
 
-from matplotlib.pyplot import imshow
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.colors as mcolors
-from matplotlib.colors import LogNorm
-
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-
 from astropy import units as u
 from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.wcs.utils import proj_plane_pixel_scales
-from astropy.table import Table, join, hstack, vstack
-from astropy.time import Time
-from astropy.nddata.utils import Cutout2D
-from astropy.coordinates import SkyCoord, ICRS, EarthLocation
-from astropy.nddata import NoOverlapError
-from astropy.stats import SigmaClip
+from astropy.table import Table, Column, MaskedColumn, join, hstack, vstack
 from astropy.utils.exceptions import AstropyUserWarning
-from reproject import reproject_interp 
 
-from erfa import ErfaWarning
-from earthshadow import get_shadow_center, get_shadow_radius, dist_from_shadow_center
-
-from photutils.background import Background2D, MedianBackground, ModeEstimatorBackground
-from photutils.aperture import CircularAperture, aperture_photometry, CircularAnnulus, ApertureStats
-from photutils.profiles import RadialProfile
-from photutils.psf import fit_2dgaussian
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 import settings
-from settings import get_parameters, current_dataset, fname
+from settings import get_parameters, current_dataset, fname, get_table_sources, CACHEPATH
 
 # Image names are not imported, but kept instead in a json file
 images_json = 'images.json'
@@ -73,6 +62,391 @@ def is_in_jupyter():
         return False
     
     
+class CachedImage:
+    '''
+    A plate scan held by the ImageCache. 
+
+    The header and WCS are parsed when the entry is created. The data array 
+    is only mapped into memory when first accessed.
+    '''
+    def __init__(self, file_name):
+        from astropy.wcs import WCS
+
+        self.file_name = file_name
+
+        self.hdul = fits.open(file_name, memmap=True)
+
+        # images with scaled integer data (e.g. unsigned 16-bit, stored with 
+        # BZERO = 32768) can't be memory-mapped; these are read in full when 
+        # the data is first accessed.
+        header = self.hdul[0].header
+        if 'BZERO' in header or 'BSCALE' in header or 'BLANK' in header:
+            self.hdul.close()
+            self.hdul = fits.open(file_name, memmap=False)
+
+        self.header = self.hdul[0].header
+        self.wcs = WCS(self.header)
+
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        # threads that read the same scan at the same time map it only once
+        with self._lock:
+            if self._data is None:
+                self._data = self.hdul[0].data
+        return self._data
+
+    @property
+    def nbytes(self):
+        if self._data is None:
+            return 0
+        return self._data.nbytes
+
+    def close(self):
+        self._data = None
+        self.hdul.close()
+
+
+class ImageCache:
+    '''
+    Process-wide cache of plate scans, keyed by file name.
+
+    Least-recently-used entries are evicted when the data arrays held by
+    the cache exceed a memory budget. Evicted entries are only dropped from
+    the cache, not closed: callers that still hold one can keep using it, 
+    and its file is closed when the last reference to it goes away. The 
+    budget can be changed at any time by setting the max_bytes attribute of
+    the module-level instance:
+
+        library.image_cache.max_bytes = 8 * 1024**3
+
+    Data arrays must be treated as read-only, since they are shared by every
+    function that reads the same scan.
+
+    The cache can be used from several threads (e.g. by BackgroundMeshWorker
+    instances in a thread pool): lookups, inserts and evictions are serialized
+    by a lock.
+    '''
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_name):
+        '''
+        Returns the CachedImage for a file, opening it if necessary.
+        '''
+        with self._lock:
+            if file_name in self._entries:
+                self._entries.move_to_end(file_name)
+            else:
+                self._entries[file_name] = CachedImage(file_name)
+
+            self._evict(keep=file_name)
+
+            return self._entries[file_name]
+
+    def _evict(self, keep=None):
+        # must be called with the lock held
+        while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            self._entries.pop(oldest)
+
+    @property
+    def nbytes(self):
+        return sum([entry.nbytes for entry in list(self._entries.values())])
+
+    def clear(self):
+        # entries are dropped, not closed, as in _evict
+        with self._lock:
+            self._entries.clear()
+
+
+image_cache = ImageCache()
+
+
+def get_image(file_name):
+    '''
+    Gets a plate scan from the process-wide image cache.
+
+    Parameters:
+
+    file_name - full path name of the image file
+
+    Returns:
+
+    CachedImage instance, with attributes data, header and wcs
+    '''
+    return image_cache.get(file_name)
+
+
+def temporary_name(file_name):
+    '''
+    Name for a temporary file next to file_name, to be written in full and
+    then moved into place with os.replace. Names are unique across processes
+    and threads, so concurrent writers of the same file never share one.
+    '''
+    return file_name + '.' + str(os.getpid()) + '.' + uuid.uuid4().hex
+
+
+def file_checksum(file_name, cachepath=CACHEPATH):
+    '''
+    Computes the sha256 checksum of a file. Checksums are memoized in a json 
+    file in the cache directory, and are computed again only when the file 
+    size or modification time change.
+    '''
+    checksums_file = os.path.join(cachepath, 'checksums.json')
+    try:
+        with open(checksums_file, 'r') as json_file:
+            checksums = json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        checksums = {}
+
+    stat = os.stat(file_name)
+    key = os.path.abspath(file_name)
+    entry = checksums.get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024**2), b''):
+            sha.update(chunk)
+
+    checksums[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha.hexdigest()}
+
+    os.makedirs(cachepath, exist_ok=True)
+    tmp_file = temporary_name(checksums_file)
+    with open(tmp_file, 'w') as json_file:
+        json.dump(checksums, json_file, indent=1)
+    os.replace(tmp_file, checksums_file)
+
+    return sha.hexdigest()
+
+
+class BackgroundMeshWorker:
+    '''
+    Class with callable instances that compute the low-resolution background 
+    mesh values for a list of boxes in a plate. It provides the callable for
+    the `Pool.apply_async` function (or its thread pool equivalent).
+
+    Box statistics are the same as in photutils' Background2D with a median
+    estimator: sigma-clipped median, with boxes that have too many clipped or
+    masked pixels marked as NaN.
+    '''
+    def __init__(self, name, source, boxes, box_size, sigma=3., exclude_percentile=10., invert=True):
+        '''
+        Parameters:
+
+        name               - id string for this worker
+        source             - plate image file name, or 2D pixel array
+        boxes              - list of (iy, ix) box indices to process
+        box_size           - (y, x) box size in pixels
+        sigma              - sigma clip threshold
+        exclude_percentile - boxes with more than this percentage of clipped
+                             or masked pixels are excluded
+        invert             - invert photographic density to positive, before 
+                             computing statistics
+        '''
+        self.name = name
+        self.source = source
+        self.boxes = boxes
+        self.box_size = box_size
+        self.sigma = sigma
+        self.exclude_percentile = exclude_percentile
+        self.invert = invert
+
+    def __call__(self):
+        from astropy.stats import SigmaClip
+
+        data = self.source
+        if isinstance(data, str):
+            data = get_image(data).data
+
+        sigma_clip = SigmaClip(sigma=self.sigma)
+        box_y, box_x = self.box_size
+        threshold = (1. - self.exclude_percentile / 100.) * box_y * box_x
+
+        result = []
+        for iy, ix in self.boxes:
+            y0 = iy * box_y
+            x0 = ix * box_x
+            block = np.array(data[y0:y0+box_y, x0:x0+box_x], dtype=float).ravel()
+            if self.invert:
+                block = 65535. - block
+            block[~np.isfinite(block)] = np.nan
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=AstropyUserWarning)
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                block = sigma_clip(block, masked=False, copy=False)
+                value = np.nanmedian(block)
+
+            if np.count_nonzero(~np.isnan(block)) <= threshold:
+                value = np.nan
+
+            result.append((iy, ix, value))
+
+        return result
+
+
+def tiled_background(source, shape, box_size=2000, filter_size=101, sigma=3., exclude_percentile=10., 
+                     invert=True, nproc=4, processes=False):
+    '''
+    Full-plate background estimation, equivalent to photutils' Background2D 
+    with a MedianBackground estimator (results are identical, see 
+    tests/test_background.py).
+
+    The plate is split in tiles aligned with the background boxes, and box 
+    statistics are computed in a pool of threads or processes. Each tile is 
+    read and converted to float separately, so there are no full-size float
+    temporaries. The low-resolution mesh is then stitched together, excluded
+    boxes are filled by inverse distance weighting, and the mesh is median 
+    filtered and spline interpolated to full resolution, as in Background2D.
+
+    Parameters:
+
+    source             - plate image file name, or 2D pixel array
+    shape              - plate image shape
+    box_size           - box size in pixels
+    filter_size        - median filter size, applied to the mesh
+    sigma              - sigma clip threshold
+    exclude_percentile - boxes with more than this percentage of clipped
+                         or masked pixels are excluded from the mesh
+    invert             - invert photographic density to positive
+    nproc              - number of parallel workers
+    processes          - use processes instead of threads. Process workers
+                         read the plate themselves when source is a file name.
+
+    Returns:
+
+    background - full-size background map
+    mesh       - low-resolution background mesh
+    '''
+    from scipy.ndimage import generic_filter, zoom
+    from photutils.utils import ShepardIDWInterpolator
+
+    ny, nx = shape
+
+    # as in Background2D, boxes can't be larger than the image
+    box_size = (min(box_size, ny), min(box_size, nx))
+
+    nby = int(math.ceil(ny / box_size[0]))
+    nbx = int(math.ceil(nx / box_size[1]))
+
+    boxes = [(iy, ix) for iy in range(nby) for ix in range(nbx)]
+
+    mesh = np.full((nby, nbx), np.nan)
+
+    def factory(name, index_init, index_end):
+        return BackgroundMeshWorker(name, source, boxes[index_init:index_end], box_size, 
+                                    sigma=sigma, exclude_percentile=exclude_percentile, invert=invert)
+
+    results = parallel_map(factory, len(boxes), nproc=nproc,
+                           backend='process' if processes else 'thread')
+
+    for result in results:
+        for iy, ix, value in result:
+            mesh[iy, ix] = value
+
+    if np.all(np.isnan(mesh)):
+        raise ValueError("All background boxes were excluded. Cannot compute a background.")
+
+    # fill excluded boxes by inverse distance weighting
+    bad = np.isnan(mesh)
+    if np.any(bad):
+        good = ~bad
+        interpolator = ShepardIDWInterpolator(np.column_stack(np.where(good)), mesh[good])
+        mesh[bad] = interpolator(np.column_stack(np.where(bad)), n_neighbors=10, power=1.0)
+
+    if filter_size > 1:
+        mesh = generic_filter(mesh, np.nanmedian, size=filter_size, mode='constant', cval=np.nan)
+
+    if np.ptp(mesh) == 0:
+        return np.full(shape, mesh.min()), mesh
+
+    background = zoom(mesh, box_size, order=3, mode='reflect', grid_mode=True)[:ny, :nx]
+    np.clip(background, mesh.min(), mesh.max(), out=background)
+
+    return background, mesh
+
+
+def get_background(file_name, box_size=2000, filter_size=101, sigma=3., method='tiled', nproc=4,
+                   cachepath=CACHEPATH):
+    '''
+    Gets the background map, and the background-subtracted image, for a full
+    plate. The plate is inverted to positive before the background is estimated
+    with a median estimator, either with the parallel tiled estimator (function
+    tiled_background), or with photutils' Background2D.
+
+    Results are cached on disk as .npy files, keyed by the plate file checksum
+    and the background parameters, so each plate is processed only once. Cached
+    arrays are returned as read-only memory maps.
+
+    Parameters:
+
+    file_name   - plate image file
+    box_size    - Background2D box size
+    filter_size - Background2D filter size
+    sigma       - sigma clip threshold
+    method      - 'tiled' or 'photutils'
+    nproc       - number of threads used by the tiled estimator
+
+    Returns:
+
+    data       - the inverted, background-subtracted image
+    background - the background map
+    '''
+    from astropy.stats import SigmaClip
+    from photutils.background import Background2D, MedianBackground
+
+    key = json.dumps([file_checksum(file_name, cachepath=cachepath), 'median', box_size, filter_size, sigma, method])
+    key = hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    data_file = os.path.join(cachepath, 'bkgsub_' + key + '.npy')
+    background_file = os.path.join(cachepath, 'bkg_' + key + '.npy')
+
+    if not (os.path.exists(data_file) and os.path.exists(background_file)):
+        # photographic images are reversed ("negative"). Invert them to 
+        # positive so the background can be subtracted.
+        raw_data = get_image(file_name).data
+
+        if method == 'tiled':
+            background, _ = tiled_background(raw_data, raw_data.shape, box_size=box_size, filter_size=filter_size,
+                                             sigma=sigma, invert=True, nproc=nproc)
+
+            # subtract in bands of rows, to avoid full-size temporaries
+            data = np.empty(raw_data.shape)
+            for y0 in range(0, raw_data.shape[0], box_size):
+                band = slice(y0, y0 + box_size)
+                np.subtract(65535., raw_data[band], out=data[band])
+                data[band] -= background[band]
+        else:
+            data = 65535. - raw_data
+
+            sigma_clip = SigmaClip(sigma=sigma)
+            bkg_estimator = MedianBackground()
+            bkg = Background2D(data, box_size, filter_size=filter_size, sigma_clip=sigma_clip, 
+                               bkg_estimator=bkg_estimator)
+            background = bkg.background
+
+            data = data - background
+
+        # write to temporary files first, so concurrent readers never see partial files
+        os.makedirs(cachepath, exist_ok=True)
+        for array, cache_file in [(background, background_file), (data, data_file)]:
+            tmp_file = temporary_name(cache_file)
+            with open(tmp_file, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_file, cache_file)
+
+    return np.load(data_file, mmap_mode='r'), np.load(background_file, mmap_mode='r')
+
+
 def is_false_positive(table, row_index, par):
     '''
     Detects false positives that were missed by sextractor.
@@ -91,15 +465,23 @@ def is_false_positive(table, row_index, par):
     
     True if a source is detected on the second image; False otherwise
     
+    If the table already has a 'flux_ratio' column (see function add_flux_ratio),
+    the test is done on that column, and no images are read.
     '''
-    # read both images from the current dataset
-    f_1 = fits.open(fname(par['image1']))
-    f_2 = fits.open(fname(par['image2']))
+    from astropy.coordinates import SkyCoord
+    from photutils.aperture import CircularAperture, aperture_photometry, CircularAnnulus, ApertureStats
+
+    if 'flux_ratio' in table.colnames:
+        return bool(table['flux_ratio'][row_index] < par['false_positive_threshold'])
 
-    wcs_1 = WCS(f_1[0].header)
-    wcs_2 = WCS(f_2[0].header)
-    data_1 = f_1[0].data
-    data_2 = f_2[0].data
+    # get both images from the current dataset
+    image_1 = get_image(fname(par['image1']))
+    image_2 = get_image(fname(par['image2']))
+
+    wcs_1 = image_1.wcs
+    wcs_2 = image_2.wcs
+    data_1 = image_1.data
+    data_2 = image_2.data
                              
     # get target coordinates
     ra  = table['ra_icrs'][row_index]    
@@ -139,15 +521,62 @@ def is_false_positive(table, row_index, par):
     flux_1 = abs(final_flux_1[0])
     flux_2 = abs(final_flux_2[0])
 
-    f_1.close()
-    f_2.close()
-    
     if flux_1 / flux_2 < par['false_positive_threshold']:
         return True
     
     return False
 
 
+def add_flux_ratio(table, par):
+    '''
+    Table-level version of the photometry in function is_false_positive.
+
+    Positions for all rows are converted to pixels with a single call per
+    image, and aperture photometry is run once per image with all apertures.
+    Columns 'flux_1', 'flux_2' and 'flux_ratio' are added to the table. A
+    source is a false positive when flux_ratio < par['false_positive_threshold'].
+
+    Parameters:
+
+    table - table with non-matched sources
+    par   - parameter dict
+
+    Returns:
+
+    the input table, with the new columns
+    '''
+    from astropy.coordinates import SkyCoord
+    from photutils.aperture import CircularAperture, aperture_photometry, CircularAnnulus, ApertureStats
+
+    coords = SkyCoord(ra=np.asarray(table['ra_icrs']), dec=np.asarray(table['dec_icrs']), unit='deg')
+
+    for image_key, column in [('image1', 'flux_1'), ('image2', 'flux_2')]:
+        image = get_image(fname(par[image_key]))
+
+        if len(table) == 0:
+            table[column] = np.array([], dtype=float)
+            continue
+
+        pix_x, pix_y = image.wcs.world_to_pixel(coords)
+        positions = np.column_stack((pix_x, pix_y))
+
+        aperture = CircularAperture(positions, r=5.0)
+        annulus_aperture = CircularAnnulus(positions, r_in=10., r_out=15.)
+
+        phot_table = aperture_photometry(image.data, aperture)
+        annulus_stats = ApertureStats(image.data, annulus_aperture)
+
+        bkg_sum = annulus_stats.median * aperture.area
+
+        # data is in photographic density units
+        table[column] = np.abs(np.asarray(phot_table['aperture_sum']) - bkg_sum)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['flux_ratio'] = np.asarray(table['flux_1']) / np.asarray(table['flux_2'])
+
+    return table
+
+
 def exceeds_criteria(table, row_index, par):
     '''
     Tests if a variety of thresholds are crossed.
@@ -207,8 +636,8 @@ def get_par(table):
     Get the parameters dictionary for a particular table row.
     
     The plate IDs in the table row (current and next) are used
-    to build a key to update variable current_dataset and get
-    the specific parameters dictionary for that dataset.
+    to build a key to get the specific parameters dictionary for 
+    that dataset. File dataset.json is not touched.
     
     Parameters:
     
@@ -224,11 +653,7 @@ def get_par(table):
     plate_id_next = table['plate_id_next'][0]
     dataset_key = str(plate_id) + ',' + str(plate_id_next)
 
-    # update and get new set of parameters
-    update_dataset(dataset_key)
-    reload(settings)
-    from settings import current_dataset
-    par = get_parameters(current_dataset)
+    par = get_parameters(dataset_key)
 
     return par, dataset_key 
         
@@ -238,6 +663,8 @@ def fit_fwhm(data, *, xypos=None, fwhm=None, fit_shape=None, mask=None, error=No
     Overrides photutils library function of same name in order to 
     return the complete PSFPhotometry object.
     '''
+    from photutils.psf import fit_2dgaussian
+
     with warnings.catch_warnings(record=True) as fit_warnings:
         phot = fit_2dgaussian(data, xypos=xypos, fwhm=fwhm, fix_fwhm=False,
                               fit_shape=fit_shape, mask=mask, error=error)
@@ -251,9 +678,283 @@ def fit_fwhm(data, *, xypos=None, fwhm=None, fit_shape=None, mask=None, error=No
     return np.array(phot.results['fwhm_fit']), phot   # returning an extra object
 
 
+GAUSSIAN_FWHM_TO_SIGMA = 1. / (2. * np.sqrt(2. * np.log(2.)))
+
+# columns in the fit results table, in the same order as in the PSFPhotometry results
+fit_columns = ['id', 'group_id', 'group_size', 'local_bkg', 'x_init', 'y_init', 'flux_init', 'fwhm_init',
+               'x_fit', 'y_fit', 'flux_fit', 'fwhm_fit', 'x_err', 'y_err', 'flux_err', 'fwhm_err',
+               'n_pixels_fit', 'qfit', 'cfit', 'reduced_chi2', 'flags']
+
+
+def extract_stamps(data, xypos, fit_shape):
+    '''
+    Extracts square stamps centered on a list of positions. These are the 
+    same pixels that photutils' PSFPhotometry fits. Pixels that fall outside
+    the image, or are not finite, are set to NaN.
+
+    Parameters:
+
+    data      - 2D pixel array
+    xypos     - list or (N, 2) array with x,y positions (px)
+    fit_shape - stamp size (odd number of pixels)
+
+    Returns:
+
+    stamps           - (N, fit_shape, fit_shape) float array
+    x_start, y_start - pixel coordinates in the image, of pixel [0, 0] of each stamp 
+    '''
+    xypos = np.asarray(xypos, dtype=float).reshape(-1, 2)
+    ny, nx = data.shape
+
+    # same rounding as astropy's overlap_slices
+    x_start = np.ceil(xypos[:, 0] - fit_shape / 2.).astype(int)
+    y_start = np.ceil(xypos[:, 1] - fit_shape / 2.).astype(int)
+
+    offsets = np.arange(fit_shape)
+    xx = x_start[:, None] + offsets
+    yy = y_start[:, None] + offsets
+    inside = ((yy >= 0) & (yy < ny))[:, :, None] & ((xx >= 0) & (xx < nx))[:, None, :]
+
+    stamps = np.array(data[np.clip(yy, 0, ny-1)[:, :, None], np.clip(xx, 0, nx-1)[:, None, :]], dtype=float)
+    stamps[~inside] = np.nan
+    stamps[~np.isfinite(stamps)] = np.nan
+
+    return stamps, x_start, y_start
+
+
+def _gaussian_prf(params, x_pix, y_pix, derivatives=False):
+    '''
+    Evaluates pixel-integrated circular Gaussians (the same model as photutils' 
+    CircularGaussianPRF) over a stack of stamps, and optionally their derivatives
+    regarding the parameters flux, x_0, y_0, fwhm. 
+    '''
+    from scipy.special import erf
+
+    flux, x_0, y_0, fwhm = params.T
+    sigma = fwhm * GAUSSIAN_FWHM_TO_SIGMA
+    scale = (1. / (np.sqrt(2.) * sigma))[:, None]
+
+    ax = (x_pix - x_0[:, None] + 0.5) * scale
+    bx = (x_pix - x_0[:, None] - 0.5) * scale
+    ay = (y_pix - y_0[:, None] + 0.5) * scale
+    by = (y_pix - y_0[:, None] - 0.5) * scale
+
+    ex = 0.5 * (erf(ax) - erf(bx))
+    ey = 0.5 * (erf(ay) - erf(by))
+
+    shape = ey[:, :, None] * ex[:, None, :]
+    model = flux[:, None, None] * shape
+
+    if not derivatives:
+        return model
+
+    gax, gbx = np.exp(-ax**2), np.exp(-bx**2)
+    gay, gby = np.exp(-ay**2), np.exp(-by**2)
+    s = sigma[:, None]
+
+    dex_dx0 = (gbx - gax) / (np.sqrt(2. * np.pi) * s)
+    dey_dy0 = (gby - gay) / (np.sqrt(2. * np.pi) * s)
+    dex_ds = (bx * gbx - ax * gax) / (np.sqrt(np.pi) * s)
+    dey_ds = (by * gby - ay * gay) / (np.sqrt(np.pi) * s)
+
+    f = flux[:, None, None]
+    jacobian = np.stack([shape,
+                         f * ey[:, :, None] * dex_dx0[:, None, :],
+                         f * dey_dy0[:, :, None] * ex[:, None, :],
+                         f * (dey_ds[:, :, None] * ex[:, None, :] + ey[:, :, None] * dex_ds[:, None, :]) 
+                           * GAUSSIAN_FWHM_TO_SIGMA], axis=-1)
+
+    return model, jacobian
+
+
+def fit_gaussian_stamps(stamps, x_start, y_start, xypos, fwhm, image_shape, maxiters=100, 
+                        ftol=1.e-10, xtol=1.e-8):
+    '''
+    Fits circular Gaussians to a stack of stamps, all at once, with vectorized
+    Levenberg-Marquardt iterations. The model is the same used by photutils' 
+    fit_2dgaussian (pixel-integrated circular Gaussian, with flux, x, y and 
+    FWHM as free parameters, and no local background).
+
+    Parameters:
+
+    stamps           - (N, k, k) stack of stamps, with NaN in pixels to be ignored
+    x_start, y_start - pixel coordinates in the image of pixel [0, 0] of each stamp
+    xypos            - (N, 2) array with initial x,y positions (px)
+    fwhm             - initial FWHM (px)
+    image_shape      - shape of the image where the stamps come from
+    maxiters         - maximum number of iterations
+    ftol, xtol       - relative tolerances in cost and parameters, for convergence
+
+    Returns:
+
+    table with the same columns as the PSFPhotometry results table
+    '''
+    xypos = np.asarray(xypos, dtype=float).reshape(-1, 2)
+    n, k, _ = stamps.shape
+
+    good = np.isfinite(stamps)
+    weights = good.astype(float)
+    data = np.where(good, stamps, 0.)
+    npix = good.sum(axis=(1, 2))
+
+    x_pix = (x_start[:, None] + np.arange(k)).astype(float)
+    y_pix = (y_start[:, None] + np.arange(k)).astype(float)
+
+    flux_init = data.sum(axis=(1, 2))
+    params = np.column_stack([flux_init, xypos[:, 0], xypos[:, 1], np.full(n, float(fwhm))])
+    nparams = params.shape[1]
+
+    # sources that can't be fitted
+    valid = npix >= nparams
+
+    def _cost(p, rows):
+        residual = (data[rows] - _gaussian_prf(p, x_pix[rows], y_pix[rows])) * weights[rows]
+        return np.sum(residual**2, axis=(1, 2))
+
+    cost = np.full(n, np.nan)
+    rows = np.where(valid)[0]
+    cost[rows] = _cost(params[rows], rows)
+
+    lam = np.full(n, 1.e-3)
+    active = valid & np.isfinite(cost)
+    converged = np.zeros(n, dtype=bool)
+
+    for _ in range(maxiters):
+        rows = np.where(active)[0]
+        if len(rows) == 0:
+            break
+
+        p = params[rows]
+        model, jacobian = _gaussian_prf(p, x_pix[rows], y_pix[rows], derivatives=True)
+        jacobian = (jacobian * weights[rows][..., None]).reshape(len(rows), k * k, nparams)
+        residual = ((data[rows] - model) * weights[rows]).reshape(len(rows), k * k)
+
+        alpha = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+        beta = np.einsum('nmi,nm->ni', jacobian, residual)
+
+        diagonal = np.einsum('nii->ni', alpha)
+        damped = alpha + (lam[rows][:, None] * np.maximum(diagonal, 1.e-12))[:, :, None] * np.eye(nparams)
+
+        try:
+            step = np.linalg.solve(damped, beta[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(damped, beta)])
+
+        p_new = p + step
+        # FWHM is bounded at zero, as in fit_2dgaussian
+        p_new[:, 3] = np.maximum(p_new[:, 3], 1.e-6)
+
+        cost_new = _cost(p_new, rows)
+        accept = np.isfinite(cost_new) & (cost_new <= cost[rows])
+
+        small_cost_change = accept & (cost[rows] - cost_new <= ftol * cost[rows])
+        small_step = accept & np.all(np.abs(step) <= xtol * (np.abs(p) + xtol), axis=1)
+
+        params[rows[accept]] = p_new[accept]
+        cost[rows[accept]] = cost_new[accept]
+        lam[rows[accept]] *= 0.1
+        lam[rows[~accept]] *= 10.
+
+        # damping too large means no further improvement is possible: a minimum was found
+        done = small_cost_change | small_step | (lam[rows] > 1.e10)
+        converged[rows[done]] = True
+        active[rows[done]] = False
+
+    # residuals and covariance at the solution
+    rows = np.where(valid)[0]
+    p = params[rows]
+    model, jacobian = _gaussian_prf(p, x_pix[rows], y_pix[rows], derivatives=True)
+    jacobian = (jacobian * weights[rows][..., None]).reshape(len(rows), k * k, nparams)
+    residual = (data[rows] - model) * weights[rows]
+
+    errors = np.full((n, nparams), np.nan)
+    has_covariance = np.zeros(n, dtype=bool)
+    alpha = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+    dof = npix[rows] - nparams
+    for i, row in enumerate(rows):
+        if dof[i] <= 0:
+            continue
+        try:
+            covariance = np.linalg.inv(alpha[i]) * cost[row] / dof[i]
+        except np.linalg.LinAlgError:
+            continue
+        errors[row] = np.sqrt(np.abs(np.diag(covariance)))
+        has_covariance[row] = True
+
+    sum_abs_residuals = np.full(n, np.nan)
+    sum_abs_residuals[rows] = np.sum(np.abs(residual), axis=(1, 2))
+
+    # residual at the pixel that contains the initial position
+    cen_residuals = np.full(n, np.nan)
+    cx = np.ceil(xypos[rows, 0] - 0.5).astype(int) - x_start[rows]
+    cy = np.ceil(xypos[rows, 1] - 0.5).astype(int) - y_start[rows]
+    inside = (cx >= 0) & (cx < k) & (cy >= 0) & (cy < k)
+    cx = np.clip(cx, 0, k-1)
+    cy = np.clip(cy, 0, k-1)
+    has_center = inside & good[rows, cy, cx]
+    cen_residuals[rows[has_center]] = residual[np.where(has_center)[0], cy[has_center], cx[has_center]]
+
+    fit = np.full((n, nparams), np.nan)
+    fit[valid] = params[valid]
+    errors[~valid] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        qfit = np.where(fit[:, 0] != 0, sum_abs_residuals / fit[:, 0], np.nan)
+        cfit = np.where(fit[:, 0] != 0, cen_residuals / fit[:, 0], np.nan)
+
+    # flags have the same meaning as in PSFPhotometry
+    ny, nx = image_shape
+    flags = np.zeros(n, dtype=int)
+    flags[npix < k * k] |= 1
+    with np.errstate(invalid='ignore'):
+        flags[(fit[:, 1] < -0.5) | (fit[:, 2] < -0.5) | (fit[:, 1] > nx - 0.5) | (fit[:, 2] > ny - 0.5)] |= 2
+        flags[fit[:, 0] <= 0] |= 4
+    flags[valid & ~converged] |= 8
+    flags[~has_covariance] |= 16
+    no_overlap = (x_start + k <= 0) | (y_start + k <= 0) | (x_start >= nx) | (y_start >= ny)
+    flags[no_overlap] |= 64
+    flags[~no_overlap & (npix == 0)] |= 128
+    flags[(npix > 0) & (npix < nparams)] |= 256
+
+    result = Table()
+    result['id'] = np.arange(1, n + 1)
+    result['group_id'] = result['id']
+    result['group_size'] = np.ones(n, dtype=int)
+    result['local_bkg'] = np.zeros(n)
+    result['x_init'] = xypos[:, 0]
+    result['y_init'] = xypos[:, 1]
+    result['flux_init'] = flux_init
+    result['fwhm_init'] = np.full(n, float(fwhm))
+    for i, name in enumerate(['flux', 'x', 'y', 'fwhm']):
+        result[name + '_fit'] = fit[:, i]
+        result[name + '_err'] = errors[:, i]
+    result['n_pixels_fit'] = npix
+    result['qfit'] = qfit
+    result['cfit'] = cfit
+    result['reduced_chi2'] = np.full(n, np.nan)
+    result['flags'] = flags
+
+    return result[fit_columns]
+
+
+def fit_gaussians(data, xypos, fwhm, fit_shape, maxiters=100):
+    '''
+    Batched replacement for fit_fwhm: fits circular Gaussians at a list of
+    positions in an image, all at once. See function fit_gaussian_stamps.
+
+    Returns:
+
+    table with the same columns as the PSFPhotometry results table
+    '''
+    stamps, x_start, y_start = extract_stamps(data, xypos, fit_shape)
+
+    return fit_gaussian_stamps(stamps, x_start, y_start, xypos, fwhm, data.shape, maxiters=maxiters)
+
+
 def get_cutouts(file1, file2, target_coords, size):
     '''
-    Extract cutouts from two images, at the same coordinates.
+    Extract cutouts from two images, at the same coordinates. Images
+    are taken from the process-wide image cache.
 
     Parameters:
 
@@ -262,11 +963,14 @@ def get_cutouts(file1, file2, target_coords, size):
     target_coords - the SkyCoord instance with the center coordinates of the cutouts
     size          - size of the (square) cutout (in units of u * deg)
     '''
+    from astropy.nddata import NoOverlapError
+    from astropy.nddata.utils import Cutout2D
+
     def _get_cutout(file_name, target_coords, size):
-        f = fits.open(file_name)
+        image = get_image(file_name)
 
-        w = WCS(f[0].header)
-        data = f[0].data
+        w = image.wcs
+        data = image.data
         
         try:
             cutout = Cutout2D(data, position=target_coords, size=size, wcs=w)
@@ -289,6 +993,8 @@ def make_sky_coords(table, wcs):
     Converts x,y pixel positions in a table, to a SkyCoord
     object, using the provided WCS instance.
     '''
+    from astropy.coordinates import SkyCoord
+
     x_pos = list(table['x_source'])
     y_pos = list(table['y_source'])
     
@@ -308,6 +1014,9 @@ def rotate_cutout(cutout, angle=90.):
     
     NOT WORKING AT THE MOMENT
     '''
+    from astropy.wcs import WCS
+    from reproject import reproject_interp
+
     wcs = cutout.wcs
     new_wcs = wcs.deepcopy() 
     angle_rad = np.radians(angle)
@@ -427,6 +1136,9 @@ def plot_psf_analysis(table_list, par_set, title=None,
     
     fig -  the matplotlib/pyplot *figure* object
     '''    
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
+
     col_names = ['fwhm_fit', 'elongation', 'qfit', 'cfit']
     colors = [['lightblue', 'black'], 
               [mcolors.CSS4_COLORS['violet'], 'red']]
@@ -554,6 +1266,10 @@ def plot_cutouts(cutout1, cutout2, target_coords, title, invert_color=False,
     fig_1         - Figure where the plots were drawn
     ax_1, ax_2    - Axis objects for each one of the plots (ax_2 can be None) 
     '''    
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+    from matplotlib.colors import LogNorm
+
     def _plot(figure, index, cutout, target_coords, title, invert_color, 
               invert_north, invert_east, rotate, marker="", thumbnail=False,
               lognorm=False):
@@ -670,6 +1386,8 @@ def make_radial_profile(table, source_id, cutout, wcs_original, edge_radii):
     
     RadialProfile instance
     '''
+    from photutils.profiles import RadialProfile
+
     x, y = get_pixel_coords(table, source_id, cutout, wcs_original)
     
     rp = RadialProfile(cutout.data, [x, y], edge_radii)
@@ -677,6 +1395,163 @@ def make_radial_profile(table, source_id, cutout, wcs_original, edge_radii):
     return rp
 
 
+def cutout_positions(table, cutout):
+    '''
+    Gets the pixel coordinates on a cutout, of all sources in a table. This
+    is the same as function get_pixel_coords, for all rows at once, and
+    without going thru sky coordinates.
+
+    Parameters:
+
+    table  - table with X,Y pixel coordinates (on the original image) of sources
+    cutout - image cutout (Cutout2D or StoredCutout)
+
+    Returns:
+
+    (N, 2) array with x,y coordinates in pixels
+    '''
+    x = np.asarray(table['x_source'], dtype=float) - cutout.origin_original[0]
+    y = np.asarray(table['y_source'], dtype=float) - cutout.origin_original[1]
+
+    return np.column_stack([x, y])
+
+
+def circle_corner_area(x, y, radius):
+    '''
+    Signed area of the intersection of a circle centered at the origin with
+    the rectangle that has corners at the origin and at (x, y). The overlap 
+    of the circle with any pixel follows from the values at its four corners
+    (see function radial_profiles). Arguments are arrays that broadcast 
+    against each other.
+    '''
+    radius = np.asarray(radius, dtype=float)
+    r2 = radius**2
+    safe_radius = np.where(radius > 0., radius, 1.)
+
+    # by symmetry, only the first quadrant is needed
+    a = np.minimum(np.abs(x), radius)
+    b = np.minimum(np.abs(y), radius)
+
+    def primitive(t):
+        # integral of sqrt(r^2 - t^2) from 0 to t
+        return 0.5 * (t * np.sqrt(np.maximum(r2 - t**2, 0.)) + r2 * np.arcsin(np.clip(t / safe_radius, -1., 1.)))
+
+    # columns at t < t_b are taller than the rectangle: the area is b*a up to
+    # t_b, and the area under the circle from t_b to a, if a > t_b
+    t_b = np.sqrt(np.maximum(r2 - b**2, 0.))
+
+    area = np.minimum(a, t_b)
+    area *= b
+    area += np.maximum(primitive(a) - primitive(t_b), 0.)
+    area *= np.sign(x)
+    area *= np.sign(y)
+
+    return area
+
+
+def radial_profiles(data, xypos, edge_radii):
+    '''
+    Makes radial profiles around a list of positions in an image, all at once.
+    The profiles are the same as in photutils' RadialProfile (exact pixel 
+    overlaps, non-finite pixels masked), but without building aperture 
+    objects and running aperture photometry once per radius and position.
+
+    For each position, the exact overlap of every circle with a box of pixels
+    around the center is computed once, into a (n_radii, box, box) weights 
+    array. Overlaps come from a closed form (see function circle_corner_area),
+    evaluated for many positions and radii at once, instead of a call to 
+    photutils' circular_overlap_grid per position and radius. Fluxes and areas
+    in all bins then come from reductions over the box pixels.
+
+    Parameters:
+
+    data       - 2D image array (usually a cutout)
+    xypos      - (N, 2) array with x,y positions (px)
+    edge_radii - array of radii defining the edges of the radial bins
+
+    Returns:
+
+    (N, n_bins) array with the profiles
+    '''
+    xypos = np.asarray(xypos, dtype=float).reshape(-1, 2)
+    edge_radii = np.asarray(edge_radii, dtype=float)
+    ny, nx = data.shape
+
+    # box of pixels around the center pixel that contains the largest circle
+    half = int(np.ceil(edge_radii[-1])) + 1
+    offsets = np.arange(-half, half + 1)
+
+    x_center = np.round(xypos[:, 0]).astype(int)
+    y_center = np.round(xypos[:, 1]).astype(int)
+
+    # pixel values in the boxes; pixels outside the image are masked
+    xx = x_center[:, None] + offsets
+    yy = y_center[:, None] + offsets
+    inside = ((yy >= 0) & (yy < ny))[:, :, None] & ((xx >= 0) & (xx < nx))[:, None, :]
+    values = np.array(data[np.clip(yy, 0, ny-1)[:, :, None], np.clip(xx, 0, nx-1)[:, None, :]], dtype=float)
+    valid = inside & np.isfinite(values)
+    values[~valid] = 0.
+
+    # offsets of the box center pixels from the positions
+    x_shift = (x_center - xypos[:, 0])[:, None]
+    y_shift = (y_center - xypos[:, 1])[:, None]
+    valid = valid.astype(float)
+
+    # exact overlap of each circle with the box pixels, for many positions 
+    # and radii at once, by inclusion-exclusion over the pixel corners. 
+    # Circles are taken in groups of consecutive radii, each group over the 
+    # part of the box that contains its largest circle, and positions in 
+    # chunks, to bound memory. Annulus fluxes and areas are differences 
+    # between consecutive circles.
+    flux = np.zeros((len(xypos), len(edge_radii)))
+    area = np.zeros((len(xypos), len(edge_radii)))
+
+    radii_index = np.flatnonzero(edge_radii > 0.)
+    groups = [radii_index[k:k+8] for k in range(0, len(radii_index), 8)]
+
+    for start in range(0, len(xypos), 64):
+        chunk = slice(start, start + 64)
+        for group in groups:
+            h = int(np.ceil(edge_radii[group].max())) + 1
+            edges = np.arange(-h - 0.5, h + 1.)
+            corners = circle_corner_area((x_shift[chunk] + edges)[:, None, None, :], 
+                                         (y_shift[chunk] + edges)[:, None, :, None],
+                                         edge_radii[group][None, :, None, None])
+            weights = corners[..., 1:, 1:] - corners[..., 1:, :-1] - corners[..., :-1, 1:] + corners[..., :-1, :-1]
+
+            box = slice(half - h, half + h + 1)
+            flux[chunk, group] = np.einsum('nkij,nij->nk', weights, values[chunk, box, box])
+            area[chunk, group] = np.einsum('nkij,nij->nk', weights, valid[chunk, box, box])
+
+    # as in aperture photometry, circles with bounding boxes that fall 
+    # entirely outside the image have undefined flux
+    x, y = xypos[:, 0:1], xypos[:, 1:2]
+    outside = (np.ceil(x + edge_radii + 0.5) <= 0) | (np.floor(x - edge_radii + 0.5) >= nx) | \
+              (np.ceil(y + edge_radii + 0.5) <= 0) | (np.floor(y - edge_radii + 0.5) >= ny)
+    outside &= edge_radii > 0.
+    flux[outside] = np.nan
+    area[outside] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.diff(flux, axis=1) / np.diff(area, axis=1)
+
+
+def profile_box_inside(xypos, shape, edge_radii):
+    '''
+    Checks which positions have the box of pixels used by function 
+    radial_profiles entirely inside an image of the given shape. Profiles 
+    at these positions don't depend on anything outside the image.
+    '''
+    xypos = np.asarray(xypos, dtype=float).reshape(-1, 2)
+    half = int(np.ceil(np.max(edge_radii))) + 1
+    ny, nx = shape
+
+    x_center = np.round(xypos[:, 0]).astype(int)
+    y_center = np.round(xypos[:, 1]).astype(int)
+
+    return (x_center - half >= 0) & (x_center + half < nx) & (y_center - half >= 0) & (y_center + half < ny)
+
+
 def make_labels(sid, source_id, label_flag):
     '''
     Encapsulates logic for handling plot labels and colors in profile plots
@@ -711,6 +1586,8 @@ def plot_radial_profiles(ax, table, source_id, cutout, wcs_original, edge_radii,
     edge_radii   - array of radii defining the edges of the radial bins
     title        - plot title
     '''
+    import matplotlib.pyplot as plt
+
     label_flag = True
     
     for row in range(len(table)):
@@ -765,12 +1642,18 @@ def plot_analysis_results(table, table_matched, index, par, flux_range, edge_rad
     Parameters:
     
     table         - table with non-matched objects, with their PSFs already fitted
-    table_matched - table with matched objects, with no PSF fitted
+    table_matched - table with matched objects, with no PSF fitted (or a NeighborhoodIndex over it)
     index         - index in non-matched table where the target object lives
     par           - parameter dict
     flux_range    - range of peak flux where to accept stars for profile analysis
     edge_radii    - radii used to build radial profiles
     '''
+    import matplotlib.pyplot as plt
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord
+    from astropy.stats import SigmaClip
+    from photutils.background import Background2D, MedianBackground
+
     # pick up one row in the non-matched table; extract info
     plate_id = table['plate_id_1'][index]
     plate_id_2 = table['next_plate_id'][index]
@@ -783,10 +1666,10 @@ def plot_analysis_results(table, table_matched, index, par, flux_range, edge_rad
     formatted_y_source = "{:.1f}".format(table['y_source'][index])
 
     # mid-exposure time, exptime, and WCS from image header
-    header_1 = fits.getheader(fname(par['image1']))
-    header_2 = fits.getheader(fname(par['image2']))
+    header_1 = get_image(fname(par['image1'])).header
+    header_2 = get_image(fname(par['image2'])).header
 
-    wcs_1 = WCS(header_1)
+    wcs_1 = get_image(fname(par['image1'])).wcs
     
     time_stamp_1 = header_1['DATE-AVG']
     time_event_1 = Time(time_stamp_1)
@@ -820,23 +1703,33 @@ def plot_analysis_results(table, table_matched, index, par, flux_range, edge_rad
     # sky coords for the target object
     target_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
 
+    # cutouts come from the per-pair cutout store when it is available
+    store = get_cutout_store(par)
+    if store is not None and source_id not in store:
+        store = None
+
     # plot cutouts around target, for both images
-    plot_images(fname(par['image1']), fname(par['image2']), target_coords, target_cutout_size, title, 
-                invert_east=par['invert_east'], invert_north=par['invert_north'], rotate=par['rotate'],
-                marker_right='+')
+    if store is not None:
+        plot_cutouts(store.get('TARGET_1', source_id), store.get('TARGET_2', source_id), target_coords, title,
+                     invert_east=par['invert_east'], invert_north=par['invert_north'], rotate=par['rotate'],
+                     marker_right='+', thumbnail=True)
+    else:
+        plot_images(fname(par['image1']), fname(par['image2']), target_coords, target_cutout_size, title, 
+                    invert_east=par['invert_east'], invert_north=par['invert_north'], rotate=par['rotate'],
+                    marker_right='+')
     
     # cutout for neighborhood needs to be explicitly handled here
-    cutout_1, _no_need = get_cutouts(fname(par['image1']), fname(par['image2']), 
-                                     target_coords, neighborhood_cutout_size)
+    if store is not None:
+        cutout_1 = store.get('NEIGHBORHOOD', source_id)
+    else:
+        cutout_1, _no_need = get_cutouts(fname(par['image1']), None, 
+                                         target_coords, neighborhood_cutout_size)
 
-    # on the matched table, filter out rows that fall outside the neighborhood cutout footprint
-    table_neighborhood = remove_outsiders(cutout_1.data, cutout_1.wcs, table_matched, wcs_table=wcs_1)
-    
-    # now, filter out rows that have peak flux off by more than a given limit
-    mask = table_neighborhood['flux_max'] < (target_flux_max * (1. + flux_range))
-    table_neighborhood = table_neighborhood[mask]
-    mask = table_neighborhood['flux_max'] > (target_flux_max * (1. - flux_range))
-    table_neighborhood = table_neighborhood[mask]
+    # on the matched table, pick up rows that fall inside the neighborhood cutout 
+    # footprint, and have peak flux within a given limit
+    if not isinstance(table_matched, NeighborhoodIndex):
+        table_matched = NeighborhoodIndex(table_matched)
+    table_neighborhood = table_matched.query_cutout(cutout_1, target_flux_max, flux_range)
 
     # skip profile plot if neighborhood is empty of stars with same flux
     if len(table_neighborhood) < 1:
@@ -891,7 +1784,8 @@ def plot_analysis_results(table, table_matched, index, par, flux_range, edge_rad
         sid_list.append(table_all_neighborhood['source_id'][table_row])
     plates = {str(plate_id): sid_list}
     
-    plot_cutout_series(plates, table_all_neighborhood, images, source_id, frames_per_row=frames_per_row)
+    plot_cutout_series(plates, table_all_neighborhood, images, source_id, frames_per_row=frames_per_row,
+                       store=store)
     
     plt.show()
     plt.close()
@@ -981,6 +1875,9 @@ def get_earth_shadow(ra, dec, time_event, longitude=10.242, latitude=53.482):
     - distance in degrees
     - boolean: True - is in shadow; False - is not in shadow
     '''
+    from astropy.coordinates import EarthLocation
+    from earthshadow import get_shadow_radius, dist_from_shadow_center
+
     location = EarthLocation.from_geodetic(longitude, latitude, 0.0)
     es_radius = get_shadow_radius(orbit='GEO', geocentric_angle=False)
     
@@ -994,16 +1891,125 @@ def get_earth_shadow(ra, dec, time_event, longitude=10.242, latitude=53.482):
     return dist.to_value(u.deg)[0], in_shadow
 
 
-def extract_cutout_neighborhood(table_target, table_stars, image_data, image_wcs, 
-                                cutout_size, flux_range, row_index):
+class NeighborhoodIndex:
     '''
-    Extracts an image cutout around a target position. Extracts a table with a list of
-    stars around that position, withinn the cutout boundaries.
-    
+    Spatial and flux index over a table of stars (usually the matched stars 
+    of a plate), to find the stars inside a cutout and within a peak flux
+    window without scanning the whole table.
+
+    Stars are put in square buckets on a grid of plate pixel coordinates 
+    (x_source, y_source). Rows are sorted by bucket, and by flux_max inside 
+    each bucket, so a query visits only the buckets that overlap the cutout,
+    and picks the flux window in each bucket with a binary search.
+
+    Selection is the same as in function remove_outsiders (plus the peak flux
+    cut), assuming the cutout comes from the same image the table positions
+    refer to: a star is inside a cutout when 0 < x,y < cutout size, in cutout
+    pixel coordinates.
+    '''
+    def __init__(self, table, bucket_size=256):
+        '''
+        Parameters:
+
+        table       - table with x_source, y_source and flux_max columns
+        bucket_size - size of the (square) buckets, in pixels
+        '''
+        self.table = table
+        self.bucket_size = bucket_size
+
+        x = np.asarray(table['x_source'], dtype=float)
+        y = np.asarray(table['y_source'], dtype=float)
+        flux = np.asarray(table['flux_max'], dtype=float)
+
+        bx = np.floor(x / bucket_size).astype(int)
+        by = np.floor(y / bucket_size).astype(int)
+        self.bx_min = bx.min() if len(x) > 0 else 0
+        self.by_min = by.min() if len(y) > 0 else 0
+        self.nbx = (bx.max() - self.bx_min + 1) if len(x) > 0 else 0
+        self.nby = (by.max() - self.by_min + 1) if len(y) > 0 else 0
+
+        bucket = (by - self.by_min) * self.nbx + (bx - self.bx_min)
+        self.order = np.lexsort((flux, bucket))
+
+        self.x = x[self.order]
+        self.y = y[self.order]
+        self.flux = flux[self.order]
+
+        # first row of each bucket, in the sorted arrays
+        self.starts = np.searchsorted(bucket[self.order], np.arange(self.nbx * self.nby + 1))
+
+    def __len__(self):
+        return len(self.table)
+
+    def query(self, xmin, xmax, ymin, ymax, flux_min=None, flux_max=None):
+        '''
+        Finds the stars with xmin < x < xmax, ymin < y < ymax, and with 
+        flux_min < peak flux < flux_max (flux limits are optional).
+
+        Returns:
+
+        array with the table rows of the selected stars, in table order
+        '''
+        bs = self.bucket_size
+        bx0 = max(int(np.floor(xmin / bs)) - self.bx_min, 0)
+        bx1 = min(int(np.floor(xmax / bs)) - self.bx_min, self.nbx - 1)
+        by0 = max(int(np.floor(ymin / bs)) - self.by_min, 0)
+        by1 = min(int(np.floor(ymax / bs)) - self.by_min, self.nby - 1)
+
+        rows = []
+        for by in range(by0, by1 + 1):
+            for bx in range(bx0, bx1 + 1):
+                bucket = by * self.nbx + bx
+                start, end = self.starts[bucket], self.starts[bucket + 1]
+                if start == end:
+                    continue
+                if flux_min is not None:
+                    start = start + np.searchsorted(self.flux[start:end], flux_min, side='right')
+                if flux_max is not None:
+                    end = start + np.searchsorted(self.flux[start:end], flux_max, side='left')
+                rows.append(np.arange(start, end))
+
+        if len(rows) == 0:
+            return np.array([], dtype=int)
+        rows = np.concatenate(rows)
+
+        mask = (self.x[rows] > xmin) & (self.x[rows] < xmax) & (self.y[rows] > ymin) & (self.y[rows] < ymax)
+
+        return np.sort(self.order[rows[mask]])
+
+    def query_cutout(self, cutout, target_flux_max=None, flux_range=None):
+        '''
+        Finds the stars inside a cutout (Cutout2D or StoredCutout), optionally 
+        only the ones with peak flux within a fraction flux_range of the target's
+        peak flux.
+
+        Returns:
+
+        table with the selected stars
+        '''
+        x0, y0 = cutout.origin_original
+        ny, nx = cutout.shape
+
+        flux_min = flux_max = None
+        if target_flux_max is not None:
+            flux_min = target_flux_max * (1. - flux_range)
+            flux_max = target_flux_max * (1. + flux_range)
+
+        rows = self.query(x0, x0 + nx, y0, y0 + ny, flux_min=flux_min, flux_max=flux_max)
+
+        return self.table[rows]
+
+
+def extract_cutout_neighborhood(table_target, table_stars, image_data, image_wcs, 
+                                cutout_size, flux_range, row_index):
+    '''
+    Extracts an image cutout around a target position. Extracts a table with a list of
+    stars around that position, withinn the cutout boundaries.
+    
     Parameters:
     
     table_target  - table with the target object
-    table_stars   - table with stars
+    table_stars   - table with stars, or a NeighborhoodIndex over it
     image_data    - image bkg-subtracted pixel array
     image_wcs     - image WCS
     cutout_size   - cutout full size, arcmin
@@ -1015,106 +2021,1615 @@ def extract_cutout_neighborhood(table_target, table_stars, image_data, image_wcs
     cutout             - the Cutout2D instance
     table_neighborhood - the table with stars inside the cutout 
     '''
+    from astropy.nddata.utils import Cutout2D
+    from astropy.coordinates import SkyCoord
+
     # get info from row
     ra  = table_target['ra_icrs'][row_index]
     dec = table_target['dec_icrs'][row_index]
     target_flux_max = table_target['flux_max'][row_index]
 
-    # sky coords for the target object
-    target_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
+    # sky coords for the target object
+    target_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
+
+    # extract cutout from input image, around the target celestial coordinates
+    cutout = Cutout2D(image_data, position=target_coords, size=cutout_size, wcs=image_wcs)
+
+    # stars that fall inside the neighborhood cutout footprint, and have 
+    # peak flux within the given limit
+    if not isinstance(table_stars, NeighborhoodIndex):
+        table_stars = NeighborhoodIndex(table_stars)
+    table_neighborhood = table_stars.query_cutout(cutout, target_flux_max, flux_range)
+
+    return cutout, table_neighborhood
+
+
+def plot_cutout_series(plates, table, images, target_id, frames_per_row=8, figsize=(10, 4), store=None):
+    '''
+    Plots a sequence of thumbnail images with the center of each thumbnail at
+    a particular coordinates from a table. 
+    
+    'plates' is a dict whose keys are plate ID numbers, and the value for each
+    key is a list of source ID numbers. Each one is looked for at the table and
+    plotted as a small thumbnail. An example of the 'plates' dict can be found at
+    notebook 'results_analyis.ipynb
+    
+    Parameters:
+    plates    - dict keyed by plate ID, with lists of source IDs to be plotted
+    table     - table with object coordinates
+    images    - dict that translates between plate ID, and image file name
+    target_id - the source_id of the target
+    store     - CutoutStore for the plate pair, or None. When given, thumbnails for 
+                its first plate are taken from the store instead of the plate scan.
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    from astropy.coordinates import SkyCoord
+
+    frame_number = 0
+    figure = plt.figure(figsize=figsize)
+    
+    for plate in list(plates.keys()):
+        sids = plates[plate]
+
+        for sid in sids: 
+            
+            # get transient coordinates and other info
+            m = table['source_id'] == sid
+            t = table[m]
+
+            # handle case were the same source ID shows up more than once in the table. This
+            # is caused by duplication within sequences.
+            if (len(t)) > 1:
+                t = t[[0]]
+            
+            ra  = t['ra_icrs']
+            dec = t['dec_icrs']
+            target_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
+            
+            annular_bin = t['annular_bin_1'][0]
+
+            # read cutout
+            size = 17
+            cutout = None
+            if store is not None and images[str(plate)] == store.header['PLATE1']:
+                cutout = get_stored_thumbnail(store, sid, target_id, target_coords, size)
+            if cutout is None:
+                image_name = fname(images[str(plate)])
+                cutout, _ = get_cutouts(image_name, None, target_coords, size)
+            cw = cutout.wcs
+            pixdata = cutout.data
+            
+            # display it
+            text1 = str(sid)[-6:]
+            if target_id is not None and sid == target_id:
+                text1 = text1 + " - Target"
+            text2 = str(annular_bin) + "          " + str(plate)
+ 
+            color_map = plt.get_cmap('viridis').reversed()
+            plt.subplots_adjust(wspace=0, hspace=0, left=0, right=1, bottom=0, top=1)      
+            ax = figure.add_subplot(1, frames_per_row, frame_number+1, projection=cw)
+            image = ax.imshow(pixdata, origin='lower', cmap=color_map, norm=LogNorm())
+            ax.text(1, int(size-2), text1, fontsize=9, color='white')
+            ax.text(1, 0, text2, fontsize=9, color='white')
+            ax.axis('off')
+            ax.grid(color='white', ls='solid')
+
+            frame_number += 1
+
+            if frame_number >= frames_per_row:
+                # dump figure and create next figure
+                plt.tight_layout()
+                plt.show()
+                plt.close()
+                figure = plt.figure(figsize=figsize)
+
+                frame_number = 0
+
+    plt.tight_layout()
+    plt.show()            
+    plt.close()
+
+    
+class StoredCutout:
+    '''
+    Image cutout read from a cutout store. It stands in for Cutout2D instances
+    in the plotting and profile functions: it has the same 'data', 'wcs', 
+    'shape' and 'origin_original' attributes, and the position conversion methods.
+    '''
+    def __init__(self, data, wcs, origin_original):
+        self.data = data
+        self.wcs = wcs
+        self.shape = data.shape
+        self.origin_original = origin_original
+
+    def to_original_position(self, cutout_position):
+        return (cutout_position[0] + self.origin_original[0], 
+                cutout_position[1] + self.origin_original[1])
+
+    def to_cutout_position(self, original_position):
+        return (original_position[0] - self.origin_original[0], 
+                original_position[1] - self.origin_original[1])
+
+
+class CutoutStore:
+    '''
+    Per-pair store with image cutouts around the non-matched targets. It is
+    written at the end of psf_analysis.ipynb, and read by the display notebooks,
+    so these don't have to read the full plate scans again.
+
+    The store is a FITS file with:
+
+     - an INDEX binary table with the source_id of each target, and the bounding 
+       box of each cutout inside its cube layer (columns <layer>_BBOX, holding
+       ymin, ymax, xmin, xmax, and the cutout origin x, y in the original image);
+     - one float32 cube per layer, one plane per target. Cutouts that fall partially
+       outside the plate are padded with NaN, and the bounding box trims them back;
+     - WCS_IMAGE1 and WCS_IMAGE2 header-only extensions with the plates' WCS. 
+
+    Planes are read with the FITS section interface, so only the requested cutouts
+    are read from disk. Cutouts come out identical to the ones produced by Cutout2D
+    (with the default 'trim' mode) from the full plate.
+    '''
+    # layer name, image, and key in par dict with the cutout size in arcmin 
+    # (or the size in pixels for thumbnails)
+    layers = [('NEIGHBORHOOD', 'image1', 'neighborhood_cutout_size'),
+              ('TARGET_1',     'image1', 'display_cutout_size'),
+              ('TARGET_2',     'image2', 'display_cutout_size'),
+              ('THUMBNAIL',    'image1', None)]
+
+    def __init__(self, file_name):
+        from astropy.wcs import WCS
+
+        self.file_name = file_name
+        self.hdul = fits.open(file_name, memmap=True)
+        self.header = self.hdul[0].header
+
+        index = self.hdul['INDEX'].data
+        self.source_id = np.array(index['source_id'])
+        self._rows = {sid: row for row, sid in enumerate(self.source_id)}
+        self._bbox = {layer: np.array(index[layer + '_BBOX']) for layer, _, _ in self.layers}
+
+        self._wcs = {}
+        for _, image_key, _ in self.layers:
+            self._wcs[image_key] = WCS(self.hdul['WCS_' + image_key.upper()].header)
+
+    def __contains__(self, source_id):
+        return source_id in self._rows
+
+    def __len__(self):
+        return len(self.source_id)
+
+    def get(self, layer, source_id):
+        '''
+        Returns the StoredCutout for a given layer and source, or None if
+        the source is not in the store, or its cutout had no overlap with the plate.
+        '''
+        from astropy.wcs import Sip
+
+        row = self._rows.get(source_id)
+        if row is None:
+            return None
+
+        ymin, ymax, xmin, xmax, x0, y0 = self._bbox[layer][row]
+        if ymin < 0:
+            return None
+
+        data = np.array(self.hdul[layer].section[row, ymin:ymax, xmin:xmax])
+
+        image_key = [image_key for name, image_key, _ in self.layers if name == layer][0]
+        wcs_original = self._wcs[image_key]
+
+        # same WCS handling as in Cutout2D
+        wcs = wcs_original.deepcopy()
+        wcs.wcs.crpix -= (x0, y0)
+        wcs.array_shape = data.shape
+        if wcs_original.sip is not None:
+            wcs.sip = Sip(wcs_original.sip.a, wcs_original.sip.b, 
+                          wcs_original.sip.ap, wcs_original.sip.bp,
+                          wcs_original.sip.crpix - (x0, y0))
+
+        return StoredCutout(data, wcs, (x0, y0))
+
+    def close(self):
+        self.hdul.close()
+
+
+def write_cutout_store(table, par, thumbnail_size=17):
+    '''
+    Writes the cutout store (see class CutoutStore) for the current pair of plates.
+
+    Parameters:
+
+    table          - table with the non-matched targets
+    par            - parameter dict
+    thumbnail_size - size of thumbnails, in pixels
+
+    Returns:
+
+    the store file name
+    '''
+    from astropy.nddata import NoOverlapError
+    from astropy.nddata.utils import Cutout2D, overlap_slices
+    from astropy.coordinates import SkyCoord
+
+    coords = SkyCoord(ra=np.asarray(table['ra_icrs']), dec=np.asarray(table['dec_icrs']), unit='deg')
+    nrows = len(table)
+
+    index = Table()
+    index['source_id'] = table['source_id']
+
+    primary = fits.PrimaryHDU()
+    primary.header['PLATE1'] = par['image1']
+    primary.header['PLATE2'] = par['image2']
+    primary.header['NBHDSIZE'] = (float(par['neighborhood_cutout_size']), 'arcmin')
+    primary.header['DISPSIZE'] = (float(par['display_cutout_size']), 'arcmin')
+    primary.header['THMBSIZE'] = (thumbnail_size, 'px')
+
+    cubes = []
+    wcs_hdus = {}
+    for layer, image_key, size_key in CutoutStore.layers:
+        image = get_image(fname(par[image_key]))
+
+        size = thumbnail_size
+        if size_key is not None:
+            size = float(par[size_key]) / 60. * u.deg
+
+        bbox = np.full((nrows, 6), -1, dtype=np.int32)
+        cube = None
+
+        for row in range(nrows):
+            try:
+                cutout = Cutout2D(image.data, position=coords[row], size=size, wcs=image.wcs)
+            except NoOverlapError:
+                continue
+
+            # cubes hold the full-size cutout, so place the (possibly trimmed) 
+            # cutout where it would be in the full-size box.
+            if cube is None:
+                cube = np.full((nrows,) + tuple(cutout.shape_input), np.nan, dtype=np.float32)
+
+            _, slices_box = overlap_slices(image.data.shape, cube.shape[1:], 
+                                           cutout.input_position_original[::-1], mode='partial')
+            cube[row][slices_box] = cutout.data
+
+            bbox[row] = [slices_box[0].start, slices_box[0].stop, slices_box[1].start, slices_box[1].stop, 
+                         cutout.origin_original[0], cutout.origin_original[1]]
+
+        if cube is None:
+            cube = np.full((nrows, 1, 1), np.nan, dtype=np.float32)
+
+        index[layer + '_BBOX'] = bbox
+        cubes.append(fits.ImageHDU(cube, name=layer))
+
+        if image_key not in wcs_hdus:
+            wcs_hdus[image_key] = fits.ImageHDU(header=image.wcs.to_header(relax=True), 
+                                                name='WCS_' + image_key.upper())
+
+    hdul = fits.HDUList([primary, fits.BinTableHDU(index, name='INDEX')] + cubes + list(wcs_hdus.values()))
+
+    file_name = fname(par['cutout_store'])
+    hdul.writeto(file_name, overwrite=True)
+
+    return file_name
+
+
+def get_stored_thumbnail(store, source_id, target_id, coords, size):
+    '''
+    Gets a thumbnail from a cutout store. The target's thumbnail is stored 
+    as is; thumbnails for neighborhood stars are cut from the target's 
+    neighborhood cutout. Returns None if the thumbnail can't be built from
+    the store (e.g. it would extend beyond the neighborhood cutout).
+    '''
+    from astropy.nddata import NoOverlapError
+    from astropy.nddata.utils import Cutout2D
+
+    if source_id in store and store.header['THMBSIZE'] == size:
+        return store.get('THUMBNAIL', source_id)
+
+    neighborhood = store.get('NEIGHBORHOOD', target_id)
+    if neighborhood is None:
+        return None
+
+    try:
+        cutout = Cutout2D(neighborhood.data, position=coords, size=size, wcs=neighborhood.wcs)
+    except NoOverlapError:
+        return None
+
+    if cutout.shape != (size, size):
+        return None
+
+    return cutout
+
+
+# opened stores, keyed by file name and modification time
+cutout_stores = {}
+
+def get_cutout_store(par):
+    '''
+    Returns the cutout store for the current pair of plates, or None if there
+    is no store, or if it was written with cutout sizes different from the 
+    ones in the parameter dict.
+    '''
+    file_name = fname(par['cutout_store'])
+    try:
+        key = (file_name, os.path.getmtime(file_name))
+    except OSError:
+        return None
+
+    if key not in cutout_stores:
+        cutout_stores[key] = CutoutStore(file_name)
+    store = cutout_stores[key]
+
+    if store.header['NBHDSIZE'] != float(par['neighborhood_cutout_size']) or \
+       store.header['DISPSIZE'] != float(par['display_cutout_size']):
+        return None
+
+    return store
+
+
+
+def unit_vectors(ra, dec):
+    '''
+    Converts celestial coordinates (in degrees) to an (N, 3) array of
+    cartesian unit vectors.
+    '''
+    ra_rad  = np.radians(np.asarray(ra, dtype=float))
+    dec_rad = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec_rad)
+
+    return np.column_stack((cos_dec * np.cos(ra_rad), cos_dec * np.sin(ra_rad), np.sin(dec_rad)))
+
+
+def within_tolerance(ra1, dec1, ra2, dec2, tolerance, shape='box'):
+    '''
+    Element-wise test of coordinate pairs against a matching tolerance.
+
+    Parameters:
+
+    ra1, dec1 - coordinates of the first element of each pair, in degrees
+    ra2, dec2 - coordinates of the second element of each pair, in degrees
+    tolerance - half-size of box, or radius of circle, in degrees
+    shape     - 'box' accepts pairs with both |delta RA| and |delta Dec| within
+                the tolerance (same as the test in Worker.matched, but with
+                delta RA taken across the 0/360 deg boundary); 'circle' accepts
+                pairs with angular separation within the tolerance.
+
+    Returns:
+
+    boolean array, True where the pair is accepted
+    '''
+    dra  = (np.asarray(ra2) - np.asarray(ra1) + 180.) % 360. - 180.
+    ddec = np.asarray(dec2) - np.asarray(dec1)
+
+    if shape == 'box':
+        return (np.abs(dra) <= tolerance) & (np.abs(ddec) <= tolerance)
+
+    if shape == 'circle':
+        # haversine formula; well behaved at small separations
+        hav = np.sin(np.radians(ddec) / 2.)**2 + \
+              np.cos(np.radians(dec1)) * np.cos(np.radians(dec2)) * np.sin(np.radians(dra) / 2.)**2
+        separation = np.degrees(2. * np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+        return separation <= tolerance
+
+    raise ValueError("Unknown matching shape: " + str(shape))
+
+
+class SkyIndex:
+    '''
+    Spatial index over a set of celestial positions.
+
+    Positions are stored as unit vectors in a KD-tree, so searches do not
+    suffer from the RA wrap-around at 0/360 deg, nor from the coordinate
+    singularity at the poles. Candidate pairs are found with a radius search
+    that encloses the acceptance region, and then subjected to the exact test
+    in function within_tolerance. Use shape='circle' close to the poles,
+    where a box defined in RA degrees is no longer meaningful.
+    '''
+    def __init__(self, ra, dec):
+        '''
+        Parameters:
+
+        ra, dec - arrays with coordinates, in degrees
+        '''
+        self.ra  = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+
+        self.tree = cKDTree(unit_vectors(self.ra, self.dec))
+
+    @classmethod
+    def from_table(cls, table, x_label='ra_icrs', y_label='dec_icrs'):
+        return cls(table[x_label], table[y_label])
+
+    def __len__(self):
+        return len(self.ra)
+
+    @staticmethod
+    def _search_radius(tolerance, shape):
+        # chord length that encloses the acceptance region. The box
+        # corners are at most sqrt(2) * tolerance away from its center.
+        angle = tolerance
+        if shape == 'box':
+            angle = tolerance * math.sqrt(2.)
+        return 2. * math.sin(math.radians(angle) / 2.) * (1. + 1.e-9)
+
+    def query_pairs(self, ra, dec, tolerance=5./3600., shape='box'):
+        '''
+        Finds all pairs made of a query position and an indexed position
+        that are within the tolerance of each other.
+
+        Parameters:
+
+        ra, dec   - arrays with the query coordinates, in degrees
+        tolerance - half-size of search box (or radius of search circle), in degrees
+        shape     - 'box' or 'circle' (see function within_tolerance)
+
+        Returns:
+
+        i - indices into the query arrays
+        j - indices into this index
+        '''
+        query = SkyIndex(ra, dec)
+
+        pairs = query.tree.sparse_distance_matrix(self.tree, self._search_radius(tolerance, shape),
+                                                  output_type='ndarray')
+        i = pairs['i'].astype(np.int64)
+        j = pairs['j'].astype(np.int64)
+
+        accept = within_tolerance(query.ra[i], query.dec[i], self.ra[j], self.dec[j], tolerance, shape)
+
+        return i[accept], j[accept]
+
+    def self_pairs(self, tolerance=5./3600., shape='box'):
+        '''
+        Finds all pairs of indexed positions that are within the tolerance
+        of each other.
+
+        Returns:
+
+        i, j - arrays with the indices of each pair, with i < j
+        '''
+        pairs = self.tree.query_pairs(self._search_radius(tolerance, shape), output_type='ndarray')
+        i = pairs[:, 0].astype(np.int64)
+        j = pairs[:, 1].astype(np.int64)
+
+        accept = within_tolerance(self.ra[i], self.dec[i], self.ra[j], self.dec[j], tolerance, shape)
+
+        return i[accept], j[accept]
+
+    def has_match(self, ra, dec, tolerance=5./3600., shape='box'):
+        '''
+        Returns a boolean array, True for query positions that have at
+        least one indexed position within the tolerance.
+        '''
+        i, _ = self.query_pairs(ra, dec, tolerance=tolerance, shape=shape)
+
+        result = np.zeros(len(np.atleast_1d(ra)), dtype=bool)
+        result[i] = True
+
+        return result
+
+
+class SharedColumns:
+    '''
+    Holds a set of named numpy arrays (usually table columns) in shared
+    memory blocks.
+
+    Instances can be handed to worker processes in place of an astropy Table.
+    Only the block names, dtypes and shapes are pickled; workers attach to the
+    blocks by name the first time a column is accessed, so the data reaches
+    each worker without being copied. Column access (shared['ra_icrs']) and 
+    len() work as they do with a Table, so instances can be handed to Worker
+    and Worker2 as is.
+
+    The process that creates the instance owns the blocks, and must release
+    them by calling close() (or by using the instance as a context manager).
+    '''
+    def __init__(self, table, columns):
+        '''
+        Parameters:
+
+        table   - astropy Table, or dict of numpy arrays
+        columns - names of the columns to be placed in shared memory
+        '''
+        self._owner = True
+        self._specs  = {}
+        self._blocks = {}
+        self._arrays = {}
+
+        for name in columns:
+            array = np.ascontiguousarray(np.asarray(table[name]))
+
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            view[...] = array
+
+            self._specs[name]  = (block.name, array.dtype.str, array.shape)
+            self._blocks[name] = block
+            self._arrays[name] = view
+
+    def __getstate__(self):
+        # just what is needed to attach to the blocks
+        return {'_specs': self._specs}
+
+    def __setstate__(self, state):
+        self._owner = False
+        self._specs  = state['_specs']
+        self._blocks = {}
+        self._arrays = {}
+
+    def _attach(self, name):
+        block_name, dtype, shape = self._specs[name]
+
+        # the owner is in charge of releasing the block, so workers shouldn't
+        # have it tracked (the 'track' argument only exists in python >= 3.13)
+        try:
+            block = shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=block_name)
+
+        self._blocks[name] = block
+        self._arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._attach(name)
+        return self._arrays[name]
+
+    def __len__(self):
+        block_name, dtype, shape = next(iter(self._specs.values()))
+        return shape[0]
+
+    @property
+    def colnames(self):
+        return list(self._specs.keys())
+
+    def close(self):
+        '''
+        Detaches from the blocks; the owner also releases them. Views
+        obtained from this instance must not be used afterwards.
+        '''
+        self._arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def peak_rss():
+    '''
+    Peak resident set size of this process so far, in MB. NaN where the
+    resource module is not available.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 1024**2
+    return maxrss / 1024
+
+
+class Profiler:
+    '''
+    Collects timing and memory records for pipeline stages, the steps inside
+    them, and the worker calls made by parallel_map.
+
+    Each record is a dict with the step name, its level ('stage', 'step' or
+    'worker'), wall and CPU time (s), peak RSS of the process that ran it (MB),
+    rows in and out (when they apply), plus the labels (e.g. the pair key) 
+    active when it was recorded. 
+
+    The CPU time of a step is process CPU time (time.process_time), so it 
+    includes the threads the step runs, plus the CPU time of the workers it
+    ran in pool processes. The CPU time of a worker call is the CPU time of
+    the thread that ran it (time.thread_time).
+
+    A process-wide instance is kept in the module-level profiler variable. 
+    Usage:
+
+        with profiler.step('cross_match', rows_in=len(table)) as record:
+            ...
+            record['rows_out'] = len(matched)
+    '''
+    def __init__(self):
+        self.records = []
+        self.labels = {}
+        self.child_cpu = 0.
+
+    def add(self, record):
+        record = dict(self.labels, **record)
+        self.records.append(record)
+        return record
+
+    @contextmanager
+    def step(self, name, rows_in=None, level='step', **labels):
+        record = {'step': name, 'level': level, 'rows_in': rows_in, 'rows_out': None, 'start': time.time()}
+        record.update(labels)
+
+        wall = time.perf_counter()
+        cpu = time.process_time() + self.child_cpu
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() + self.child_cpu - cpu
+            record['peak_rss'] = peak_rss()
+            record['pid'] = os.getpid()
+            self.add(record)
+
+    @contextmanager
+    def labelled(self, **labels):
+        '''
+        Within this context, records get the given labels.
+        '''
+        saved = self.labels
+        self.labels = dict(saved, **labels)
+        try:
+            yield
+        finally:
+            self.labels = saved
+
+    @contextmanager
+    def recording(self):
+        '''
+        Within this context, records go to a new list, which is yielded, and
+        CPU time of pool processes is counted from zero. Processes that are
+        reused (e.g. to run several pairs) get a clean state for each run.
+        '''
+        saved = self.records, self.child_cpu
+        self.records = []
+        self.child_cpu = 0.
+        try:
+            yield self.records
+        finally:
+            # steps that enclose the context still see the CPU time of its workers
+            self.records, self.child_cpu = saved[0], saved[1] + self.child_cpu
+
+
+profiler = Profiler()
+
+
+def _timed_call(worker, rows_in):
+    # calls a worker, and returns its result with a 'worker' level record
+    start = time.time()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+
+    result = worker()
+
+    record = {'step': type(worker).__name__, 'level': 'worker', 'worker': getattr(worker, 'name', None),
+              'rows_in': rows_in, 'rows_out': len(result) if isinstance(result, (Table, list)) else None,
+              'start': start, 'wall': time.perf_counter() - wall, 'cpu': time.thread_time() - cpu,
+              'peak_rss': peak_rss(), 'pid': os.getpid()}
+
+    return result, record
+
+
+def _call_worker(task):
+    # runs in the pool; must live at module level so it can be pickled
+    chunk, rows_in, worker = task
+    result, record = _timed_call(worker, rows_in)
+    return chunk, result, record
+
+
+def parallel_map(factory, table, nproc=1, chunk_size=None, backend='process', chunks_per_proc=8, pool=None):
+    '''
+    Runs worker instances (Worker, Worker2, FitWorker, ProfileWorker, ...)
+    over a table, with the rows split in many small chunks.
+
+    Chunks are handed to the pool one at a time, as workers become free
+    (imap_unordered), so a chunk that takes long (e.g. in a crowded region
+    of the plate) doesn't hold back the others. Results are put back in row
+    order before returning.
+
+    Workers are built in the calling process, by a factory with signature
+    factory(name, index_init, index_end), and are pickled into the pool
+    processes (with the 'process' backend). Large arrays (e.g. the image)
+    should reach them through shared memory (see SharedColumns).
+
+    Parameters:
+
+    factory         - callable that returns a worker for a range of table rows
+    table           - table whose rows are split among workers (or its length)
+    nproc           - number of processes (or threads)
+    chunk_size      - rows per chunk; default is len(table)/(nproc*chunks_per_proc)
+    backend         - 'process', 'thread', or 'serial'
+    chunks_per_proc - number of chunks per process, when chunk_size is not given
+    pool            - an open Pool (or ThreadPool) to run the chunks in, for callers
+                      that run several maps in a row. It is left open.
+
+    Returns:
+
+    list with the results returned by each worker, in row order. Each worker
+    call is also recorded by the profiler (see class Profiler).
+    '''
+    nrows = table if isinstance(table, int) else len(table)
+
+    if chunk_size is None:
+        chunk_size = int(math.ceil(nrows / max(nproc * chunks_per_proc, 1)))
+    chunk_size = max(int(chunk_size), 1)
+
+    ranges = [(start, min(start + chunk_size, nrows)) for start in range(0, nrows, chunk_size)]
+
+    # an empty table still gets one (empty) worker, so callers always have a result to stack
+    if len(ranges) == 0:
+        ranges = [(0, 0)]
+
+    if pool is None and (nproc <= 1 or len(ranges) <= 1):
+        backend = 'serial'
+
+    # CPU time spent in other processes is not seen by time.process_time()
+    if pool is not None:
+        in_children = not isinstance(pool, ThreadPool)
+    else:
+        in_children = backend == 'process'
+
+    # workers are built as the pool asks for them, so they don't all sit in memory at once
+    tasks = ((chunk, row_end - row_start, factory("w"+str(chunk), row_start, row_end)) 
+             for chunk, (row_start, row_end) in enumerate(ranges))
+
+    results = [None] * len(ranges)
+
+    def collect(chunk, result, record):
+        results[chunk] = result
+        profiler.add(record)
+        if in_children:
+            profiler.child_cpu += record['cpu']
+
+    if backend == 'serial':
+        for task in tasks:
+            collect(*_call_worker(task))
+        return results
+
+    if pool is not None:
+        for chunk, result, record in pool.imap_unordered(_call_worker, tasks):
+            collect(chunk, result, record)
+        return results
+
+    if backend == 'process':
+        pool = Pool(min(nproc, len(ranges)))
+    elif backend == 'thread':
+        pool = ThreadPool(min(nproc, len(ranges)))
+    else:
+        raise ValueError("Unknown backend: " + str(backend))
+
+    try:
+        for chunk, result, record in pool.imap_unordered(_call_worker, tasks):
+            collect(chunk, result, record)
+    except Exception:
+        pool.terminate()
+        raise
+
+    pool.close()
+    pool.join()
+
+    return results
+
+
+def run_match_workers(table1, table2=None, nproc=1, tolerance=5./3600., method='vectorized',
+                      columns=['ra_icrs', 'dec_icrs', 'source_id'], chunk_size=None):
+    '''
+    Runs Worker (or Worker2, when table2 is None) over a table, with the
+    rows split in chunks among nproc processes (see parallel_map). 
+
+    Only the columns needed for matching reach the worker processes, through
+    shared memory blocks (see SharedColumns). The tables themselves are never
+    pickled, so pool startup doesn't grow with the table sizes.
+
+    Parameters:
+
+    table1     - sources table for the first plate
+    table2     - sources table for the second plate, or None to look for duplications in table1
+    nproc      - number of processes
+    tolerance  - half-size of search box, in degrees. Default is 5 arcsec.
+    method     - 'vectorized' or 'loop' (see Worker)
+    columns    - columns used by the workers
+    chunk_size - rows per worker (see parallel_map)
+
+    Returns:
+
+    list with indices in table1 of the rows that have a match, in row order
+    '''
+    if nproc <= 1:
+        if table2 is None:
+            worker = Worker2("w0", table1, 0, len(table1), tolerance=tolerance, method=method)
+        else:
+            worker = Worker("w0", table1, table2, 0, len(table1), tolerance=tolerance, method=method)
+        return list(worker())
+
+    shared_1 = SharedColumns(table1, columns)
+    shared_2 = None
+    if table2 is not None:
+        shared_2 = SharedColumns(table2, columns)
+
+    def factory(name, row_start, row_end):
+        if shared_2 is None:
+            return Worker2(name, shared_1, row_start, row_end, tolerance=tolerance, method=method)
+        return Worker(name, shared_1, shared_2, row_start, row_end, tolerance=tolerance, method=method)
+
+    try:
+        results = parallel_map(factory, table1, nproc=nproc, chunk_size=chunk_size)
+    finally:
+        shared_1.close()
+        if shared_2 is not None:
+            shared_2.close()
+
+    matched = []
+    for result in results:
+        matched.extend(result)
+
+    return matched
+
+
+def cross_match(table1, table2=None, tolerance=5./3600., shape='box', method='tree',
+                x_label='ra_icrs', y_label='dec_icrs', nproc=1):
+    '''
+    Finds which sources in one table have a counterpart in another table.
+
+    Stands in for the Worker and Worker2 parallel loops in find_mismatches.ipynb.
+    When table2 is None, table1 is matched against itself in the same way Worker2
+    does it: a row counts as matched when some *later* row in the table lies
+    within the tolerance.
+
+    Parameters:
+
+    table1    - sources table for the first plate
+    table2    - sources table for the second plate, or None to look for duplications in table1
+    tolerance - half-size of search box (or radius of search circle), in degrees. Default is 5 arcsec.
+    shape     - acceptance test, 'box' or 'circle' (see function within_tolerance)
+    method    - 'tree' (default) uses a SkyIndex and runs in O(N log N). 'vectorized' and 'loop' run
+                the old Worker code (Worker.matched_vectorized and Worker.matched, respectively)
+                serially over the entire table. These are very slow, and are provided only to check
+                that results agree with the old code. They ignore the 'shape' parameter.
+    x_label, y_label - names of the coordinate columns
+    nproc     - number of processes used by the 'vectorized' and 'loop' methods
+
+    Returns:
+
+    matched     - sorted array with indices in table1 of sources that have a match
+    non_matched - sorted array with indices in table1 of sources with no match
+    '''
+    if method == 'tree':
+        ra1  = np.asarray(table1[x_label], dtype=float)
+        dec1 = np.asarray(table1[y_label], dtype=float)
+
+        if table2 is None:
+            i, _ = SkyIndex(ra1, dec1).self_pairs(tolerance=tolerance, shape=shape)
+            matched = np.unique(i)
+        else:
+            index = SkyIndex.from_table(table2, x_label=x_label, y_label=y_label)
+            matched = np.flatnonzero(index.has_match(ra1, dec1, tolerance=tolerance, shape=shape))
+
+    elif method in ['vectorized', 'loop']:
+        matched = run_match_workers(table1, table2, nproc=nproc, tolerance=tolerance, method=method,
+                                    columns=[x_label, y_label, 'source_id'])
+        matched = np.unique(np.array(matched, dtype=np.int64))
+
+    else:
+        raise ValueError("Unknown matching method: " + str(method))
+
+    non_matched = np.setdiff1d(np.arange(len(table1)), matched)
+
+    return matched, non_matched
+
+
+# Columns used by the matching and selection code, named as in the joined 
+# table. Passing them as the columns argument of read_sources keeps a much 
+# smaller cache, but then the tables written downstream lose all the other 
+# APPLAUSE columns (magnitudes, timestamps, etc.), so by default all columns
+# are kept.
+source_columns = ['source_id', 'plate_id', 'plate_id_1', 'plate_id_2', 'scan_id', 'scan_id_1', 'scan_id_2',
+                  'ra_icrs', 'dec_icrs', 'gaiaedr3_id', 'x_source', 'y_source', 'flux_max', 'elongation',
+                  'flag_rim', 'sextractor_flags_1', 'sextractor_flags_2', 'model_prediction_1', 
+                  'model_prediction_2', 'annular_bin_1', 'annular_bin_2']
+
+
+def merge_join(table1, table2, key='source_id'):
+    '''
+    Inner join of two tables on a key column, for tables with unique keys. 
+    Rows are matched with a merge over the sorted keys, which is much faster 
+    than astropy's join. The APPLAUSE tables are downloaded already sorted 
+    by source_id, so the sort is usually skipped.
+
+    Output columns are named as in astropy's join: columns present in both 
+    tables get suffixes '_1' (table1) and '_2' (table2). Tables with repeated 
+    keys are handed over to astropy's join.
+    '''
+    keys1 = np.asarray(table1[key])
+    keys2 = np.asarray(table2[key])
+
+    order1 = None if np.all(keys1[1:] > keys1[:-1]) else np.argsort(keys1, kind='stable')
+    order2 = None if np.all(keys2[1:] > keys2[:-1]) else np.argsort(keys2, kind='stable')
+
+    sorted1 = keys1 if order1 is None else keys1[order1]
+    sorted2 = keys2 if order2 is None else keys2[order2]
+
+    if np.any(sorted1[1:] == sorted1[:-1]) or np.any(sorted2[1:] == sorted2[:-1]):
+        return join(table1, table2, keys=key)
+
+    _, rows1, rows2 = np.intersect1d(sorted1, sorted2, assume_unique=True, return_indices=True)
+    if order1 is not None:
+        rows1 = order1[rows1]
+    if order2 is not None:
+        rows2 = order2[rows2]
+
+    common = set(table1.colnames) & set(table2.colnames)
+
+    result = Table()
+    for name in table1.colnames:
+        new_name = name if (name == key or name not in common) else name + '_1'
+        result[new_name] = table1[name][rows1]
+    for name in table2.colnames:
+        if name == key:
+            continue
+        new_name = name if name not in common else name + '_2'
+        result[new_name] = table2[name][rows2]
+
+    return result
+
+
+def downcast(array):
+    '''
+    Converts an array to a smaller dtype, but only if that doesn't change any value.
+    '''
+    if len(array) == 0:
+        return array
+
+    # no int8: FITS has no signed byte columns, and astropy writes int8 columns as logical
+    if array.dtype.kind == 'i':
+        for dtype in (np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if array.min() >= info.min and array.max() <= info.max:
+                return array.astype(dtype)
+
+    elif array.dtype == np.float64:
+        array_32 = array.astype(np.float32)
+        if np.array_equal(array_32.astype(np.float64), array, equal_nan=True):
+            return array_32
+
+    return array
+
+
+# bump when the cache layout or dtypes change, to rebuild existing caches
+source_cache_version = 2
+
+
+def source_cache_dir(plate_id, cachepath=CACHEPATH):
+    return os.path.join(cachepath, 'sources_' + str(plate_id))
+
+
+def write_source_cache(table, plate_id, sources_stat, columns, cachepath=CACHEPATH):
+    '''
+    Writes a joined sources table to the columnar cache: one .npy file per 
+    column (plus one per mask, for masked columns), and a meta.json file with
+    the column names and dtypes, and the size and modification time of the 
+    CSV files the table was built from.
+
+    Files already in the cache are never written over: the new cache is 
+    built in a temporary directory that then replaces the old one. Readers 
+    see either the old or the new cache, and memory maps of the old column 
+    files stay valid.
+    '''
+    cache_dir = source_cache_dir(plate_id, cachepath=cachepath)
+    os.makedirs(cachepath, exist_ok=True)
+
+    # an old cache is invalidated first, so it isn't read while being replaced
+    try:
+        os.remove(os.path.join(cache_dir, 'meta.json'))
+    except FileNotFoundError:
+        pass
+
+    suffix = '.' + str(os.getpid()) + '.' + uuid.uuid4().hex
+    tmp_dir = cache_dir + '.tmp' + suffix
+    os.makedirs(tmp_dir)
+
+    meta = {'version': source_cache_version, 'sources': sources_stat, 'columns_requested': columns, 
+            'columns': [], 'masked': []}
+
+    for name in table.colnames:
+        column = table[name]
+        data = downcast(np.asarray(column.data.data if hasattr(column, 'mask') else column))
+        np.save(os.path.join(tmp_dir, name + '.npy'), data)
+
+        if hasattr(column, 'mask') and np.any(column.mask):
+            np.save(os.path.join(tmp_dir, name + '.mask.npy'), np.asarray(column.mask))
+            meta['masked'].append(name)
+        meta['columns'].append(name)
+
+    # meta.json signals a complete cache
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as json_file:
+        json.dump(meta, json_file, indent=1)
+
+    # a directory can't be renamed over a non-empty one: move the old one aside
+    old_dir = cache_dir + '.old' + suffix
+    try:
+        os.rename(cache_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another process put its own cache in place in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_source_cache(plate_id, sources_stat, columns, cachepath=CACHEPATH):
+    '''
+    Reads a joined sources table from the columnar cache, with columns 
+    memory-mapped. Returns None if there is no cache, or if it is out of date.
+    '''
+    cache_dir = source_cache_dir(plate_id, cachepath=cachepath)
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as json_file:
+            meta = json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if meta.get('version') != source_cache_version or meta['sources'] != sources_stat or \
+       meta['columns_requested'] != columns:
+        return None
+
+    # the cache may be replaced by another process while it's being read
+    columns = []
+    try:
+        for name in meta['columns']:
+            data = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+            if name in meta['masked']:
+                mask = np.load(os.path.join(cache_dir, name + '.mask.npy'))
+                columns.append(MaskedColumn(data, name=name, mask=mask, copy=False))
+            else:
+                columns.append(Column(data, name=name, copy=False))
+
+        # setting columns one by one would copy them out of the memory maps
+        table = Table(columns, copy=False)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return table
+
+
+def read_sources(plate_id, columns=None, cache=True, cachepath=CACHEPATH, datapath=settings.DATAPATH):
+    '''
+    Reads the source and source_calib tables generated by the APPLAUSE
+    database for a plate, and joins them on source_id.
+
+    The joined table, with all columns (or only the requested ones) and
+    with dtypes downcast where that is lossless, is kept in a columnar cache. Later
+    reads of the same plate load it memory-mapped and skip CSV parsing.
+    The cache is rebuilt when any of the CSV files changes.
+
+    Parameters:
+
+    plate_id  - plate ID
+    columns   - list of columns to keep, or None to keep all
+    cache     - use the columnar cache?
+    cachepath - cache directory
+    datapath  - directory with the CSV files
+
+    Returns:
+
+    the joined table
+    '''
+    file_src   = fname(get_table_sources(plate_id), datapath=datapath)
+    file_calib = fname(get_table_sources(plate_id, calib=True), datapath=datapath)
+
+    sources_stat = [[os.path.getsize(f), os.path.getmtime(f)] for f in (file_src, file_calib)]
+
+    if cache:
+        table = read_source_cache(plate_id, sources_stat, columns, cachepath=cachepath)
+        if table is not None:
+            return table
+
+    table_src   = Table.read(file_src, format='ascii.csv')
+    table_calib = Table.read(file_calib, format='ascii.csv')
+
+    table = merge_join(table_calib, table_src, key='source_id')
+
+    if columns is not None:
+        table = table[[name for name in table.colnames if name in columns]]
+
+    if not cache:
+        return table
+
+    write_source_cache(table, plate_id, sources_stat, columns, cachepath=cachepath)
+
+    return read_source_cache(plate_id, sources_stat, columns, cachepath=cachepath)
+
+
+def select_sources(table, par):
+    '''
+    Uses a variety of criteria from SEXTRACTOR to get rid of possible
+    contaminants in a sources table. Only well-defined star images
+    should survive.
+
+    Parameters:
+
+    table - joined sources table for the first plate in a dataset
+    par   - parameter dict
+
+    Returns:
+
+    the selected rows, as a new table
+    '''
+    table_1copy = table.copy()
+
+    # Extraction flags
+    mask = table_1copy['sextractor_flags_1'] <= par['sextractor_flags']
+    table_1copy = table_1copy[mask]
+
+    # Likelihood of being valid star image
+    mask = table_1copy['model_prediction_1'] > par['model_prediction']
+    table_1copy = table_1copy[mask]
+
+    # Round objects
+    mask = table_1copy['elongation'] < par['elongation']
+    table_1copy = table_1copy[mask]
+
+    # Ring
+    mask = table_1copy['annular_bin_1'] <= par['annular_bin']
+    table_1copy = table_1copy[mask]
+
+    # Is source at plate rim ?
+    mask = table_1copy['flag_rim'] == par['flag_rim']
+    table_1copy = table_1copy[mask]
+
+    # flux threshold - set it to fraction of max peak in image
+    flux_threshold = max(table_1copy['flux_max']) * par['max_flux_threshold']
+    mask = table_1copy['flux_max'] > flux_threshold
+    table_1copy = table_1copy[mask]
+
+    return table_1copy
+
+
+# parameters read by function select_sources
+selection_parameters = ['sextractor_flags', 'model_prediction', 'elongation', 'annular_bin',
+                        'flag_rim', 'max_flux_threshold']
+
+
+class PlateProducts:
+    '''
+    Products derived from a single plate, that don't depend on the pair the
+    plate is analysed in: the joined sources table, the selected sources, the
+    WCS, the inverted and background-subtracted image, and the PSF fits of
+    reference stars.
+
+    In a sequence, a plate is the second plate of a pair and the first plate
+    of the next pair. Both pairs get the same instance from function
+    get_plate_products, and share its sources table and WCS. The background
+    and the reference star fits are used only by the pair in which the plate
+    comes first. Products are built when first accessed. The expensive ones
+    are also kept in the on-disk caches (see functions read_sources,
+    get_background and fit_reference_stars), where they are found by the 
+    processes that run other pairs.
+
+    Instances hold full-plate arrays, so they should be dropped (see function
+    release_plate_products) once the last pair that uses the plate is done.
+
+    Tables and arrays returned by instances are shared, and must be treated
+    as read-only.
+    '''
+    def __init__(self, plate_id, cachepath=CACHEPATH):
+        self.plate_id = str(plate_id)
+        self.cachepath = cachepath
+
+        self._sources = None
+        self._selected = {}
+        self._background = None
+
+    def __repr__(self):
+        return "PlateProducts(" + self.plate_id + ")"
+
+    @property
+    def image_file(self):
+        return fname(images[self.plate_id])
+
+    @property
+    def sources(self):
+        '''
+        Joined source and source_calib tables (see function read_sources).
+        '''
+        if self._sources is None:
+            self._sources = read_sources(self.plate_id, cachepath=self.cachepath)
+        return self._sources
+
+    @property
+    def wcs(self):
+        return get_image(self.image_file).wcs
+
+    def selected_sources(self, par):
+        '''
+        Sources that survive function select_sources, with the selection
+        parameters in par. Kept for each set of selection parameters used.
+        '''
+        key = tuple([par[name] for name in selection_parameters])
+        if key not in self._selected:
+            self._selected[key] = select_sources(self.sources, par)
+        return self._selected[key]
+
+    def background(self, nproc=1):
+        '''
+        Inverted, background-subtracted image, and background map (see
+        function get_background).
+        '''
+        if self._background is None:
+            self._background = get_background(self.image_file, box_size=2000, filter_size=101, sigma=3.,
+                                              method='tiled', nproc=nproc, cachepath=self.cachepath)
+        return self._background
+
+    def reference_fits(self, table, par, nproc=1, **kwargs):
+        '''
+        Gaussian fits to a sample of reference stars from the plate (see
+        function fit_reference_stars). Stars already fitted, in this or any
+        other pair, are taken from the plate's reference store.
+
+        Parameters:
+
+        table  - table with matched stars
+        par    - parameter dict from settings.py
+        nproc  - number of processes used for fitting
+        kwargs - sampling parameters passed to fit_reference_stars
+
+        Returns:
+
+        table with the fitted stars, and table with a summary of each stratum
+        '''
+        data, _ = self.background(nproc=nproc)
+        store_file = os.path.join(self.cachepath, settings.get_reference_store(self.plate_id))
+
+        return fit_reference_stars(data, table, par, store_file=store_file, nproc=nproc, **kwargs)
+
+    def release(self):
+        '''
+        Drops the products held in memory. They are read back from the 
+        on-disk caches if accessed again.
+        '''
+        self._sources = None
+        self._selected = {}
+        self._background = None
+
+    def build(self, background=False, nproc=1):
+        '''
+        Builds the sources table and the WCS, and optionally the background,
+        so they are in place (and in the on-disk caches) before any pair
+        asks for them.
+        '''
+        self.sources
+        self.wcs
+        if background:
+            self.background(nproc=nproc)
+        return self
+
+
+# process-wide PlateProducts instances, keyed by plate ID
+plate_products = {}
+
+
+def get_plate_products(plate_id):
+    '''
+    Gets the PlateProducts instance for a plate, creating it if necessary.
+    '''
+    plate_id = str(plate_id)
+    if plate_id not in plate_products:
+        plate_products[plate_id] = PlateProducts(plate_id)
+    return plate_products[plate_id]
+
+
+def release_plate_products(plate_id=None):
+    '''
+    Drops the PlateProducts instance of a plate, and the arrays it holds.
+    With no plate ID, drops them all.
+    '''
+    plate_ids = list(plate_products.keys()) if plate_id is None else [str(plate_id)]
+    for plate_id in plate_ids:
+        plate = plate_products.pop(plate_id, None)
+        if plate is not None:
+            plate.release()
+
+
+def find_duplicates(table, tolerance=5./3600., shape='box', x_label='ra_icrs', y_label='dec_icrs',
+                    scan_label='scan_id_1'):
+    '''
+    Finds groups of duplicated sources in a single table.
+
+    Groups are built friends-of-friends style over a SkyIndex: two rows
+    belong to the same group when they are linked by a chain of pairs,
+    each pair within the tolerance. Runs in O(N log N).
+
+    Parameters:
+
+    table     - sources table
+    tolerance - half-size of search box (or radius of search circle), in degrees. Default is 5 arcsec.
+    shape     - acceptance test, 'box' or 'circle' (see function within_tolerance)
+    x_label, y_label - names of the coordinate columns
+    scan_label - name of the scan ID column. Tables built by read_sources are joins
+                 of two APPLAUSE tables, where it is named 'scan_id_1'. A table with 
+                 a plain 'scan_id' column is also accepted.
+
+    Returns:
+
+    groups  - list of arrays, each with the sorted indices of the rows in a group of duplicates
+    offsets - (number of pairs, 2) array with the offsets (delta RA * cos(Dec), delta Dec) 
+              between the two rows in each pair of duplicates, in arcsec. When the table has
+              a scan ID column, offsets point from the lower to the higher scan ID, so their
+              median is the typical displacement between scans.
+    '''
+    ra  = np.asarray(table[x_label], dtype=float)
+    dec = np.asarray(table[y_label], dtype=float)
+    n = len(ra)
+
+    i, j = SkyIndex(ra, dec).self_pairs(tolerance=tolerance, shape=shape)
+
+    # connected components of the graph of pairs are the groups
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels)
+    groups = [g for g in np.split(order, np.cumsum(counts)[:-1]) if len(g) > 1]
+
+    # orient pairs by scan
+    if scan_label not in table.colnames and 'scan_id' in table.colnames:
+        scan_label = 'scan_id'
+    if scan_label in table.colnames:
+        scan_id = np.asarray(table[scan_label])
+        flip = scan_id[i] > scan_id[j]
+        i, j = np.where(flip, j, i), np.where(flip, i, j)
+
+    dra = (ra[j] - ra[i] + 180.) % 360. - 180.
+    ddec = dec[j] - dec[i]
+    offsets = np.column_stack((dra * np.cos(np.radians(dec[i])), ddec)) * 3600.
+
+    return groups, offsets
+
+
+def remove_scanner_artifacts(table, tolerance=5./3600., groups=None, shape='box'):
+    '''
+    Keeps only the rows that have duplicates in the same table.
+
+    Plates scanned twice (rotated by 90 deg.) have both scans in the same
+    table. Objects on the plate show up in both scans at the same celestial
+    coordinates, scanner-induced artifacts don't. As with the old Worker2
+    code, a row is kept when a later row in the table is within the 
+    tolerance, so a pair of duplicates results in a single row being kept.
+    In larger groups (e.g. a chain a-b-c, where a and c are not within the
+    tolerance of each other), every row with a later duplicate is kept. If 
+    a small number of duplicates, or none, was detected, the table is 
+    returned as is.
+
+    Parameters:
+
+    table     - sources table
+    tolerance - half-size of search box, in degrees. Default is 5 arcsec.
+    groups    - groups of duplicates from function find_duplicates (with the
+                same tolerance and shape), or None to have them computed here
+    shape     - acceptance test, 'box' or 'circle' (see function within_tolerance)
+    '''
+    if groups is None:
+        groups, _ = find_duplicates(table, tolerance=tolerance, shape=shape)
+
+    # duplicates are only looked for among the rows in groups
+    rows = np.concatenate(list(groups) + [np.array([], dtype=np.int64)])
+    keep = np.array([], dtype=np.int64)
+    if len(rows) > 0:
+        ra  = np.asarray(table['ra_icrs'], dtype=float)[rows]
+        dec = np.asarray(table['dec_icrs'], dtype=float)[rows]
+        i, j = SkyIndex(ra, dec).self_pairs(tolerance=tolerance, shape=shape)
+        keep = np.unique(np.minimum(rows[i], rows[j]))
+
+    if len(keep) > len(table) / 10:
+        return table[keep]
+
+    return table
+
+
+def split_matches(table, matched, next_plate_id):
+    '''
+    Splits a sources table into matched and non-matched objects.
+
+    Objects with a valid Gaia ID are removed from the non-matched table,
+    and objects without one are removed from the matched table. A column
+    with the plate ID of the second plate in the dataset is added to both.
+
+    Parameters:
+
+    table         - sources table for the first plate
+    matched       - indices in table of the objects with a match in the second plate
+    next_plate_id - plate ID of the second plate
+
+    Returns:
+
+    table_matched, table_non_matched
+    '''
+    table_non_matched = table.copy()
+
+    # remove duplicated indices first; removal is done in-place
+    m = list(dict.fromkeys(matched))
+    table_non_matched.remove_rows(m)
+
+    table_matched = table[m]
+
+    # anything that has a valid Gaia ID is removed from the non-matched table
+    table_non_matched = table_non_matched[table_non_matched['gaiaedr3_id'].mask]
+
+    # and the opposite in the matched table
+    table_matched = table_matched[~table_matched['gaiaedr3_id'].mask]
+
+    next_plate_id = int(next_plate_id)
+    table_non_matched['next_plate_id'] = np.full_like(table_non_matched['plate_id_1'], next_plate_id)
+    table_matched['next_plate_id'] = np.full_like(table_matched['plate_id_1'], next_plate_id)
+
+    return table_matched, table_non_matched
+
+
+def match_sequence(sequence, tolerance=5./3600., shape='box', parameters=None):
+    '''
+    Matches all plates in a sequence in a single pass.
+
+    Each plate is read, and indexed, only once. The sources of every plate
+    except the last are selected in the same way find_mismatches.ipynb does
+    for the first plate of a pair, and then matched against the (unfiltered)
+    sources of *every* plate in the sequence.
+
+    Parameters:
+
+    sequence   - list of plate IDs, such as an entry in settings.sequences
+    tolerance  - half-size of search box, in degrees. Default is 5 arcsec.
+    shape      - acceptance test, 'box' or 'circle' (see function within_tolerance)
+    parameters - dict keyed by pair key (e.g. '19012,19013') with the parameter dict
+                 of each pair; default is to get them from settings.get_parameters
+
+    Returns:
+
+    dict keyed by plate ID (as a string) of each plate but the last, with:
+
+     'table'   - selected sources table for the plate
+     'present' - boolean (N, number of plates) array: True where the source has
+                 a counterpart in the corresponding plate of the sequence
+     'covered' - boolean (N, number of plates) array: True where the source falls
+                 inside the footprint of the corresponding plate of the sequence
+    '''
+    plates = [str(plate_id) for plate_id in sequence]
+
+    tables  = {}
+    indices = {}
+    wcss    = {}
+    for plate_id in plates:
+        tables[plate_id]  = get_plate_products(plate_id).sources
+        indices[plate_id] = SkyIndex.from_table(tables[plate_id])
+        wcss[plate_id]    = get_plate_products(plate_id).wcs
+
+        print("Plate ", plate_id, " - ", len(tables[plate_id]), " sources", flush=True)
 
-    # extract cutout from input image, around the target celestial coordinates
-    cutout = Cutout2D(image_data, position=target_coords, size=cutout_size, wcs=image_wcs)
+    result = {}
+    for k in range(len(plates) - 1):
+        plate_id = plates[k]
+        next_plate_id = plates[k+1]
 
-    # on the stars table, filter out rows that fall outside the neighborhood cutout footprint
-    table_neighborhood = remove_outsiders(cutout.data, cutout.wcs, table_stars, wcs_table=image_wcs)
+        key = plate_id + ',' + next_plate_id
+        par = parameters[key] if parameters is not None else get_parameters(key)
 
-    # filter out rows that have peak flux off by more than a given limit
-    mask = table_neighborhood['flux_max'] < (target_flux_max * (1. + flux_range))
-    table_neighborhood = table_neighborhood[mask]
-    mask = table_neighborhood['flux_max'] > (target_flux_max * (1. - flux_range))
-    table_neighborhood = table_neighborhood[mask]
+        # same sequence of steps as in find_mismatches.ipynb
+        with profiler.labelled(pair=key):
+            with profiler.step('select_sources', rows_in=len(tables[plate_id])) as record:
+                table = get_plate_products(plate_id).selected_sources(par)
+                record['rows_out'] = len(table)
 
-    return cutout, table_neighborhood
+            with profiler.step('remove_outsiders', rows_in=len(table)) as record:
+                table = remove_outsiders(None, wcss[next_plate_id], table, wcs_table=wcss[plate_id])
+                record['rows_out'] = len(table)
+
+            with profiler.step('remove_duplicates', rows_in=len(table)) as record:
+                table = remove_scanner_artifacts(table, tolerance=tolerance)
+                record['rows_out'] = len(table)
+
+            with profiler.step('cross_match', rows_in=len(table)) as record:
+                coords = make_sky_coords(table, wcss[plate_id])
+                ra  = np.asarray(table['ra_icrs'], dtype=float)
+                dec = np.asarray(table['dec_icrs'], dtype=float)
+
+                present = np.ones((len(table), len(plates)), dtype=bool)
+                covered = np.ones((len(table), len(plates)), dtype=bool)
 
+                for j, other_plate_id in enumerate(plates):
+                    if j == k:
+                        continue
+                    present[:, j] = indices[other_plate_id].has_match(ra, dec, tolerance=tolerance, shape=shape)
+                    covered[:, j] = coords.contained_by(wcss[other_plate_id])
 
-def plot_cutout_series(plates, table, images, target_id, frames_per_row=8, figsize=(10, 4)):
+                record['rows_out'] = int(np.count_nonzero(present[:, k+1]))
+
+        result[plate_id] = {'table': table, 'present': present, 'covered': covered}
+
+        print("Plate ", plate_id, " - ", len(table), " selected, ",
+              np.count_nonzero(~present[:, k+1]), " not matched in ", next_plate_id, flush=True)
+
+    return result
+
+
+def run_sequence_matching(seq_key, tolerance=5./3600., shape='box', parameters=None):
     '''
-    Plots a sequence of thumbnail images with the center of each thumbnail at
-    a particular coordinates from a table. 
-    
-    'plates' is a dict whose keys are plate ID numbers, and the value for each
-    key is a list of source ID numbers. Each one is looked for at the table and
-    plotted as a small thumbnail. An example of the 'plates' dict can be found at
-    notebook 'results_analyis.ipynb
-    
+    Sequence-level replacement for running find_mismatches.ipynb on each
+    pair of consecutive plates.
+
+    Writes, for each pair, the same matched and non-matched FITS tables
+    written by find_mismatches.ipynb. It also writes a per-sequence table
+    with the presence/absence matrix of every selected source across all
+    plates in the sequence. Column 'stays_gone' in that table flags sources
+    that have no counterpart in any of the later plates that cover them.
+
     Parameters:
-    plates    - dict keyed by plate ID, with lists of source IDs to be plotted
-    table     - table with object coordinates
-    images    - dict that translates between plate ID, and image file name
-    target_id - the source_id of the target
+
+    seq_key    - key in the settings.sequences dict
+    tolerance  - half-size of search box, in degrees. Default is 5 arcsec.
+    shape      - acceptance test, 'box' or 'circle' (see function within_tolerance)
+    parameters - dict keyed by pair key with the parameter dict of each pair (see
+                 function match_sequence)
+
+    Returns:
+
+    dict keyed by pair key (e.g. '19012,19013'), with the (matched, non-matched)
+    tables written for each pair
     '''
-    frame_number = 0
-    figure = plt.figure(figsize=figsize)
-    
-    for plate in list(plates.keys()):
-        sids = plates[plate]
+    sequence = settings.sequences[seq_key]
+    plates = [str(plate_id) for plate_id in sequence]
 
-        for sid in sids: 
-            
-            # get transient coordinates and other info
-            m = table['source_id'] == sid
-            t = table[m]
+    results = match_sequence(sequence, tolerance=tolerance, shape=shape, parameters=parameters)
 
-            # handle case were the same source ID shows up more than once in the table. This
-            # is caused by duplication within sequences.
-            if (len(t)) > 1:
-                t = t[[0]]
-            
-            ra  = t['ra_icrs']
-            dec = t['dec_icrs']
-            target_coords = SkyCoord(ra=ra, dec=dec, unit='deg')
-            
-            annular_bin = t['annular_bin_1'][0]
+    pair_tables = {}
+    presence_tables = []
+    for k in range(len(plates) - 1):
+        plate_id = plates[k]
+        next_plate_id = plates[k+1]
+        key = plate_id + ',' + next_plate_id
+        par = parameters[key] if parameters is not None else get_parameters(key)
 
-            # read cutout
-            size = 17
-            image_name = fname(images[str(plate)])
-            cutout, _ = get_cutouts(image_name, None, target_coords, size)
-            cw = cutout.wcs
-            pixdata = cutout.data
-            
-            # display it
-            text1 = str(sid)[-6:]
-            if target_id is not None and sid == target_id:
-                text1 = text1 + " - Target"
-            text2 = str(annular_bin) + "          " + str(plate)
- 
-            color_map = plt.get_cmap('viridis').reversed()
-            plt.subplots_adjust(wspace=0, hspace=0, left=0, right=1, bottom=0, top=1)      
-            ax = figure.add_subplot(1, frames_per_row, frame_number+1, projection=cw)
-            image = ax.imshow(pixdata, origin='lower', cmap=color_map, norm=LogNorm())
-            ax.text(1, int(size-2), text1, fontsize=9, color='white')
-            ax.text(1, 0, text2, fontsize=9, color='white')
-            ax.axis('off')
-            ax.grid(color='white', ls='solid')
+        table   = results[plate_id]['table']
+        present = results[plate_id]['present']
+        covered = results[plate_id]['covered']
 
-            frame_number += 1
+        matched = np.flatnonzero(present[:, k+1])
+        table_matched, table_non_matched = split_matches(table, matched, next_plate_id)
 
-            if frame_number >= frames_per_row:
-                # dump figure and create next figure
-                plt.tight_layout()
-                plt.show()
-                plt.close()
-                figure = plt.figure(figsize=figsize)
+        table_non_matched.write(fname(par['table_non_matched']), format='fits', overwrite=True)
+        table_matched.write(fname(par['table_matched']), format='fits', overwrite=True)
 
-                frame_number = 0
+        print("Dataset ", plate_id + ',' + next_plate_id, " - non-matched objects: ",
+              len(table_non_matched), "  matched objects: ", len(table_matched), flush=True)
+
+        pair_tables[plate_id + ',' + next_plate_id] = (table_matched, table_non_matched)
+
+        later = slice(k+1, len(plates))
+        stays_gone = ~np.any(present[:, later] & covered[:, later], axis=1)
+
+        presence_tables.append(Table({'source_id': table['source_id'],
+                                      'plate_id_1': table['plate_id_1'],
+                                      'present': present,
+                                      'covered': covered,
+                                      'stays_gone': stays_gone}))
+
+    table_presence = vstack(presence_tables)
+    table_presence.meta['PLATES'] = ','.join(plates)
+    table_presence.write(fname(settings.get_table_presence(seq_key)), format='fits', overwrite=True)
+
+    return pair_tables
 
-    plt.tight_layout()
-    plt.show()            
-    plt.close()
 
-    
 class Worker:
     '''
     Class with callable instances that execute the double loop in script
@@ -1124,16 +3639,19 @@ class Worker:
     It provides the callable for the `Pool.apply_async` function, and also
     holds all parameters necessary to perform the search.
     '''
-    def __init__(self, name, table1, table2, index_init, index_end, tolerance=5./3600.):
+    def __init__(self, name, table1, table2, index_init, index_end, tolerance=5./3600.,
+                 method='vectorized'):
         '''
         Parameters:
 
         name       - id string for this worker
-        table1     - sources table for the first plate
-        table2     - sources table for the second plate
+        table1     - sources table for the first plate (or a SharedColumns instance)
+        table2     - sources table for the second plate (or a SharedColumns instance)
         index_init - initial value for the index at the outermost loop (i1)
         index_end  - final value for the index at the outermost loop (i1)
         tolerance  - half-size of search box, in degrees. Default is 5 arcsec.
+        method     - 'vectorized' uses matched_vectorized; 'loop' runs the old 
+                     internal loop over the second table, using matched.
 
         Returns:
 
@@ -1150,6 +3668,7 @@ class Worker:
         self.index_init = index_init
         self.index_end  = index_end
         self.tolerance = tolerance
+        self.method = method
                 
         # results go in this list
         self.matched_rows = []
@@ -1173,17 +3692,23 @@ class Worker:
                 
             # Internal loop scans the newer plate. 
             # We scan the entire table for every entry in the first 
-            # table. Not the most efficient code by far; we keep
-            # it here because the vectorized approach, which avoids
-            # the internal loop in i2, is still being evaluated.
+            # table. Not the most efficient code by far; the function 
+            # cross_match does the same job with a spatial index. We 
+            # keep this code here as a reference to the old results.
             
-#             for i2 in range(len(self.table2)):
-#                 if self.matched(i1, i2):
-#                     self.matched_rows.append(i1)
-#                     break
+            if self.method == 'loop':
+                # when comparing a table with itself, use just rows forward of row i1
+                i2_init = 0
+                if self.skip_self:
+                    i2_init = i1 + 1
+
+                for i2 in range(i2_init, len(self.table2)):
+                    if self.matched(i1, i2):
+                        self.matched_rows.append(i1)
+                        break
 
             # use vectorized matching code in place of internal loop
-            if self.matched_vectorized(i1):
+            elif self.matched_vectorized(i1):
                 self.matched_rows.append(i1)
 
         return self.matched_rows
@@ -1266,7 +3791,7 @@ class Worker2(Worker):
     '''
     Subclass that looks for duplications in a single table.
     '''
-    def __init__(self, name, table1, index_init, index_end, tolerance=5./3600.):
+    def __init__(self, name, table1, index_init, index_end, tolerance=5./3600., method='vectorized'):
         '''
         Parameters:
 
@@ -1275,45 +3800,29 @@ class Worker2(Worker):
         index_init - initial value for the index at the outermost loop (i1)
         index_end  - final value for the index at the outermost loop (i1)
         tolerance  - half-size of search box, in degrees. Default is 5 arcsec.
+        method     - 'vectorized' or 'loop' (see Worker)
 
         Returns:
 
         list with indices in the table that have duplications.
         '''        
-        super().__init__(name, table1, table1, index_init, index_end)
+        super().__init__(name, table1, table1, index_init, index_end, tolerance=tolerance, method=method)
         
+        # the internal loop scans only what wasn't scanned yet.
         self.skip_self = True
-                        
-    def __call__(self):
-        
-        # External loop scans the entire range of rows.
-
-        for i1 in range(self.index_init, self.index_end):
-            
-            self.ncount += 1
-                
-            # Internal loop scans only what wasn't scanned yet.
-            # No longer used; kept in here for reference only.
-
-#             for i2 in range(i1+1, len(self.table2)):
-#                 if self.matched(i1, i2):
-#                     self.matched_rows.append(i1)
-#                     break
-
-            # vectorized
-            if self.matched_vectorized(i1):
-                self.matched_rows.append(i1)
-
-        return self.matched_rows
 
 
 class FitWorker:
     '''
-    Class with callable instances that uses fit_fwhm to fit Gaussians over a 
-    list of x,y positions on an image.  
+    Class with callable instances that fits Gaussians over a list of x,y 
+    positions on an image. By default, it uses the batched fitter in function
+    fit_gaussians. Setting par['fit_method'] to 'photutils' selects the 
+    reference mode, that uses fit_fwhm (photutils' fit_2dgaussian).
 
     It provides the callable for the `Pool.apply_async` function, and also
-    holds all parameters necessary to perform the fits.
+    holds all parameters necessary to perform the fits. In batched mode, the
+    fit stamps are extracted from the image when the worker is built, and 
+    only the stamps (not the full image) are shipped to the worker process.
     '''
     def __init__(self, name, data, table, index_init, index_end, par):
         '''
@@ -1332,7 +3841,6 @@ class FitWorker:
         and the table in the PSFPhotometry ".results" field
         '''
         self.name = name
-        self.data = data
         
         self.index_init = index_init
         self.index_end  = index_end
@@ -1341,12 +3849,21 @@ class FitWorker:
 
         self.fwhm = par['fwhm_init']
         self.fit_shape = par['fit_shape']
+        self.fit_method = par.get('fit_method', 'batched')
         
         # build list with x,y positions to fit
         x_pos = list(self.table['x_source'])
         y_pos = list(self.table['y_source'])
         
         self.xypos = list(zip(x_pos, y_pos))
+
+        if self.fit_method == 'photutils':
+            self.data = data
+        else:
+            # compact (N, fit_shape, fit_shape) array, plus the stamp offsets in the image
+            self.data = None
+            self.image_shape = data.shape
+            self.stamps, self.x_start, self.y_start = extract_stamps(data, self.xypos, self.fit_shape)
         
         print("FitWorker ", name, " - ", index_init, index_end, flush=True)
         
@@ -1357,17 +3874,554 @@ class FitWorker:
 
         print("FitWorker ", self.name, " - started.", flush=True)
 
-        # this function seems to not work efficiently under a parallelized environment. Perhaps it
-        # puts locks on the data, somehow. 
-        fwhm_values, phot = fit_fwhm(self.data, xypos=self.xypos, fwhm=self.fwhm, fit_shape=self.fit_shape)
+        if self.fit_method == 'photutils':
+            # this function seems to not work efficiently under a parallelized environment. Perhaps it
+            # puts locks on the data, somehow. 
+            fwhm_values, phot = fit_fwhm(self.data, xypos=self.xypos, fwhm=self.fwhm, fit_shape=self.fit_shape)
+            fit_results = phot.results
+        else:
+            fit_results = fit_gaussian_stamps(self.stamps, self.x_start, self.y_start, self.xypos, 
+                                              self.fwhm, self.image_shape)
         
-        result = hstack([self.table, phot.results])
+        result = hstack([self.table, fit_results])
 
         print("FitWorker ", self.name, " - ended.", flush=True)
 
         return result
     
     
+def select_reference_stars(table, flux_bins=5, seed=0):
+    '''
+    Orders the candidate reference stars (matched stars) for stratified 
+    sampling. Stars are grouped in strata by annular_bin_1, and by bins
+    in peak flux (quantiles of log flux_max). Inside each stratum, stars
+    are put in random order, so the first n stars of a stratum are an 
+    unbiased sample of that stratum.
+
+    Parameters:
+
+    table     - table with matched stars
+    flux_bins - number of peak flux bins
+    seed      - seed for the random ordering
+
+    Returns:
+
+    copy of the input table, with columns 'stratum' and 'stratum_rank', 
+    sorted by stratum and rank
+    '''
+    result = table.copy()
+
+    log_flux = np.log10(np.maximum(np.asarray(result['flux_max'], dtype=float), 1.e-30))
+    edges = np.quantile(log_flux, np.linspace(0., 1., flux_bins + 1)[1:-1])
+    flux_bin = np.searchsorted(edges, log_flux, side='right')
+
+    result['stratum'] = np.asarray(result['annular_bin_1'], dtype=int) * flux_bins + flux_bin
+
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(result)), result['stratum']))
+    result = result[order]
+
+    _, first, counts = np.unique(result['stratum'], return_index=True, return_counts=True)
+    result['stratum_rank'] = np.arange(len(result)) - np.repeat(first, counts)
+
+    return result
+
+
+def median_ci(values, confidence=0.95):
+    '''
+    Distribution-free confidence interval of the median, from order statistics.
+    Returns the interval half-width relative to the median, or infinity if 
+    there are too few values.
+    '''
+    from statistics import NormalDist
+
+    values = np.sort(np.asarray(values, dtype=float))
+    values = values[np.isfinite(values)]
+    n = len(values)
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2.)
+    lower = int(np.floor(n / 2. - z * np.sqrt(n) / 2.))
+    upper = int(np.ceil(n / 2. + z * np.sqrt(n) / 2.))
+    if n < 3 or lower < 0 or upper > n - 1:
+        return np.inf
+
+    median = np.median(values)
+    if median <= 0:
+        return np.inf
+
+    return (values[upper] - values[lower]) / 2. / median
+
+
+def data_fingerprint(data, step=64):
+    '''
+    Cheap fingerprint of a (large) image array, computed from a sparse 
+    grid of pixels. Used to check that products derived from an image
+    are still valid.
+    '''
+    sample = np.ascontiguousarray(data[::step, ::step], dtype=float)
+    key = hashlib.sha256(str(data.shape).encode())
+    key.update(sample.tobytes())
+    return key.hexdigest()[:16]
+
+
+def read_reference_store(file_name, data_key, par):
+    '''
+    Reads the store with fitted reference stars of a plate. Returns None 
+    if the file doesn't exist, or if it was written from a different
+    image, or with different fit parameters.
+    '''
+    try:
+        store = Table.read(file_name, format='fits')
+    except (FileNotFoundError, OSError):
+        return None
+
+    if store.meta.get('DATAKEY') != data_key or \
+       store.meta.get('FWHMINIT') != float(par['fwhm_init']) or \
+       store.meta.get('FITSHAPE') != int(par['fit_shape']) or \
+       store.meta.get('FITMETH') != par.get('fit_method', 'batched'):
+        print("Reference store", file_name, "is out of date and will be rebuilt.")
+        return None
+
+    return store
+
+
+def write_reference_store(file_name, store, data_key, par):
+    '''
+    Writes the store with fitted reference stars of a plate. The store
+    has the source_id plus the fit columns, for every star ever fitted
+    (including bad fits, so they are not fitted again).
+    '''
+    store.meta['DATAKEY'] = data_key
+    store.meta['FWHMINIT'] = float(par['fwhm_init'])
+    store.meta['FITSHAPE'] = int(par['fit_shape'])
+    store.meta['FITMETH'] = par.get('fit_method', 'batched')
+
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    tmp_file = temporary_name(file_name)
+    store.write(tmp_file, format='fits', overwrite=True)
+    os.replace(tmp_file, file_name)
+
+
+def fit_reference_stars(data, table, par, store_file=None, nproc=1, flux_bins=5, batch_size=50, 
+                        ci_tolerance=0.02, min_stars=30, max_stars=2500, confidence=0.95):
+    '''
+    Fits Gaussians to a stratified sample of reference (matched) stars. 
+    Strata are defined by annular_bin_1 and peak flux (see function 
+    select_reference_stars). Stars are fitted in rounds of batch_size stars 
+    per stratum, and fitting stops in a stratum once the confidence interval
+    of its median FWHM (after clean_bad_fits) is narrower than ci_tolerance 
+    (relative), or when the stratum runs out of stars.
+
+    Fitted stars are kept in a per-plate store, and are reused when the same 
+    plate is analysed again, in this or any other pair.
+
+    Parameters:
+
+    data         - numpy array with bkg-subtracted image
+    table        - table with matched stars
+    par          - parameter dict from settings.py
+    store_file   - reference store file, or None to not use a store
+    nproc        - number of processes used for fitting
+    flux_bins    - number of peak flux bins
+    batch_size   - number of stars fitted per stratum, per round
+    ci_tolerance - relative half-width of the median FWHM confidence interval
+    min_stars    - minimum number of good fits in a stratum, before it can stop
+    max_stars    - maximum total number of fitted stars
+    confidence   - confidence level for the median FWHM interval
+
+    Returns:
+
+    table with the fitted stars, as the tables returned by FitWorker
+    table with a summary of each stratum
+    '''
+    candidates = select_reference_stars(table, flux_bins=flux_bins)
+    strata, first, counts = np.unique(candidates['stratum'], return_index=True, return_counts=True)
+
+    data_key = data_fingerprint(data)
+    store = None
+    if store_file is not None:
+        store = read_reference_store(store_file, data_key, par)
+    stored_rows = {}
+    if store is not None:
+        stored_rows = {sid: row for row, sid in enumerate(store['source_id'])}
+    new_fits = []
+
+    pool = Pool(nproc) if nproc > 1 else None
+
+    fitted = []
+    n_fitted = 0
+    position = np.zeros(len(strata), dtype=int)
+    done = np.zeros(len(strata), dtype=bool)
+    converged = np.zeros(len(strata), dtype=bool)
+    ci = np.full(len(strata), np.inf)
+    n_good = np.zeros(len(strata), dtype=int)
+
+    # the pool is shut down (and its workers joined) even if a fit fails
+    try:
+        while not np.all(done) and n_fitted < max_stars:
+
+            # next batch of stars from each stratum still open
+            rows = []
+            for k in np.where(~done)[0]:
+                start = position[k]
+                end = min(start + batch_size, counts[k])
+                rows.append(first[k] + np.arange(start, end))
+                position[k] = end
+            rows = np.concatenate(rows)[:max_stars - n_fitted]
+            if len(rows) == 0:
+                break
+            batch = candidates[rows]
+
+            # reuse stars already in the store, fit the others
+            in_store = np.array([sid in stored_rows for sid in batch['source_id']], dtype=bool)
+            if np.any(in_store):
+                reused = store[[stored_rows[sid] for sid in batch['source_id'][in_store]]]
+                reused.remove_column('source_id')
+                reused.meta = {}
+                fitted.append(hstack([batch[in_store], reused]))
+
+            to_fit = batch[~in_store]
+            if len(to_fit) > 0:
+                def factory(name, row_start, row_end):
+                    return FitWorker("ref" + name, data, to_fit, row_start, row_end, par)
+
+                with profiler.step('reference_batch', rows_in=len(to_fit)) as record:
+                    tables_fit = parallel_map(factory, to_fit, nproc=nproc, pool=pool)
+
+                    fit_table = vstack(tables_fit)
+                    record['rows_out'] = len(fit_table)
+                fitted.append(fit_table)
+                new_fits.append(fit_table[['source_id'] + fit_columns])
+
+            n_fitted += len(batch)
+
+            # check convergence of the median FWHM in each stratum
+            table_fitted = vstack(fitted)
+            table_good = clean_bad_fits(table_fitted, par)
+            for k in np.where(~done)[0]:
+                fwhm = table_good['fwhm_fit'][table_good['stratum'] == strata[k]]
+                n_good[k] = len(fwhm)
+                ci[k] = median_ci(fwhm, confidence=confidence)
+                converged[k] = n_good[k] >= min_stars and ci[k] <= ci_tolerance
+                done[k] = converged[k] or position[k] >= counts[k]
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if store_file is not None and len(new_fits) > 0:
+        new_store = vstack(new_fits)
+        if store is not None:
+            store.meta = {}
+            new_store = vstack([store, new_store])
+        write_reference_store(store_file, new_store, data_key, par)
+
+    summary = Table()
+    summary['stratum'] = strata
+    summary['annular_bin_1'] = strata // flux_bins
+    summary['flux_bin'] = strata % flux_bins
+    summary['n_candidates'] = counts
+    summary['n_fitted'] = position
+    summary['n_good'] = n_good
+    summary['ci'] = ci
+    summary['converged'] = converged
+
+    return vstack(fitted), summary
+
+
+def tiny_cutouts(data, xypos, size):
+    '''
+    Extracts small square cutouts around a list of positions. The pixels are
+    the same as in Cutout2D(data, position, size) (in the default 'trim' mode,
+    so cutouts at the image edges are smaller).
+
+    Parameters:
+
+    data  - 2D pixel array
+    xypos - (N, 2) array with x,y positions (px)
+    size  - cutout size (px)
+
+    Returns:
+
+    list of 2D arrays (views into data)
+    '''
+    xypos = np.asarray(xypos, dtype=float).reshape(-1, 2)
+    ny, nx = data.shape
+
+    # same rounding as astropy's overlap_slices
+    x_start = np.ceil(xypos[:, 0] - size / 2.).astype(int)
+    y_start = np.ceil(xypos[:, 1] - size / 2.).astype(int)
+
+    cutouts = []
+    for x0, y0 in zip(x_start, y_start):
+        cutouts.append(data[max(y0, 0):min(y0 + size, ny), max(x0, 0):min(x0 + size, nx)])
+
+    return cutouts
+
+
+def shape_metrics(cutouts, thresholds=[21, 45], min_area=7.):
+    '''
+    Computes contour shape metrics for a batch of small cutouts around targets.
+    Each cutout is normalized to the [0, 255] range and thresholded at each of
+    the thresholds; OpenCV contours are then measured. As in the original 
+    per-target code in ProfileWorker, the metrics are taken from the last 
+    contour (over all thresholds) with area larger than min_area, and are 
+    zero if there is no such contour.
+
+    Parameters:
+
+    cutouts    - list (or 3D stack) of 2D float arrays
+    thresholds - threshold values for the contours (on a 0-255 scale)
+    min_area   - minimum contour area (px)
+
+    Returns:
+
+    circularity      - 4 pi area / perimeter**2
+    area             - contour area (px)
+    shape_defect     - sum of convexity defect depths, normalized by the bounding box size
+    circle_deviation - stddev of contour point distances to the minimum enclosing 
+                       circle center, normalized by the circle radius
+    '''
+    import cv2
+
+    n = len(cutouts)
+    circularity = np.zeros(n)
+    area = np.zeros(n)
+    shape_defect = np.zeros(n)
+    circle_deviation = np.zeros(n)
+
+    # uint8 buffers, reused for all cutouts of a given shape
+    buffers = {}
+
+    for k, image_float in enumerate(cutouts):
+        image_float = np.asarray(image_float)
+        if image_float.shape not in buffers:
+            buffers[image_float.shape] = (np.empty(image_float.shape, dtype=np.uint8), 
+                                          np.empty(image_float.shape, dtype=np.uint8))
+        image_uint8, thresh = buffers[image_float.shape]
+
+        # use try-except to report errors in a parallelized notebook environment.
+        # An error ends the computation for the cutout, keeping the results so far.
+        try:
+            cv2.normalize(image_float, image_uint8, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+            for t in thresholds:
+                cv2.threshold(image_uint8, t, 255, cv2.THRESH_BINARY, dst=thresh)
+                contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+                for contour in contours:
+                    ar = cv2.contourArea(contour)
+                    perimeter = cv2.arcLength(contour, True)
+                    approx_contour = cv2.approxPolyDP(contour, 0.01 * perimeter, True)
+                    hull = cv2.convexHull(approx_contour, returnPoints=False)
+                    if not (ar > min_area and perimeter > 0.):
+                        continue
+
+                    circularity[k] = (4 * math.pi * ar) / (perimeter ** 2)
+                    area[k] = ar
+
+                    # cummulative shape defect (depths are fixed-point, 8 fractional bits).
+                    # OpenCV 4 returns defects with shape (n, 1, 4), OpenCV 5 with (n, 4).
+                    defects = cv2.convexityDefects(approx_contour, hull)
+                    if defects is not None:
+                        _, _, w, h = cv2.boundingRect(approx_contour)
+                        shape_defect[k] = np.sum(defects.reshape(-1, 4)[:, 3] / 256.0) / max(w, h)
+
+                    # spread of distances to the enclosing circle center 
+                    # (smaller means a shape closer to a circle)
+                    (x_c, y_c), radius = cv2.minEnclosingCircle(contour)
+                    points = contour[:, 0, :]
+                    distances = np.sqrt((points[:, 0] - x_c)**2 + (points[:, 1] - y_c)**2) / radius
+                    circle_deviation[k] = np.std(distances)
+
+        except Exception as e:
+            msg = str(e)
+            if "(-5:Bad argument) The convex hull indices" not in msg:
+                print(e)
+
+    return circularity, area, shape_defect, circle_deviation
+
+
+def normalize_profiles(profiles):
+    '''
+    Normalizes each row of a (N, n_bins) array of profiles between 0. and 1.,
+    as function normalize_profile does for a single profile.
+    '''
+    pr_max = np.max(profiles, axis=1, keepdims=True)
+    pr_min = np.min(profiles, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (profiles - pr_min) / (pr_max - pr_min)
+
+
+class ProfileBankWorker:
+    '''
+    Class with callable instances that compute normalized radial profiles 
+    for a range of rows in a table of stars. 
+
+    It provides the callable for the `Pool.apply_async` function. The image 
+    is handed to the worker in shared memory (a SharedColumns instance with
+    the image in column 'data'), so it is not copied into each process.
+    '''
+    def __init__(self, name, shared_image, xypos, index_init, index_end, edge_radii):
+        '''
+        Parameters:
+
+        name         - id string for this worker
+        shared_image - SharedColumns instance with the bkg-subtracted image in column 'data'
+        xypos        - (N, 2) array with x,y positions of all stars (px)
+        index_init   - initial row handled by this worker
+        index_end    - final row handled by this worker
+        edge_radii   - radii where to compute profiles
+        '''
+        self.name = name
+        self.shared_image = shared_image
+        self.xypos = xypos[index_init:index_end]
+        self.index_init = index_init
+        self.edge_radii = edge_radii
+
+    def __call__(self):
+        data = self.shared_image['data']
+        profiles = normalize_profiles(radial_profiles(data, self.xypos, self.edge_radii))
+
+        return self.index_init, profiles
+
+
+class ProfileBank:
+    '''
+    Normalized radial profiles of the matched stars of a pair, computed once 
+    over the full bkg-subtracted image and kept as a dense (N, n_bins) array, 
+    row-aligned with the table of matched stars. 
+
+    The profile of a neighborhood star is the same wherever the star shows 
+    up, so ProfileWorker can gather the profiles of a neighborhood from the 
+    bank instead of building them again for every target. The exception are
+    stars close to the edges of a target's cutout, which ProfileWorker still
+    profiles over the cutout (see function profile_box_inside).
+
+    Banks are saved with the pair products, in a FITS file with the profiles
+    (PROFILES), the source_id of each row (INDEX), and the radii (RADII).
+    '''
+    def __init__(self, source_id, profiles, edge_radii, data_key=None):
+        self.source_id = np.asarray(source_id)
+        self.profiles = profiles
+        self.edge_radii = np.asarray(edge_radii, dtype=float)
+        self.data_key = data_key
+
+        # source_id lookups are binary searches over the sorted ids
+        self._order = np.argsort(self.source_id, kind='stable')
+        self._sorted_id = self.source_id[self._order]
+
+    def __len__(self):
+        return len(self.source_id)
+
+    def get(self, source_ids):
+        '''
+        Returns the (n, n_bins) array of normalized profiles for a list of 
+        source IDs. Rows for IDs not in the bank are NaN.
+        '''
+        source_ids = np.asarray(source_ids)
+        position = np.searchsorted(self._sorted_id, source_ids)
+        position = np.clip(position, 0, max(len(self._sorted_id) - 1, 0))
+        found = (len(self._sorted_id) > 0) & (self._sorted_id[position] == source_ids)
+
+        result = np.full((len(source_ids), self.profiles.shape[1]), np.nan)
+        result[found] = self.profiles[self._order[position[found]]]
+        return result
+
+    def matches(self, table, edge_radii, data_key):
+        '''
+        Checks if the bank was built for a table of stars, radii, and image.
+        '''
+        return len(self.source_id) == len(table) and \
+               np.array_equal(self.source_id, np.asarray(table['source_id'])) and \
+               np.array_equal(self.edge_radii, np.asarray(edge_radii, dtype=float)) and \
+               self.data_key == data_key
+
+    def write(self, file_name):
+        primary = fits.PrimaryHDU()
+        primary.header['DATAKEY'] = self.data_key
+        index = Table()
+        index['source_id'] = self.source_id
+
+        hdul = fits.HDUList([primary, 
+                             fits.ImageHDU(self.profiles, name='PROFILES'),
+                             fits.BinTableHDU(index, name='INDEX'),
+                             fits.ImageHDU(self.edge_radii, name='RADII')])
+
+        tmp_file = temporary_name(file_name)
+        hdul.writeto(tmp_file, overwrite=True)
+        os.replace(tmp_file, file_name)
+
+
+def read_profile_bank(file_name):
+    '''
+    Reads a profile bank file. Returns None if there is no such file.
+    '''
+    try:
+        with fits.open(file_name) as hdul:
+            return ProfileBank(np.array(hdul['INDEX'].data['source_id']), np.array(hdul['PROFILES'].data, dtype=float),
+                               np.array(hdul['RADII'].data), data_key=hdul[0].header.get('DATAKEY'))
+    except (FileNotFoundError, OSError, KeyError):
+        return None
+
+
+def build_profile_bank(data, table, edge_radii, nproc=1):
+    '''
+    Computes the normalized radial profiles of all stars in a table, over 
+    the full image, with the rows split among nproc processes.
+
+    Parameters:
+
+    data       - numpy 2D array with bkg-subtracted pixel data for entire image
+    table      - table with stars (x_source, y_source, source_id)
+    edge_radii - radii where to compute profiles
+    nproc      - number of processes
+
+    Returns:
+
+    ProfileBank instance
+    '''
+    xypos = np.column_stack([np.asarray(table['x_source'], dtype=float), 
+                             np.asarray(table['y_source'], dtype=float)])
+    profiles = np.full((len(table), len(edge_radii) - 1), np.nan)
+
+    if nproc <= 1 or len(table) < nproc:
+        if len(table) > 0:
+            profiles[:] = normalize_profiles(radial_profiles(data, xypos, edge_radii))
+    else:
+        with SharedColumns({'data': data}, ['data']) as shared_image:
+            def factory(name, row_start, row_end):
+                return ProfileBankWorker(name, shared_image, xypos, row_start, row_end, edge_radii)
+
+            for index_init, result_profiles in parallel_map(factory, table, nproc=nproc):
+                profiles[index_init:index_init + len(result_profiles)] = result_profiles
+
+    return ProfileBank(np.asarray(table['source_id']), profiles, edge_radii, data_key=data_fingerprint(data))
+
+
+def get_profile_bank(data, table, edge_radii, par, nproc=1):
+    '''
+    Returns the profile bank for the current pair of plates. The bank is read
+    from the pair products if it is up to date with the table of matched 
+    stars, the radii, and the image; otherwise it is built and saved.
+    '''
+    file_name = fname(par['profile_bank'])
+    data_key = data_fingerprint(data)
+
+    bank = read_profile_bank(file_name)
+    if bank is not None and bank.matches(table, edge_radii, data_key):
+        return bank
+
+    bank = build_profile_bank(data, table, edge_radii, nproc=nproc)
+    bank.write(file_name)
+
+    return bank
+
+
 class ProfileWorker:
     '''
     Class with callable instances that computes profile-associated and Gaussian diagnostics:
@@ -1385,14 +4439,16 @@ class ProfileWorker:
     '''
     def __init__(self, name, table_nomatch, table_match, data, wcs, cutout_size, edge_radii, 
                  index_init, index_end, fwhm_init, fit_shape, 
-                 circularity_cutout=21, threshold=[21, 45]):
+                 circularity_cutout=21, threshold=[21, 45], profile_bank=None):
         '''
         Parameters:
 
         name          - id string for this worker
         table_nomatch - table_psf_nonmatched
-        table_match   - table_psf_matched (full table, not the sampled version!)
-        data          - numpy 2D array with bkg-subtracted pixel data for entire image
+        table_match   - table_psf_matched (full table, not the sampled version!), or
+                        a NeighborhoodIndex over it
+        data          - numpy 2D array with bkg-subtracted pixel data for entire image, or
+                        a SharedColumns instance with the image in column 'data'
         wcs           - WCS of entire image
         cutout_size   - size of (emtire side of) square cutout, in degrees
         edge_radii    - radii where to compute profile
@@ -1402,6 +4458,8 @@ class ProfileWorker:
         fit_shape     - size of square region around neighborhood stars
         circularity_cutout - box size for circularity computation
         threshold     - list of threshold values for contour circularity computation (on a 0-255 scale)
+        profile_bank  - ProfileBank with the normalized profiles of the stars in table_match, or 
+                        None to build the neighborhood profiles for every target
 
         Returns:
 
@@ -1413,6 +4471,8 @@ class ProfileWorker:
         
         self.t1 = table_nomatch[index_init:index_end].copy()
         self.table_match = table_match
+        if not isinstance(table_match, NeighborhoodIndex):
+            self.table_match = NeighborhoodIndex(table_match)
 
         self.data = data
         self.wcs = wcs
@@ -1420,6 +4480,7 @@ class ProfileWorker:
         self.edge_radii = edge_radii
         self.fwhm_init = fwhm_init
         self.fit_shape = fit_shape
+        self.profile_bank = profile_bank
 
         self.index_init = index_init
         self.index_end  = index_end
@@ -1430,12 +4491,8 @@ class ProfileWorker:
         self.fwhm_mean_list = []
         self.fwhm_stddev_list = []
         self.neighbor_stars_list = []
-        self.circularity_list = []
         self.solidity_list = []
         self.concavity_list = []
-        self.max_defect_list = []
-        self.area_list = []
-        self.circle_deviation_list = []
         self.threshold = threshold
         self.circularity_cutout = circularity_cutout
 
@@ -1446,7 +4503,7 @@ class ProfileWorker:
         print("ProfileWorker ", name, " - ", index_init, index_end, flush=True)
 
     def __call__(self):
-        
+
         warnings.filterwarnings('ignore', category=RuntimeWarning)
         
         # better keep everything inside a try-except block to 
@@ -1454,16 +4511,17 @@ class ProfileWorker:
         # inside the notebook server when running in multi-process
         # mode
         try:
+            data = self.data
+            if isinstance(data, SharedColumns):
+                data = data['data']
+
             for row_index in range(self.nrange):
 
                 self.ncount += 1
 
-                # get info from row
-                source_id_target = self.t1['source_id'][row_index]
-
                 # get the cutout and the stars in the neighborhood    
                 cutout, table_neighborhood = extract_cutout_neighborhood(self.t1, self.table_match, 
-                                                                         self.data, self.wcs, 
+                                                                         data, self.wcs, 
                                                                          self.cutout_size, self.flux_range, 
                                                                          row_index)   
 
@@ -1483,18 +4541,30 @@ class ProfileWorker:
 #                 self.fwhm_mean_list.append(fwhm_mean)
 #                 self.fwhm_stddev_list.append(fwhm_stddev)
                 
-                # get the radial profile for target object in this row
-                rp_target = make_radial_profile(self.t1, source_id_target, cutout, self.wcs, self.edge_radii)
-                rp_target = normalize_profile(rp_target.profile)
-                
-                # build and store a radial profile for each star in this neighborhood
-                rps = []
-                for row_index_star in range(len(table_neighborhood)):
-                    source_id_star = table_neighborhood['source_id'][row_index_star]
-
-                    rp = make_radial_profile(table_neighborhood, source_id_star, cutout, self.wcs, self.edge_radii)
-
-                    rps.append(normalize_profile(rp.profile))
+                if self.profile_bank is not None:
+                    # radial profile for the target object in this row; the normalized 
+                    # profiles of the stars in this neighborhood come from the bank
+                    xypos = cutout_positions(self.t1[row_index:row_index+1], cutout)
+                    rp_target = normalize_profile(radial_profiles(cutout.data, xypos, self.edge_radii)[0])
+                    rps = self.profile_bank.get(table_neighborhood['source_id'])
+
+                    # stars close to the cutout edges have profiles truncated by the cutout;
+                    # these are computed from it, as they were before the bank existed
+                    xypos = cutout_positions(table_neighborhood, cutout)
+                    truncated = ~profile_box_inside(xypos, cutout.data.shape, self.edge_radii)
+                    if np.any(truncated):
+                        rps[truncated] = normalize_profiles(radial_profiles(cutout.data, xypos[truncated], 
+                                                                            self.edge_radii))
+                    rps = list(rps)
+                else:
+                    # radial profiles for the target object in this row (first), and for 
+                    # each star in this neighborhood, all computed in one call
+                    xypos = np.concatenate([cutout_positions(self.t1[row_index:row_index+1], cutout),
+                                            cutout_positions(table_neighborhood, cutout)])
+                    profiles = radial_profiles(cutout.data, xypos, self.edge_radii)
+
+                    rp_target = normalize_profile(profiles[0])
+                    rps = [normalize_profile(profile) for profile in profiles[1:]]
 
                 # profile difference
                 averaged_profile = np.mean(np.array(rps), axis=0)
@@ -1510,92 +4580,6 @@ class ProfileWorker:
                 
                 self.profile_diff_list.append(rp_rms)
                 
-                # circularity computation
-                circularity = 0.
-                area = 0.
-                solidity = 0.
-                concavity = 0.
-                max_defect = 0.
-                normalized_max_defect = 0.
-                circle_deviation = 0.
-
-                # use try-except to report errors in a parallelized notebook environment
-                try:
-                    # tiny cutout around object's image
-                    xpos = self.t1['x_fit'][row_index]
-                    ypos = self.t1['y_fit'][row_index]
-                    target_coords = (xpos, ypos)
-
-                    cutout_tiny = Cutout2D(self.data, position=target_coords, size=self.circularity_cutout)
-
-                    # normalize to range [0, 255] and convert to uint8
-                    image_float = cutout_tiny.data
-                    image_uint8 = np.empty(image_float.shape, dtype=np.uint8)
-
-                    cv2.normalize(image_float, image_uint8, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
-
-                    # multiple thresholds and contours
-                    for t in self.threshold:
-                        _, thresh = cv2.threshold(image_uint8, t, 255, cv2.THRESH_BINARY)
-                        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                        # compute sum of defects over contours
-                        for i, contour in enumerate(contours):
-                            ar = cv2.contourArea(contour)
-                            perimeter = cv2.arcLength(contour, True)
-                            epsilon = 0.01 * perimeter
-                            approx_contour = cv2.approxPolyDP(contour, epsilon, True)
-                            hull = cv2.convexHull(approx_contour, returnPoints=False)
-#                             hull_area = cv2.contourArea(hull)
-
-                            if ar > 7. and perimeter > 0.:
-                                c = (4 * math.pi * ar) / (perimeter ** 2)
-
-                                circularity = c
-                                area = ar
-#                                 concavity = (hull_area - ar) / hull_area
-#                                 solidity = float(ar) / hull_area                                    
-
-                                # cummulative shape defect
-                                defects = cv2.convexityDefects(approx_contour, hull)
-                                if defects is not None:
-                                    sum_depth = 0.
-                                    for i in range(defects.shape[0]):
-                                        s, e, f, d = defects[i, 0]
-                                        depth = d / 256.0  # Real distance
-                                        sum_depth += depth
-
-#                                         if depth > max_defect:
-#                                             max_defect = depth
-#                                             normalized_max_defect = max_defect / max(w, h)
-                                    
-                                    x, y, w, h = cv2.boundingRect(approx_contour)
-                                    normalized_max_defect = sum_depth / max(w, h)
-            
-                                # rms distance to circle
-                                (x_c, y_c), radius = cv2.minEnclosingCircle(contour)
-                                distances = []
-                                for point in contour:
-                                    # Euclidean distance from each point to circle center, normalized
-                                    dist = np.sqrt((point[0][0] - x_c)**2 + (point[0][1] - y_c)**2)
-                                    dist = dist / radius
-                                    distances.append(dist)
-
-                                # A smaller standard deviation indicates a shape closer to a circle
-                                circle_deviation = np.std(distances)            
-                                    
-                except Exception as e:
-                    msg = str(e)
-                    if "(-5:Bad argument) The convex hull indices" not in msg:
-                        print(e)
-                
-                self.circularity_list.append(circularity)                
-                self.area_list.append(area)                
-#                 self.solidity_list.append(solidity)                
-#                 self.concavity_list.append(concavity)  
-                self.max_defect_list.append(normalized_max_defect)
-                self.circle_deviation_list.append(circle_deviation)
-                
                 percent = int((float(self.ncount) / float(self.nrange)) * 100.) 
                 if not row_index % 100:
                     print(self.name, " - ", str(percent)+'%', ".  ", row_index, flush=True)                
@@ -1604,13 +4588,20 @@ class ProfileWorker:
 #             self.t1['fwhm_neighbors_mean'] = self.fwhm_mean_list
 #             self.t1['fwhm_neighbors_stddev'] = self.fwhm_stddev_list
 #             self.t1['n_neighbors'] = self.neighbor_stars_list
+
+            # circularity and other contour shape metrics, over tiny cutouts around each object's image
+            xypos = np.column_stack([np.asarray(self.t1['x_fit'], dtype=float), 
+                                     np.asarray(self.t1['y_fit'], dtype=float)])
+            cutouts_tiny = tiny_cutouts(data, xypos, self.circularity_cutout)
+            circularity, area, shape_defect, circle_deviation = shape_metrics(cutouts_tiny, self.threshold)
+
             self.t1['profile_diff'] = self.profile_diff_list
-            self.t1['circularity']  = self.circularity_list
-            self.t1['area']  = self.area_list
+            self.t1['circularity']  = circularity
+            self.t1['area']  = area
 #             self.t1['solidity']  = self.solidity_list
 #             self.t1['concavity'] = self.concavity_list
-            self.t1['shape_defect'] = self.max_defect_list
-            self.t1['circle_deviation'] = self.circle_deviation_list
+            self.t1['shape_defect'] = shape_defect
+            self.t1['circle_deviation'] = circle_deviation
             
         except Exception as e:
             print(e)
@@ -0,0 +1,894 @@
+import os
+import csv
+import json
+import argparse
+import subprocess
+import warnings
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table, vstack
+from astropy.wcs import FITSFixedWarning
+from astropy.utils.exceptions import AstropyUserWarning
+from astropy.utils.metadata import MergeConflictWarning
+
+from settings import DATAPATH, RESULTS, CACHEPATH, tel_suffix, sequences, images, get_parameters, fname
+from settings import get_table_sources, get_table_presence
+from library import remove_outsiders, find_duplicates, remove_scanner_artifacts
+from library import cross_match, split_matches, run_sequence_matching
+from library import clean_bad_fits, NeighborhoodIndex, FitWorker
+from library import ProfileWorker, SharedColumns, parallel_map, get_profile_bank, write_cutout_store
+from library import add_flux_ratio, exceeds_criteria, file_checksum, get_plate_products, profiler
+from library import release_plate_products, image_cache, temporary_name
+
+
+'''
+In-process version of the pipeline run by notebook pipeline.ipynb.
+
+Each stage of the pipeline (find_mismatches.ipynb, psf_analysis.ipynb, and
+the candidate selection in display_nonmatches.ipynb) is a function in here,
+with the same sequence of steps as the corresponding notebook. Tables 
+produced by a stage are handed in memory to the next stage, and products
+that depend on a single plate (sources, WCS, background, reference star 
+fits) are shared by the two pairs the plate belongs to (see class 
+PlateProducts in library.py). Each stage still writes the same FITS products
+the notebooks write.
+
+Stage functions take the pair they work on from a RunContext instance, not
+from file dataset.json, so several pairs of a sequence can be processed at
+the same time, each in its own process (see function run_pairs).
+
+Each stage run leaves a manifest in the cache directory, with the checksums
+of its input files, the parameters it read, and the checksums of its output
+files. A stage is skipped when none of these changed since its last run 
+(see function run_stage), so a rerun only redoes the stages that are 
+affected by a change.
+
+HTML pages, made by executing the display notebooks with nbconvert, are
+optional.
+
+Command line:
+
+    python pipeline.py [sequence key] [--all] [--html] [--pair-matching] [--nproc N] 
+                       [--cpus N] [--memory GB] [--force]
+'''
+
+# output path for HTML pages
+HTMLPATH = os.path.join(DATAPATH, "html")
+
+# stage manifests live here. Bump the version to invalidate all of them.
+MANIFESTPATH = os.path.join(CACHEPATH, "manifests")
+manifest_version = 1
+
+
+class TrackedParameters(dict):
+    '''
+    Parameters dict that records which keys are read from it. Stage 
+    manifests hold only the parameters the stage actually read.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.used = set()
+
+    def __getitem__(self, key):
+        self.used.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.used.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.used.add(key)
+        return super().__contains__(key)
+
+
+class RunContext:
+    '''
+    Everything a stage function needs to know about the pair of plates it
+    works on: the pair key, the parameters dict for the pair (resolved once,
+    by settings.get_parameters), and the image file names. 
+
+    Instances are small and picklable, so they can be handed to the 
+    processes that run pairs concurrently.
+    '''
+    def __init__(self, key, seq_key=None, nproc=None):
+        '''
+        Parameters:
+
+        key     - pair key, e.g. '19012,19013'
+        seq_key - key in the settings.sequences dict for the sequence the pair 
+                  belongs to, if any
+        nproc   - number of processes used by the stages of this pair; default
+                  is the 'nproc_analysis' parameter
+        '''
+        self.key = key
+        self.seq_key = seq_key
+        self.plate_id_1, self.plate_id_2 = key.split(',')
+
+        self.par = get_parameters(key)
+
+        self.image1 = fname(self.par['image1'])
+        self.image2 = fname(self.par['image2'])
+
+        self.nproc = nproc if nproc is not None else self.par['nproc_analysis']
+
+    def __repr__(self):
+        return "RunContext(" + self.key + ")"
+
+    def path(self, name):
+        '''
+        Full path name of a pair product, given its key in the parameters
+        dict (e.g. 'table_matched').
+        '''
+        return fname(dict.get(self.par, name))
+
+    def source_files(self):
+        '''
+        Full path names of the source tables (source and source_calib) of both plates.
+        '''
+        return [fname(get_table_sources(plate_id, calib=calib)) 
+                for plate_id in [self.plate_id_1, self.plate_id_2] for calib in [False, True]]
+
+    @contextmanager
+    def tracking(self):
+        '''
+        Within this context, self.par records the parameter keys that are read.
+        '''
+        par = self.par
+        self.par = TrackedParameters(par)
+        try:
+            yield self.par
+        finally:
+            self.par = par
+
+    def environment(self):
+        '''
+        Process environment that points settings.py (and so, any notebook)
+        to this pair and sequence, without rewriting file dataset.json.
+        '''
+        env = dict(os.environ)
+        env['FOOTPRINTS_DATASET'] = self.key
+        if self.seq_key is not None:
+            env['FOOTPRINTS_SEQUENCE'] = self.seq_key
+        return env
+
+    def memory_estimate(self):
+        '''
+        Rough estimate of the peak memory used by the stages of this pair, in
+        bytes: the full-plate float arrays of psf_analysis (bkg-subtracted
+        image, background map, and the shared memory copy of the image), plus
+        the integer scan the background is computed from. The scans of both
+        plates, as held by the image cache, are added on top (up to the 
+        cache's budget, image_cache.max_bytes).
+        '''
+        header = fits.getheader(self.image1)
+        npix = header.get('NAXIS1', 0) * header.get('NAXIS2', 0)
+
+        scans = 0
+        for file_name in [self.image1, self.image2]:
+            header = fits.getheader(file_name)
+            scans += header.get('NAXIS1', 0) * header.get('NAXIS2', 0) * abs(header.get('BITPIX', 16)) // 8
+
+        return npix * (3 * 8 + 2) + min(scans, image_cache.max_bytes)
+
+
+def find_mismatches(ctx):
+    '''
+    Finds the sources in the first plate of a pair that have no counterpart
+    in the second plate. Same steps as notebook find_mismatches.ipynb.
+
+    Parameters:
+
+    ctx - RunContext for the pair
+
+    Returns:
+
+    table_matched     - sources with a match in the second plate
+    table_non_matched - sources without a match in the second plate
+    '''
+    par = ctx.par
+
+    plate_1 = get_plate_products(ctx.plate_id_1)
+    plate_2 = get_plate_products(ctx.plate_id_2)
+
+    # only the first table is cleaned
+    with profiler.step('select_sources', rows_in=len(plate_1.sources)) as record:
+        table_1copy = plate_1.selected_sources(par)
+        record['rows_out'] = len(table_1copy)
+    table_2copy = plate_2.sources
+
+    # remove anything that is not in the second image's FOV. The footprint 
+    # comes from the WCS alone, so the second scan's pixels aren't read.
+    with profiler.step('remove_outsiders', rows_in=len(table_1copy)) as record:
+        table_1copy = remove_outsiders(None, plate_2.wcs, table_1copy, wcs_table=plate_1.wcs)
+        record['rows_out'] = len(table_1copy)
+
+    # remove scanner artifacts
+    with profiler.step('remove_duplicates', rows_in=len(table_1copy)) as record:
+        groups, offsets = find_duplicates(table_1copy)
+        table_1copy = remove_scanner_artifacts(table_1copy, groups=groups)
+        record['rows_out'] = len(table_1copy)
+
+    with profiler.step('cross_match', rows_in=len(table_1copy)) as record:
+        matched, non_matched = cross_match(table_1copy, table_2copy)
+        record['rows_out'] = len(matched)
+
+    table_matched, table_non_matched = split_matches(table_1copy, matched, ctx.plate_id_2)
+
+    table_non_matched.write(ctx.path('table_non_matched'), format='fits', overwrite=True)
+    table_matched.write(ctx.path('table_matched'), format='fits', overwrite=True)
+
+    print("Non-matched objects: ", len(table_non_matched))
+    print("Matched objects: ", len(table_matched))
+
+    return table_matched, table_non_matched
+
+
+def psf_analysis(ctx, table_match, table_nomatch, write_cutouts=True, flux_bins=5,
+                 batch_size=50, ci_tolerance=0.02, min_stars=30, max_stars=2500):
+    '''
+    Gaussian fits and radial profile analysis of the matched and non-matched
+    objects of a pair. Same steps as notebook psf_analysis.ipynb.
+
+    Parameters:
+
+    ctx           - RunContext for the pair
+    table_match   - table with matched objects (from find_mismatches)
+    table_nomatch - table with non-matched objects (from find_mismatches)
+    write_cutouts - write the per-pair cutout store
+    flux_bins, batch_size, ci_tolerance, min_stars, max_stars - reference
+                    star sampling parameters (see function fit_reference_stars)
+
+    Returns:
+
+    table_psf_matched    - fitted reference stars
+    table_psf_nonmatched - non-matched objects with fits and profile metrics
+    '''
+    par = ctx.par
+    nproc = ctx.nproc
+
+    plate_1 = get_plate_products(ctx.plate_id_1)
+
+    wcs_image = plate_1.wcs
+    with profiler.step('background'):
+        data, background = plate_1.background(nproc=nproc)
+
+    # reference stars
+    table_match = table_match.copy()
+    table_match.sort('flux_max', reverse=True)
+
+    table_match_full = remove_outsiders(data, wcs_image, table_match)
+    neighborhood_index = NeighborhoodIndex(table_match_full)
+
+    if len(table_match_full) == 0:
+        raise Exception("No matched objects. Bailing out...")
+
+    with profiler.step('reference_fits', rows_in=len(table_match_full)) as record:
+        table_1, strata = plate_1.reference_fits(table_match_full, par, nproc=nproc,
+                                                 flux_bins=flux_bins, batch_size=batch_size, ci_tolerance=ci_tolerance,
+                                                 min_stars=min_stars, max_stars=max_stars)
+        table_1 = clean_bad_fits(table_1, par)
+        record['rows_out'] = len(table_1)
+
+    print("Table of matched objects, after bad PSF fits were removed, has", len(table_1), "rows.")
+
+    # non-matched objects
+    table_nomatch = remove_outsiders(data, wcs_image, table_nomatch)
+
+    def fit_worker(name, row_start, row_end):
+        return FitWorker(name, data, table_nomatch, row_start, row_end, par)
+
+    with profiler.step('nonmatched_fits', rows_in=len(table_nomatch)) as record:
+        table_nomatch_1 = vstack(parallel_map(fit_worker, table_nomatch, nproc=nproc))
+        table_nomatch_1 = clean_bad_fits(table_nomatch_1, par)
+        record['rows_out'] = len(table_nomatch_1)
+
+    # segregate data points within the desired ranges of parameters
+    mask = table_nomatch_1['flux_max'] > par['min_acceptable_flux']
+    t1 = table_nomatch_1[mask]
+    mask = t1['fwhm_fit'] < par['max_fwhm']
+    t1 = t1[mask]
+    mask = t1['fwhm_fit'] > par['min_fwhm']
+    t1 = t1[mask]
+
+    # profile RMS difference, and circularity
+    cutout_size = float(par['neighborhood_cutout_size']) / 60. * u.deg
+    edge_radii = np.arange(25) / 2.
+
+    with profiler.step('profile_bank', rows_in=len(table_match_full)):
+        profile_bank = get_profile_bank(data, table_match_full, edge_radii, par, nproc=nproc)
+
+    with SharedColumns({'data': data}, ['data']) as shared_image:
+
+        def profile_worker(name, row_start, row_end):
+            return ProfileWorker(name, t1, neighborhood_index, shared_image, wcs_image,
+                                 cutout_size, edge_radii, row_start, row_end,
+                                 par['fwhm_init'], par['fit_shape'],
+                                 circularity_cutout=par['tiny_cutout_size'],
+                                 threshold=par['circularity_threshold'],
+                                 profile_bank=profile_bank)
+
+        with profiler.step('profiles', rows_in=len(t1)) as record:
+            t1 = vstack(parallel_map(profile_worker, t1, nproc=nproc))
+            record['rows_out'] = len(t1)
+
+    t1.write(ctx.path('table_psf_nonmatched'), overwrite=True)
+    print("Non-matched objects:", len(t1))
+
+    table_1.write(ctx.path('table_psf_matched'), overwrite=True)
+    print("Matched objects:    ", len(table_1))
+
+    if write_cutouts:
+        with profiler.step('cutout_store', rows_in=len(t1)):
+            store_name = write_cutout_store(t1, par)
+        print("Cutout store:", store_name)
+
+    return table_1, t1
+
+
+def select_candidates(ctx, table_psf_nonmatched):
+    '''
+    Selects the non-matched objects that pass the static criteria and the
+    false-positive test. Same selection as notebook display_nonmatches.ipynb,
+    without the plots.
+
+    Parameters:
+
+    ctx                  - RunContext for the pair
+    table_psf_nonmatched - table from psf_analysis
+
+    Returns:
+
+    table with candidate objects
+    '''
+    par = ctx.par
+
+    table_psf_nonmatched = table_psf_nonmatched.copy()
+    table_psf_nonmatched.sort('flux_max', reverse=True)
+
+    max_plots = min(len(table_psf_nonmatched), par['plot_limit'])
+
+    table_psf_nonmatched = table_psf_nonmatched[:max_plots]
+
+    with profiler.step('candidate_criteria', rows_in=max_plots) as record:
+        table_psf_nonmatched = add_flux_ratio(table_psf_nonmatched, par)
+
+        surviving_indices = [row_index for row_index in range(max_plots)
+                             if not exceeds_criteria(table_psf_nonmatched, row_index, par)]
+
+        table_candidates = table_psf_nonmatched[surviving_indices]
+        record['rows_out'] = len(table_candidates)
+
+    table_candidates.write(ctx.path('table_candidates'), overwrite=True)
+    print("Candidate objects:", len(table_candidates))
+
+    return table_candidates
+
+
+def collate(seq_key, candidates):
+    '''
+    Collates the candidate tables of all pairs in a sequence into a single
+    table, as notebook collate.ipynb does.
+
+    Parameters:
+
+    seq_key    - key in the settings.sequences dict
+    candidates - list of candidate tables, one per pair
+
+    Returns:
+
+    name of the output file
+    '''
+    table_final = vstack(candidates)
+
+    out_file = fname('pipeline_final_' + tel_suffix + '_' + seq_key + '.fits')
+    table_final.write(out_file, format='fits', overwrite=True)
+
+    print("Created output file: ", out_file)
+
+    return out_file
+
+
+def parameter_value(value):
+    # parameter values as stored in manifests (tuples become lists, etc.)
+    return json.loads(json.dumps(value, sort_keys=True, default=repr))
+
+
+def read_manifest(name):
+    '''
+    Reads a stage manifest. Returns None if there is no such manifest.
+    '''
+    try:
+        with open(os.path.join(MANIFESTPATH, name + '.json'), 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_manifest(name, manifest):
+    os.makedirs(MANIFESTPATH, exist_ok=True)
+    file_name = os.path.join(MANIFESTPATH, name + '.json')
+    tmp_file = temporary_name(file_name)
+    with open(tmp_file, 'w') as json_file:
+        json.dump(manifest, json_file, indent=1)
+    os.replace(tmp_file, file_name)
+
+
+def checksums(file_names):
+    return {file_name: file_checksum(file_name) for file_name in file_names}
+
+
+def is_current(manifest, inputs, contexts):
+    '''
+    Checks if a stage manifest is up to date: same input files with the same 
+    checksums, same values for the parameters the stage read, and output 
+    files still in place, as written by the stage.
+    '''
+    if manifest is None or manifest.get('version') != manifest_version:
+        return False
+
+    if sorted(manifest['inputs'].keys()) != sorted(inputs):
+        return False
+    for file_name in inputs:
+        if not os.path.exists(file_name) or file_checksum(file_name) != manifest['inputs'][file_name]:
+            return False
+
+    for ctx in contexts:
+        used = manifest['parameters'].get(ctx.key)
+        if used is None:
+            return False
+        for key, value in used.items():
+            if parameter_value(ctx.par.get(key)) != value:
+                return False
+
+    for file_name, checksum in manifest['outputs'].items():
+        if not os.path.exists(file_name) or file_checksum(file_name) != checksum:
+            return False
+
+    return True
+
+
+def run_stage(stage, name, contexts, inputs, outputs, function, load, force=False):
+    '''
+    Runs a stage, unless its manifest shows that nothing it depends on
+    changed since the last run. In that case, its products are read back
+    from the output files instead.
+
+    Parameters:
+
+    stage    - stage name, e.g. 'psf_analysis'
+    name     - what the stage runs on, e.g. '19012_19013' (stage and name make 
+               the manifest name)
+    contexts - RunContext instances whose parameters the stage reads
+    inputs   - input file names
+    outputs  - output file names
+    function - callable with no arguments that runs the stage
+    load     - callable with no arguments that reads the stage products back
+               from the output files
+    force    - run the stage anyway
+
+    Returns:
+
+    whatever function (or load) returns
+    '''
+    manifest_name = stage + '_' + name
+
+    with profiler.step(stage, level='stage') as record:
+        record['skipped'] = not force and is_current(read_manifest(manifest_name), inputs, contexts)
+
+        if record['skipped']:
+            print("SKIP ", stage, " ", name, " - inputs and parameters unchanged", flush=True)
+            return load()
+
+        input_checksums = checksums(inputs)
+
+        with ExitStack() as stack:
+            tracked = [stack.enter_context(ctx.tracking()) for ctx in contexts]
+            result = function()
+
+    manifest = {'version': manifest_version,
+                'stage': stage,
+                'inputs': input_checksums,
+                'parameters': {ctx.key: {key: parameter_value(dict.get(par, key)) for key in sorted(par.used)}
+                               for ctx, par in zip(contexts, tracked)},
+                'outputs': checksums(outputs)}
+
+    write_manifest(manifest_name, manifest)
+
+    return result
+
+
+def read_tables(file_names):
+    return [Table.read(file_name, format='fits') for file_name in file_names]
+
+
+def render_html(notebook, output_file, ctx):
+    '''
+    Executes a notebook for the pair in a RunContext, and saves the result 
+    as an HTML page.
+    '''
+    command = ['jupyter', 'nbconvert', '--to', 'html', '--execute', notebook, '--output', output_file]
+    result = subprocess.run(command, env=ctx.environment())
+    if result.returncode != 0:
+        print("--------  ERROR rendering ", notebook, " to ", output_file)
+
+
+def run_pair(ctx, tables=None, html=False, force=False):
+    '''
+    Runs all stages of the pipeline on a pair of plates. Stages whose 
+    inputs and parameters didn't change since their last run are skipped
+    (see function run_stage).
+
+    Parameters:
+
+    ctx    - RunContext for the pair
+    tables - (matched, non-matched) tables for the pair, if already available 
+             (e.g. from run_sequence_matching); otherwise find_mismatches is run
+    html   - also render the display notebook as an HTML page
+    force  - run all stages, even the ones that are up to date
+
+    Returns:
+
+    table with candidate objects, or None if the pair failed
+    '''
+    print("START processing dataset: ", ctx.key, flush=True)
+
+    name = ctx.plate_id_1 + '_' + ctx.plate_id_2
+
+    match_files = [ctx.path('table_matched'), ctx.path('table_non_matched')]
+    psf_files = [ctx.path('table_psf_matched'), ctx.path('table_psf_nonmatched')]
+    candidates_file = ctx.path('table_candidates')
+
+    try:
+        if tables is not None:
+            table_matched, table_non_matched = tables
+        else:
+            table_matched, table_non_matched = run_stage('find_mismatches', name, [ctx],
+                                                         ctx.source_files() + [ctx.image1, ctx.image2], match_files,
+                                                         lambda: find_mismatches(ctx), 
+                                                         lambda: read_tables(match_files), force=force)
+
+        table_psf_matched, table_psf_nonmatched = run_stage('psf_analysis', name, [ctx],
+                                                            match_files + [ctx.image1], 
+                                                            psf_files + [ctx.path('cutout_store')],
+                                                            lambda: psf_analysis(ctx, table_matched, table_non_matched),
+                                                            lambda: read_tables(psf_files), force=force)
+
+        table_candidates = run_stage('select_candidates', name, [ctx],
+                                     [psf_files[1], ctx.image1, ctx.image2], [candidates_file],
+                                     lambda: select_candidates(ctx, table_psf_nonmatched),
+                                     lambda: read_tables([candidates_file])[0], force=force)
+
+        if html:
+            suffix = ctx.plate_id_1 + "_" + ctx.plate_id_2 + ".html"
+            render_html("display_nonmatches.ipynb", os.path.join(HTMLPATH, "display_nomatches_" + suffix), ctx)
+
+    except Exception as e:
+        print("--------  ERROR in dataset ", ctx.key, ": ", str(e), flush=True)
+        print()
+        return None
+
+    finally:
+        # this is the last pair that uses the first plate
+        release_plate_products(ctx.plate_id_1)
+
+    print("END processing dataset: ", ctx.key, flush=True)
+
+    return table_candidates
+
+
+def run_pair_profiled(ctx, tables=None, html=False, force=False, release_all=False):
+    '''
+    Runs function run_pair, and returns its result together with the profiler
+    records of the pair, so records made in the processes that run pairs can
+    be handed back to the calling process.
+
+    With release_all, all plate products and scans held by this process are 
+    dropped afterwards. Processes that run pairs concurrently get pairs in no
+    particular order, so they have no reason to keep the second plate, and
+    the pool keeps them alive between pairs.
+    '''
+    with profiler.recording() as records:
+        with profiler.labelled(pair=ctx.key):
+            table_candidates = run_pair(ctx, tables, html=html, force=force)
+
+    if release_all:
+        release_plate_products()
+        image_cache.clear()
+
+    return table_candidates, records
+
+
+def physical_memory():
+    '''
+    Physical memory of this machine, in bytes.
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 16 * 1024**3
+
+
+def run_pairs(contexts, pair_tables=None, html=False, cpus=None, memory=None, force=False):
+    '''
+    Runs several pairs concurrently, each in its own process, within a
+    global budget of CPUs and memory. 
+
+    A pair takes ctx.nproc CPUs (its stages run their own process pools), 
+    and ctx.memory_estimate() bytes. Pairs are started in the order given,
+    as soon as the CPUs and memory they take are available; a pair is 
+    always started when nothing else is running, even if it doesn't fit 
+    the budget.
+
+    Parameters:
+
+    contexts    - list of RunContext instances
+    pair_tables - dict keyed by pair key with (matched, non-matched) tables,
+                  for the pairs that already have them
+    html        - also render the display notebooks as HTML pages
+    cpus        - CPU budget; default is the number of CPUs in this machine
+    memory      - memory budget in bytes; default is 80% of the physical memory
+    force       - run all stages, even the ones that are up to date
+
+    Returns:
+
+    list with the candidates table of each pair (None for failed pairs), in
+    the same order as contexts
+    '''
+    if pair_tables is None:
+        pair_tables = {}
+    if cpus is None:
+        cpus = os.cpu_count()
+    if memory is None:
+        memory = 0.8 * physical_memory()
+
+    results = [None] * len(contexts)
+
+    # a pair can't take more CPUs than the whole budget
+    for ctx in contexts:
+        ctx.nproc = max(min(ctx.nproc, cpus), 1)
+
+    if len(contexts) <= 1 or cpus <= contexts[0].nproc:
+        for i, ctx in enumerate(contexts):
+            results[i], records = run_pair_profiled(ctx, pair_tables.get(ctx.key), html=html, force=force)
+            profiler.records.extend(records)
+        return results
+
+    needs = [(ctx.nproc, ctx.memory_estimate()) for ctx in contexts]
+
+    pending = list(range(len(contexts)))
+    running = {}
+    cpus_used = 0
+    memory_used = 0
+
+    with ProcessPoolExecutor(max_workers=len(contexts)) as executor:
+        while pending or running:
+
+            # start pairs, in order, while they fit
+            while pending:
+                i = pending[0]
+                nproc, nbytes = needs[i]
+                fits_budget = cpus_used + nproc <= cpus and memory_used + nbytes <= memory
+                if running and not fits_budget:
+                    break
+
+                pending.pop(0)
+                ctx = contexts[i]
+                future = executor.submit(run_pair_profiled, ctx, pair_tables.get(ctx.key), html, force,
+                                         release_all=True)
+                running[future] = i
+                cpus_used += nproc
+                memory_used += nbytes
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                cpus_used -= needs[i][0]
+                memory_used -= needs[i][1]
+                try:
+                    results[i], records = future.result()
+                    profiler.records.extend(records)
+                except Exception as e:
+                    print("--------  ERROR in dataset ", contexts[i].key, ": ", str(e), flush=True)
+
+    return results
+
+
+def prepare_plates(sequence):
+    '''
+    Builds the products of each plate in a sequence that are used by both
+    pairs the plate belongs to (sources table and WCS, see class 
+    PlateProducts), before the pairs are started. Pairs that run at the 
+    same time then find them in the on-disk caches, instead of each building
+    its own.
+
+    Backgrounds and reference star fits are left to the pair in which the
+    plate comes first, the only one that uses them.
+    '''
+    for plate_id in sequence:
+        get_plate_products(plate_id).build()
+
+
+# columns in the profiling report (see class Profiler in library.py)
+profile_columns = ['pair', 'level', 'step', 'worker', 'skipped', 'rows_in', 'rows_out', 'wall', 'cpu', 
+                   'peak_rss', 'pid', 'start']
+
+
+def profile_summary(records):
+    '''
+    Summary of the profiler records of a sequence: one row per pair (plus a
+    'sequence' row for records not tied to a pair), with the wall time of each
+    stage, the total wall time and process CPU time (including pool processes,
+    see class Profiler) of the stages, and the largest peak RSS of any process
+    that worked on the pair.
+    '''
+    stages = list(dict.fromkeys([r['step'] for r in records if r['level'] == 'stage']))
+    pairs = list(dict.fromkeys([r.get('pair') or 'sequence' for r in records]))
+
+    rows = []
+    for pair in pairs:
+        pair_records = [r for r in records if (r.get('pair') or 'sequence') == pair]
+        stage_records = [r for r in pair_records if r['level'] == 'stage']
+
+        row = [pair]
+        row += [sum([r['wall'] for r in stage_records if r['step'] == stage]) for stage in stages]
+        row += [sum([r['wall'] for r in stage_records]), sum([r['cpu'] for r in stage_records]),
+                max([r['peak_rss'] for r in pair_records])]
+        rows.append(row)
+
+    summary = Table(rows=rows, names=['pair'] + stages + ['wall', 'process_cpu', 'peak_rss'])
+    for name in summary.colnames[1:]:
+        summary[name].format = '.2f'
+
+    return summary
+
+
+def write_profile_report(seq_key, records):
+    '''
+    Writes the profiler records of a sequence run to the RESULTS directory:
+    all records, as JSON and as CSV, and the summary across pairs (see 
+    function profile_summary), as CSV. Times are in seconds, memory in MB.
+    '''
+    records = sorted(records, key=lambda r: r['start'])
+    summary = profile_summary(records)
+
+    os.makedirs(RESULTS, exist_ok=True)
+    base_name = os.path.join(RESULTS, 'profile_' + tel_suffix + '_' + str(seq_key))
+
+    with open(base_name + '.json', 'w') as json_file:
+        json.dump({'sequence': seq_key, 'plates': sequences[seq_key], 'records': records}, json_file,
+                  indent=1, default=str)
+
+    with open(base_name + '.csv', 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=profile_columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+    summary.write(base_name + '_summary.csv', format='ascii.csv', overwrite=True)
+
+    summary.pprint_all()
+    print("Profiling report: ", base_name + '.json')
+
+
+def run_sequence(seq_key, sequence_matching=True, html=False, nproc=None, cpus=None, memory=None, force=False):
+    '''
+    Runs the pipeline on all pairs of a sequence. Pairs are processed 
+    concurrently, within a budget of CPUs and memory (see run_pairs), and
+    stages that are up to date are skipped (see run_stage). A report with the
+    time and memory taken by each stage, step and worker call is written to
+    the RESULTS directory (see function write_profile_report).
+
+    Parameters:
+
+    seq_key           - key in the settings.sequences dict
+    sequence_matching - match the entire sequence at once (see run_sequence_matching),
+                        instead of running find_mismatches on each pair
+    html              - also render the display notebooks as HTML pages
+    nproc             - number of processes per pair; default is the 'nproc_analysis' parameter
+    cpus              - CPU budget; default is the number of CPUs in this machine
+    memory            - memory budget in bytes; default is 80% of the physical memory
+    force             - run all stages, even the ones that are up to date
+    '''
+    sequence = sequences[seq_key]
+
+    print("START pipeline for sequence ", tel_suffix, " ", seq_key, " ", sequence)
+
+    first_record = len(profiler.records)
+
+    contexts = [RunContext(str(sequence[i]) + ',' + str(sequence[i+1]), seq_key=seq_key, nproc=nproc)
+                for i in range(len(sequence) - 1)]
+
+    with profiler.step('prepare_plates', level='stage'):
+        prepare_plates(sequence)
+
+    pair_tables = {}
+    if sequence_matching:
+        print("START matching sequence ", seq_key)
+
+        plates = [str(plate_id) for plate_id in sequence]
+        inputs = [fname(get_table_sources(plate_id, calib=calib)) for plate_id in plates for calib in [False, True]]
+        inputs += [fname(images[plate_id]) for plate_id in plates]
+        outputs = [ctx.path(name) for ctx in contexts for name in ['table_matched', 'table_non_matched']]
+        outputs += [fname(get_table_presence(seq_key))]
+
+        def match():
+            return run_sequence_matching(seq_key, parameters={ctx.key: ctx.par for ctx in contexts})
+
+        def load():
+            return {ctx.key: tuple(read_tables([ctx.path('table_matched'), ctx.path('table_non_matched')]))
+                    for ctx in contexts}
+
+        pair_tables = run_stage('match_sequence', tel_suffix + '_' + str(seq_key), contexts, inputs, outputs,
+                                match, load, force=force)
+
+        print("END matching sequence ", seq_key)
+
+    # plates are read back from the on-disk caches by the pairs that use them,
+    # and dropped after their last pair (see function run_pair)
+    release_plate_products()
+
+    results = run_pairs(contexts, pair_tables, html=html, cpus=cpus, memory=memory, force=force)
+
+    print("Collating results...")
+
+    candidates = [table for table in results if table is not None]
+    if len(candidates) > 0:
+        collate(seq_key, candidates)
+
+    write_profile_report(seq_key, profiler.records[first_record:])
+
+    release_plate_products()
+
+    if html:
+        print("Printing results file...")
+        suffix = tel_suffix + "_" + str(seq_key) + ".html"
+        render_html("pipeline_results.ipynb", os.path.join(RESULTS, "pipeline_view_results_" + suffix), 
+                    contexts[0])
+
+    print("END pipeline for sequence ", tel_suffix, " ", seq_key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the pipeline on one or more sequences of plates.")
+    parser.add_argument('sequence', nargs='?', default=None,
+                        help="key in the sequences dict (default: current_sequence in dataset.json)")
+    parser.add_argument('--all', action='store_true', help="run all sequences defined in settings.py")
+    parser.add_argument('--html', action='store_true', help="also render the display notebooks as HTML")
+    parser.add_argument('--pair-matching', action='store_true',
+                        help="run find_mismatches on each pair, instead of matching the entire sequence at once")
+    parser.add_argument('--nproc', type=int, default=None, help="number of processes per pair")
+    parser.add_argument('--cpus', type=int, default=None, 
+                        help="CPU budget for all pairs processed at the same time (default: all CPUs)")
+    parser.add_argument('--memory', type=float, default=None, 
+                        help="memory budget in GB for all pairs processed at the same time (default: 80%% of RAM)")
+    parser.add_argument('--force', action='store_true', help="run all stages, even the ones that are up to date")
+    args = parser.parse_args(argv)
+
+    # mostly to avoid clunky screen output
+    warnings.filterwarnings('ignore', category=AstropyUserWarning, message=".*One or more fit.*")
+    warnings.filterwarnings('ignore', category=MergeConflictWarning)
+    warnings.filterwarnings('ignore', category=FITSFixedWarning)
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+
+    if args.all:
+        keys = list(sequences.keys())
+    elif args.sequence is not None:
+        keys = [args.sequence]
+    else:
+        from settings import current_sequence
+        keys = [current_sequence]
+
+    memory = args.memory * 1024**3 if args.memory is not None else None
+
+    for seq_key in keys:
+        run_sequence(seq_key, sequence_matching=not args.pair_matching, html=args.html, nproc=args.nproc,
+                     cpus=args.cpus, memory=memory, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,9 @@ tel_suffix = "GS"
 DATAPATH = '/Users/busko/Projects/VASCO_data/footprints'
 # DATAPATH = '/Volumes/backup/plateanalysis_data/footprints'
 
+# on-disk cache for derived products (e.g. background maps)
+CACHEPATH = os.path.join(DATAPATH, 'cache')
+
 CATALOG = 'footprints_6.csv'
 # CATALOG = 'footprints_1958.csv'
 RESULTS = "./results/"
@@ -31,7 +34,12 @@ RESULTS = "./results/"
 # To support pipleine mode, the current data set and sequence names
 # are kept in a json file. To run scripts manually, edit this file 
 # to point to the desired plate pair (careful with editing, JSON 
-# files have finicky syntax). The pipeline overwrites this file.
+# files have finicky syntax). 
+#
+# Environment variables FOOTPRINTS_DATASET and FOOTPRINTS_SEQUENCE, when
+# set, take precedence over the file. The pipeline uses them to point 
+# each notebook it executes to a pair, so several pairs can be processed
+# at the same time without rewriting the file.
 
 dataset_json = 'dataset.json'    
 try:
@@ -43,6 +51,9 @@ except FileNotFoundError:
     print(f"Error: File {dataset_json} was not found.")
 except json.JSONDecodeError as e:
     print(f"JSON Error: {e}")
+
+current_dataset  = os.environ.get('FOOTPRINTS_DATASET', globals().get('current_dataset'))
+current_sequence = os.environ.get('FOOTPRINTS_SEQUENCE', globals().get('current_sequence'))
     
 
 # Image names are kept in a json file so the download
@@ -73,8 +84,15 @@ def get_table_sources(plate1, calib=False):
 def get_table_psf_nomatch(plate1, plate2):
     return 'table_psf_nomatch_' + str(plate1) + '_' + str(plate2) + '.fits'
 
+def get_reference_store(plate1):
+    return 'psf_reference_' + str(plate1) + '.fits'
+
+def get_table_presence(seq_key):
+    return 'table_presence_' + tel_suffix + '_' + str(seq_key) + '.fits'
+
 def get_parameters(key):
-    par = parameters['default']
+    # always a new dict, so parameters for different pairs can coexist
+    par = dict(parameters['default'])
     if key in parameters:
         par = par | parameters[key]
     
@@ -90,6 +108,9 @@ def get_parameters(key):
     par['table_non_matched'] = 'table_nomatch_' + plate1 + '_' + plate2 + '.fits'
     par['table_psf_nonmatched'] = get_table_psf_nomatch(plate1, plate2)
     par['table_candidates'] = 'table_candidates_' + plate1 + '_' + plate2 + '.fits'
+    par['cutout_store'] = 'cutouts_' + plate1 + '_' + plate2 + '.fits'
+    par['profile_bank'] = 'profile_bank_' + plate1 + '_' + plate2 + '.fits'
+    par['reference_store'] = get_reference_store(plate1)
     
     par['image1'] = images[plate1]
     par['image2'] = images[plate2]
@@ -0,0 +1,452 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table, MaskedColumn, vstack
+from scipy.spatial import cKDTree
+
+
+'''
+Synthetic plate scans and source tables, for testing and benchmarking the
+pipeline without the APPLAUSE scans (see benchmark.py).
+
+A sequence of plates is made from a single synthetic sky, with a TAN WCS per
+plate (pointings slightly offset from each other). Stars are rendered as
+Gaussians over a vignetted background, and converted to photographic density
+with a saturating response. Scans are stored inverted ("negative"), as the
+APPLAUSE scans are, so the pipeline inverts them back.
+
+Each plate also gets a sources_<plate>.csv and a sources_calib_<plate>.csv
+file with the columns the pipeline reads from the APPLAUSE tables. As in
+APPLAUSE, each plate was scanned twice, so real objects show up once per scan,
+while scanner artifacts show up in one scan only. A small fraction of the
+sources are contaminants (elongated, flagged, or with low model prediction)
+that the source selection should reject.
+
+For each pair of consecutive plates, a set of isolated, non-Gaia sources is
+injected that vanish after the first plate of the pair. They are listed in
+the truth table, so a run of the pipeline can be checked for recall.
+
+Command line:
+
+    python synthetic.py <output directory> [--plates 101 102] [--size 2000] [--density 2000]
+                        [--vanishing 20] [--seed 0]
+'''
+
+# arcsec per pixel
+pixel_scale = 1.5
+
+
+def make_wcs(size, scale=pixel_scale, ra=150., dec=30., offset=(0., 0.)):
+    '''
+    TAN WCS for a square plate scan.
+
+    Parameters:
+
+    size   - plate side, in pixels
+    scale  - pixel scale, in arcsec
+    ra,dec - plate center, in degrees, when offset is zero
+    offset - (x, y) offset of the plate center, in units of the plate side
+    '''
+    side = size * scale / 3600.
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crpix = [(size + 1) / 2., (size + 1) / 2.]
+    wcs.wcs.crval = [ra + offset[0] * side / np.cos(np.radians(dec)), dec + offset[1] * side]
+    wcs.wcs.cd = [[-scale / 3600., 0.], [0., scale / 3600.]]
+    wcs.pixel_shape = (size, size)
+
+    return wcs
+
+
+def make_sky(wcs, size, density=2000., margin=0.1, gaia_fraction=0.8, contaminants=0.05,
+             min_peak=300., max_peak=2.e5, rng=None):
+    '''
+    Synthetic sky sources around the footprint of a plate.
+
+    Peak intensities follow Euclidean number counts, N(>F) ~ F^-1.5.
+
+    Parameters:
+
+    wcs           - WCS of the plate the sky is built around
+    size          - plate side, in pixels
+    density       - sources per square megapixel
+    margin        - the sky extends beyond the plate by this fraction of its side
+    gaia_fraction - fraction of sources with a Gaia ID
+    contaminants  - fraction of sources that are elongated, flagged, or not star-like
+    min_peak, max_peak - range of peak intensities
+    rng           - numpy random Generator
+
+    Returns:
+
+    table with ra, dec, peak, elongation, angle, gaia, flags, model_prediction,
+    and last_plate (index in the sequence of the last plate where the source
+    is seen; -1 for sources seen in all plates)
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    low, high = -margin * size, (1. + margin) * size
+    n = int(density * ((high - low) / 1000.)**2)
+
+    x = rng.uniform(low, high, n)
+    y = rng.uniform(low, high, n)
+    ra, dec = wcs.pixel_to_world_values(x, y)
+
+    sky = Table()
+    sky['ra'] = ra
+    sky['dec'] = dec
+    sky['peak'] = np.minimum(min_peak * rng.random(n)**(-1. / 1.5), max_peak)
+    sky['elongation'] = 1. + np.abs(rng.normal(0., 0.04, n))
+    sky['angle'] = rng.uniform(0., np.pi, n)
+    sky['gaia'] = rng.random(n) < gaia_fraction
+    sky['flags'] = np.zeros(n, dtype=int)
+    sky['model_prediction'] = rng.uniform(0.9, 1., n)
+    sky['last_plate'] = np.full(n, -1)
+
+    # contaminants: galaxies and emulsion defects, blends, and flagged detections
+    kind = np.where(rng.random(n) < contaminants, rng.integers(0, 3, n), -1)
+    sky['elongation'][kind == 0] = rng.uniform(1.6, 3., np.count_nonzero(kind == 0))
+    sky['model_prediction'][kind == 1] = rng.uniform(0., 0.6, np.count_nonzero(kind == 1))
+    sky['flags'][kind == 2] = rng.choice([1, 2, 4, 16], np.count_nonzero(kind == 2))
+
+    return sky
+
+
+def add_vanishing(sky, wcs_1, wcs_2, size, plate_index, n=20, isolation=15., peaks=(2000., 10000.), rng=None):
+    '''
+    Appends to the sky table sources that are seen in the plates up to
+    plate_index in a sequence, and vanish after that. They are placed away
+    from the plate edges, inside the footprint of the next plate, and at
+    least isolation pixels away from any other source. They have no Gaia ID.
+
+    Parameters:
+
+    sky         - sky table (see function make_sky)
+    wcs_1       - WCS of the plate where the sources are last seen
+    wcs_2       - WCS of the next plate
+    size        - plate side, in pixels
+    plate_index - index in the sequence of the plate where the sources are last seen
+    n           - number of sources
+    isolation   - minimum distance to other sources, in pixels
+    peaks       - range of peak intensities
+    rng         - numpy random Generator
+
+    Returns:
+
+    the sky table with the new sources
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    x_sky, y_sky = wcs_1.world_to_pixel_values(np.asarray(sky['ra']), np.asarray(sky['dec']))
+    tree = cKDTree(np.column_stack((x_sky, y_sky)))
+
+    x, y = [], []
+    while len(x) < n:
+        xc = rng.uniform(0.2 * size, 0.8 * size, 4 * n)
+        yc = rng.uniform(0.2 * size, 0.8 * size, 4 * n)
+
+        distance, _ = tree.query(np.column_stack((xc, yc)))
+
+        ra, dec = wcs_1.pixel_to_world_values(xc, yc)
+        x2, y2 = wcs_2.world_to_pixel_values(ra, dec)
+        inside = (x2 > 0.05 * size) & (x2 < 0.95 * size) & (y2 > 0.05 * size) & (y2 < 0.95 * size)
+
+        for k in np.flatnonzero((distance > isolation) & inside):
+            # keep them isolated from each other too
+            if all([(xc[k] - xi)**2 + (yc[k] - yi)**2 > isolation**2 for xi, yi in zip(x, y)]):
+                x.append(xc[k])
+                y.append(yc[k])
+
+    x = np.array(x[:n])
+    y = np.array(y[:n])
+    ra, dec = wcs_1.pixel_to_world_values(x, y)
+
+    vanishing = Table()
+    vanishing['ra'] = ra
+    vanishing['dec'] = dec
+    vanishing['peak'] = rng.uniform(peaks[0], peaks[1], n)
+    vanishing['elongation'] = 1. + np.abs(rng.normal(0., 0.02, n))
+    vanishing['angle'] = rng.uniform(0., np.pi, n)
+    vanishing['gaia'] = np.zeros(n, dtype=bool)
+    vanishing['flags'] = np.zeros(n, dtype=int)
+    vanishing['model_prediction'] = rng.uniform(0.95, 1., n)
+    vanishing['last_plate'] = np.full(n, plate_index)
+
+    return vstack([sky, vanishing])
+
+
+def sky_background(x, y, size, fog=3000., vignetting=0.3):
+    '''
+    Background intensity of a plate: fog level, with a radial vignetting term.
+    '''
+    center = (size - 1) / 2.
+    return fog * (1. + vignetting * ((x - center)**2 + (y - center)**2) / (2. * center**2))
+
+
+def density_response(intensity, saturation=40000.):
+    '''
+    Photographic density response to intensity, in scan units. It is linear
+    for faint sources, and saturates for bright ones.
+    '''
+    return saturation * (1. - np.exp(-intensity / saturation))
+
+
+def render_plate(sky, present, wcs, size, fwhm=3.5, fog=3000., vignetting=0.3, saturation=40000.,
+                 grain=20., chunk_size=4096, rng=None):
+    '''
+    Renders a plate scan.
+
+    Parameters:
+
+    sky        - sky table (see function make_sky)
+    present    - boolean mask with the sky sources present in this plate
+    wcs        - plate WCS
+    size       - plate side, in pixels
+    fwhm       - stellar FWHM, in pixels
+    fog, vignetting - background (see function sky_background)
+    saturation - saturation of the density response (see function density_response)
+    grain      - sigma of the emulsion grain noise, in scan units
+    chunk_size - sources rendered at a time
+    rng        - numpy random Generator
+
+    Returns:
+
+    inverted (negative) scan, as a 16-bit unsigned integer array
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    sigma = fwhm / 2.3548
+    radius = int(np.ceil(3. * fwhm))
+
+    x, y = wcs.world_to_pixel_values(np.asarray(sky['ra'])[present], np.asarray(sky['dec'])[present])
+    keep = (x > -radius) & (x < size + radius) & (y > -radius) & (y < size + radius)
+    x, y = x[keep], y[keep]
+    peak = np.asarray(sky['peak'])[present][keep]
+    elongation = np.asarray(sky['elongation'])[present][keep]
+    angle = np.asarray(sky['angle'])[present][keep]
+
+    image = np.zeros((size, size), dtype=np.float32)
+
+    dy, dx = np.mgrid[-radius:radius+1, -radius:radius+1]
+
+    for start in range(0, len(x), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        ix = np.round(x[chunk]).astype(int)[:, None, None]
+        iy = np.round(y[chunk]).astype(int)[:, None, None]
+        px = ix + dx
+        py = iy + dy
+
+        u = px - x[chunk][:, None, None]
+        v = py - y[chunk][:, None, None]
+        cos = np.cos(angle[chunk])[:, None, None]
+        sin = np.sin(angle[chunk])[:, None, None]
+        e = elongation[chunk][:, None, None]
+
+        major = (u * cos + v * sin) / (sigma * np.sqrt(e))
+        minor = (-u * sin + v * cos) * np.sqrt(e) / sigma
+        values = peak[chunk][:, None, None] * np.exp(-0.5 * (major**2 + minor**2))
+
+        inside = (px >= 0) & (px < size) & (py >= 0) & (py < size)
+        np.add.at(image, (py[inside], px[inside]), values[inside].astype(np.float32))
+
+    # background, density response and grain, in bands of rows
+    for y0 in range(0, size, 1024):
+        yy, xx = np.mgrid[y0:min(y0 + 1024, size), 0:size]
+        band = slice(y0, y0 + 1024)
+        image[band] += sky_background(xx, yy, size, fog=fog, vignetting=vignetting)
+        image[band] = density_response(image[band], saturation=saturation)
+        image[band] += rng.normal(0., grain, image[band].shape)
+
+    return np.clip(65535. - image, 0, 65535).astype(np.uint16)
+
+
+def source_tables(sky, present, wcs, size, plate_id, fwhm=3.5, fog=3000., vignetting=0.3, saturation=40000.,
+                  artifacts=0.01, rng=None):
+    '''
+    Source tables for a plate, with the columns the pipeline reads from the
+    APPLAUSE source and source_calib tables. Each source is listed once for
+    each of the two scans of the plate. Scanner artifacts are listed in one
+    scan only.
+
+    Parameters:
+
+    sky       - sky table (see function make_sky)
+    present   - boolean mask with the sky sources present in this plate
+    wcs       - plate WCS
+    size      - plate side, in pixels
+    plate_id  - plate ID
+    fwhm, fog, vignetting, saturation - as in function render_plate
+    artifacts - number of scanner artifacts, as a fraction of the number of sources
+    rng       - numpy random Generator
+
+    Returns:
+
+    sources table, source_calib table
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    x, y = wcs.world_to_pixel_values(np.asarray(sky['ra']), np.asarray(sky['dec']))
+    visible = np.flatnonzero(present & (x >= 0) & (x < size - 1) & (y >= 0) & (y < size - 1))
+
+    # sources in scan 1, sources in scan 2, and artifacts in either scan
+    n_artifacts = int(artifacts * len(visible))
+    index = np.concatenate([visible, visible, np.full(n_artifacts, -1)])
+    scan_id = np.concatenate([np.ones(len(visible), dtype=int), np.full(len(visible), 2, dtype=int),
+                              rng.integers(1, 3, n_artifacts)])
+    real = index >= 0
+    n = len(index)
+
+    x_source = np.where(real, x[index], rng.uniform(0, size - 1, n)) + rng.normal(0., 0.3, n)
+    y_source = np.where(real, y[index], rng.uniform(0, size - 1, n)) + rng.normal(0., 0.3, n)
+
+    ra, dec = wcs.pixel_to_world_values(x_source, y_source)
+    ra = ra + rng.normal(0., 0.2, n) / 3600. / np.cos(np.radians(dec))
+    dec = dec + rng.normal(0., 0.2, n) / 3600.
+
+    # peak above background, as measured in the inverted scan
+    peak = np.where(real, np.asarray(sky['peak'])[index], rng.uniform(300., 1000., n))
+    background = sky_background(x_source, y_source, size, fog=fog, vignetting=vignetting)
+    flux_max = density_response(background + peak, saturation=saturation) - \
+               density_response(background, saturation=saturation)
+
+    gaia = np.where(real, np.asarray(sky['gaia'])[index], False)
+    elongation = np.where(real, np.asarray(sky['elongation'])[index], rng.uniform(1., 4., n))
+    flags = np.where(real, np.asarray(sky['flags'])[index], 0)
+    model_prediction = np.where(real, np.asarray(sky['model_prediction'])[index], rng.uniform(0., 1., n))
+
+    # annular bins, from the plate center out to the corners
+    center = (size - 1) / 2.
+    radius = np.hypot(x_source - center, y_source - center) / (center * np.sqrt(2.))
+    annular_bin = np.clip(1 + (radius * 9).astype(int), 1, 9)
+
+    rim = 0.02 * size
+    flag_rim = ((x_source < rim) | (x_source > size - 1 - rim) |
+                (y_source < rim) | (y_source > size - 1 - rim)).astype(int)
+
+    # APPLAUSE tables come sorted by source_id
+    order = np.lexsort((index, scan_id))
+    source_id = int(plate_id) * 10**8 + np.arange(n)
+
+    table = Table()
+    table['source_id'] = source_id
+    table['plate_id'] = np.full(n, int(plate_id))
+    table['scan_id'] = scan_id[order]
+    table['x_source'] = x_source[order]
+    table['y_source'] = y_source[order]
+    table['flux_max'] = flux_max[order]
+    table['elongation'] = elongation[order]
+    table['sextractor_flags'] = flags[order]
+    table['model_prediction'] = model_prediction[order]
+    table['flag_rim'] = flag_rim[order]
+    table['annular_bin'] = annular_bin[order]
+
+    table_calib = Table()
+    table_calib['source_id'] = source_id
+    table_calib['plate_id'] = np.full(n, int(plate_id))
+    table_calib['scan_id'] = scan_id[order]
+    table_calib['ra_icrs'] = ra[order]
+    table_calib['dec_icrs'] = dec[order]
+    gaia_id = np.where(real, 4 * 10**17 + index, 0)[order]
+    table_calib['gaiaedr3_id'] = MaskedColumn(gaia_id, mask=~gaia[order])
+    table_calib['sextractor_flags'] = flags[order]
+    table_calib['model_prediction'] = model_prediction[order]
+    table_calib['annular_bin'] = annular_bin[order]
+
+    return table, table_calib
+
+
+def write_sequence(directory, plate_ids=[101, 102], size=2000, density=2000., n_vanishing=20,
+                   offset=0.03, fwhm=3.5, seed=0):
+    '''
+    Writes a synthetic sequence of plates: a scan (S<plate>.fits) and the two
+    source tables (sources_<plate>.csv and sources_calib_<plate>.csv) for
+    each plate, plus file images.json with the plate ID to scan file name
+    map, and the truth table (synthetic_truth.fits) with the injected
+    vanishing sources.
+
+    Parameters:
+
+    directory   - output directory
+    plate_ids   - plate IDs in the sequence
+    size        - plate side, in pixels
+    density     - sources per square megapixel
+    n_vanishing - vanishing sources injected in each pair of consecutive plates
+    offset      - offset between consecutive pointings, in units of the plate side
+    fwhm        - stellar FWHM, in pixels
+    seed        - random seed
+
+    Returns:
+
+    dict with the scan file name of each plate (keyed by plate ID, as a string),
+    and the truth table: the vanishing sources, with the IDs of the plate
+    where each is last seen (plate_id_1) and of the next plate (next_plate_id)
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    plates = [str(plate_id) for plate_id in plate_ids]
+    wcss = [make_wcs(size, offset=(k * offset, k * offset / 2.)) for k in range(len(plates))]
+
+    sky = make_sky(wcss[0], size, density=density, margin=offset * len(plates) + 0.05, rng=rng)
+    for k in range(len(plates) - 1):
+        sky = add_vanishing(sky, wcss[k], wcss[k+1], size, k, n=n_vanishing, rng=rng)
+
+    last_plate = np.asarray(sky['last_plate'])
+
+    images = {}
+    for k, plate_id in enumerate(plates):
+        present = (last_plate < 0) | (last_plate >= k)
+
+        scan = render_plate(sky, present, wcss[k], size, fwhm=fwhm, rng=rng)
+
+        header = wcss[k].to_header()
+        header['PLATE_ID'] = int(plate_id)
+        header['DATE-AVG'] = '1960-01-01T%02d:%02d:00' % (k // 6, 10 * (k % 6))
+        header['EXPTIME'] = 600.
+
+        images[plate_id] = 'S%05d.fits' % int(plate_id)
+        fits.PrimaryHDU(scan, header=header).writeto(os.path.join(directory, images[plate_id]), overwrite=True)
+
+        table, table_calib = source_tables(sky, present, wcss[k], size, plate_id, fwhm=fwhm, rng=rng)
+        table.write(os.path.join(directory, 'sources_' + plate_id + '.csv'), format='ascii.csv', overwrite=True)
+        table_calib.write(os.path.join(directory, 'sources_calib_' + plate_id + '.csv'), format='ascii.csv',
+                          overwrite=True)
+
+        print("Plate ", plate_id, " - ", len(table), " sources", flush=True)
+
+    with open(os.path.join(directory, 'images.json'), 'w') as json_file:
+        json.dump(images, json_file, indent=1)
+
+    truth = sky[last_plate >= 0]
+    truth['plate_id_1'] = [int(plates[k]) for k in truth['last_plate']]
+    truth['next_plate_id'] = [int(plates[k+1]) for k in truth['last_plate']]
+    truth.write(os.path.join(directory, 'synthetic_truth.fits'), overwrite=True)
+
+    return images, truth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes a synthetic sequence of plate scans and source tables.")
+    parser.add_argument('directory', help="output directory")
+    parser.add_argument('--plates', type=int, nargs='+', default=[101, 102], help="plate IDs")
+    parser.add_argument('--size', type=int, default=2000, help="plate side, in pixels")
+    parser.add_argument('--density', type=float, default=2000., help="sources per square megapixel")
+    parser.add_argument('--vanishing', type=int, default=20, help="vanishing sources per pair of plates")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    write_sequence(args.directory, plate_ids=args.plates, size=args.size, density=args.density,
+                   n_vanishing=args.vanishing, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
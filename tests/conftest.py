@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# the modules live in the footprints directory, and are imported by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'footprints'))
+
+
+@pytest.fixture(scope='session')
+def synthetic_sequence(tmp_path_factory):
+    '''
+    A small synthetic sequence of three plates (see synthetic.py). Returns 
+    the directory, the full path names of the scans, keyed by plate ID, and 
+    the truth table with the injected vanishing sources.
+    '''
+    from synthetic import write_sequence
+
+    directory = str(tmp_path_factory.mktemp('synthetic'))
+    images, truth = write_sequence(directory, plate_ids=[101, 102, 103], size=800, n_vanishing=10)
+    images = {plate_id: os.path.join(directory, name) for plate_id, name in images.items()}
+
+    return directory, images, truth
+
+
+@pytest.fixture
+def synthetic_plates(synthetic_sequence, tmp_path, monkeypatch):
+    '''
+    Installs PlateProducts instances for the synthetic plates, with the 
+    sources read from the synthetic CSV files and a cache in a temporary
+    directory. Returns the list of plate IDs.
+    '''
+    library = pytest.importorskip('library')
+
+    directory, images, _ = synthetic_sequence
+    plates = sorted(images)
+
+    # full path names are left as they are by settings.fname
+    monkeypatch.setattr(library, 'images', dict(getattr(library, 'images', {})) | images, raising=False)
+
+    for plate_id in plates:
+        plate = library.PlateProducts(plate_id, cachepath=str(tmp_path))
+        plate._sources = library.read_sources(plate_id, cache=False, datapath=directory)
+        monkeypatch.setitem(library.plate_products, plate_id, plate)
+
+    yield plates
+
+    library.image_cache.clear()
@@ -0,0 +1,65 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def background2d(data, box_size, filter_size):
+    from astropy.stats import SigmaClip
+    from photutils.background import Background2D, MedianBackground
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return Background2D(65535. - data, box_size, filter_size=filter_size, sigma_clip=SigmaClip(sigma=3.),
+                            bkg_estimator=MedianBackground())
+
+
+@pytest.mark.parametrize('box_size, filter_size, shape', [(100, 3, None), (128, 3, None), (200, 1, None),
+                                                          (100, 3, (750, 630))])
+def test_tiled_background_matches_background2d(synthetic_sequence, box_size, filter_size, shape):
+    _, images, _ = synthetic_sequence
+    data = fits.getdata(images['101'])
+    if shape is not None:
+        data = data[:shape[0], :shape[1]]
+
+    reference = background2d(data, box_size, filter_size)
+    background, mesh = library.tiled_background(data, data.shape, box_size=box_size, filter_size=filter_size,
+                                                nproc=2)
+
+    assert np.array_equal(mesh, reference.background_mesh)
+    assert np.array_equal(background, reference.background)
+
+
+def test_tiled_background_with_excluded_boxes(synthetic_sequence):
+    _, images, _ = synthetic_sequence
+    data = fits.getdata(images['101']).astype(float)
+    data[150:420, 220:460] = np.nan
+
+    reference = background2d(data, 100, 3)
+    background, mesh = library.tiled_background(data, data.shape, box_size=100, filter_size=3, nproc=2)
+
+    assert np.array_equal(mesh, reference.background_mesh)
+    assert np.array_equal(background, reference.background)
+
+
+def test_get_background_methods_agree(synthetic_sequence, tmp_path):
+    _, images, _ = synthetic_sequence
+
+    data, background = library.get_background(images['101'], box_size=100, filter_size=3, method='tiled',
+                                              nproc=2, cachepath=str(tmp_path))
+    data_ref, background_ref = library.get_background(images['101'], box_size=100, filter_size=3,
+                                                      method='photutils', cachepath=str(tmp_path))
+
+    assert np.array_equal(background, background_ref)
+    assert np.array_equal(data, data_ref)
+
+    # read back from the cache
+    data_cached, _ = library.get_background(images['101'], box_size=100, filter_size=3, method='tiled',
+                                            cachepath=str(tmp_path))
+    assert isinstance(data_cached, np.memmap)
+    assert np.array_equal(data_cached, data)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+TOLERANCE = 5. / 3600.
+
+
+def random_table(n, rng, ra=150., dec=30., side=0.2):
+    table = Table()
+    table['source_id'] = np.arange(n, dtype=np.int64)
+    table['ra_icrs'] = ra + rng.uniform(0., side, n)
+    table['dec_icrs'] = dec + rng.uniform(0., side, n)
+    return table
+
+
+def pair_tables(seed=0):
+    '''
+    Two tables where about half of the first table's sources have a 
+    counterpart in the second, some of them close to the tolerance. 
+    The first table also has close pairs of its own.
+    '''
+    rng = np.random.default_rng(seed)
+    table1 = random_table(300, rng)
+
+    # close pairs in the first table
+    table1['ra_icrs'][150:180] = table1['ra_icrs'][100:130] + rng.uniform(-1.5, 1.5, 30) * TOLERANCE
+    table1['dec_icrs'][150:180] = table1['dec_icrs'][100:130] + rng.uniform(-1.5, 1.5, 30) * TOLERANCE
+
+    table2 = random_table(200, rng)
+    table2['ra_icrs'][:150] = table1['ra_icrs'][::2] + rng.uniform(-1.5, 1.5, 150) * TOLERANCE
+    table2['dec_icrs'][:150] = table1['dec_icrs'][::2] + rng.uniform(-1.5, 1.5, 150) * TOLERANCE
+
+    return table1, table2
+
+
+@pytest.mark.parametrize('method', ['loop', 'vectorized'])
+def test_tree_matches_worker(method):
+    table1, table2 = pair_tables()
+
+    matched, non_matched = library.cross_match(table1, table2)
+    matched_ref, non_matched_ref = library.cross_match(table1, table2, method=method)
+
+    assert 0 < len(matched) < len(table1)
+    assert np.array_equal(matched, matched_ref)
+    assert np.array_equal(non_matched, non_matched_ref)
+
+
+def test_tree_matches_worker2():
+    table1, _ = pair_tables()
+
+    # the vectorized Worker2 compares the last row with itself, so
+    # it always reports it as matched. The loop doesn't.
+    matched, _ = library.cross_match(table1)
+    matched_ref, _ = library.cross_match(table1, method='loop')
+
+    assert len(matched) > 0
+    assert np.array_equal(matched, matched_ref)
+
+
+def test_tree_matches_across_ra_zero():
+    rng = np.random.default_rng(1)
+    table1 = random_table(100, rng, ra=359.99, dec=10.)
+    table1['ra_icrs'] = table1['ra_icrs'] % 360.
+
+    # same sources, shifted by less than the tolerance
+    table2 = table1.copy()
+    table2['ra_icrs'] = (table2['ra_icrs'] + 0.5 * TOLERANCE) % 360.
+
+    matched, non_matched = library.cross_match(table1, table2)
+
+    assert len(matched) == len(table1)
+    assert len(non_matched) == 0
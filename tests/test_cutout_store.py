@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+
+
+def test_stored_cutouts_match_cutout2d(synthetic_sequence, synthetic_plates, tmp_path):
+    from astropy.nddata import NoOverlapError
+    from astropy.nddata.utils import Cutout2D
+
+    _, images, _ = synthetic_sequence
+
+    par = dict(settings.parameters['default'])
+    par['image1'] = images['101']
+    par['image2'] = images['102']
+    par['cutout_store'] = str(tmp_path / 'cutouts_101_102.fits')
+
+    # targets well inside the plate, close to its edges, and off the plate
+    image = library.get_image(images['101'])
+    ny, nx = image.data.shape
+    x = np.array([100., 400., 3., nx - 5., 400., -500.])
+    y = np.array([100., 500., 400., ny - 2., 2., -500.])
+    coords = image.wcs.pixel_to_world(x, y)
+
+    table = Table()
+    table['source_id'] = np.arange(len(x), dtype=np.int64) + 1
+    table['ra_icrs'] = coords.ra.deg
+    table['dec_icrs'] = coords.dec.deg
+
+    store = library.CutoutStore(library.write_cutout_store(table, par))
+    trimmed = missing = 0
+
+    for layer, image_key, size_key in library.CutoutStore.layers:
+        image = library.get_image(par[image_key])
+        size = 17 if size_key is None else float(par[size_key]) / 60. * u.deg
+
+        for row, source_id in enumerate(table['source_id']):
+            position = SkyCoord(ra=table['ra_icrs'][row], dec=table['dec_icrs'][row], unit='deg')
+            stored = store.get(layer, source_id)
+            try:
+                cutout = Cutout2D(image.data, position=position, size=size, wcs=image.wcs)
+            except NoOverlapError:
+                assert stored is None
+                missing += 1
+                continue
+
+            assert stored.shape == cutout.shape
+            assert np.array_equal(stored.data, cutout.data)
+            assert tuple(stored.origin_original) == tuple(cutout.origin_original)
+            assert np.allclose(stored.wcs.wcs.crpix, cutout.wcs.wcs.crpix)
+            trimmed += tuple(cutout.shape) != tuple(cutout.shape_input)
+
+    assert trimmed > 0 and missing > 0
+
+    store.close()
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def joined_table(scan_label='scan_id_1', offset=(1.0, -0.5), seed=0):
+    '''
+    Builds a table laid out like the join of the two APPLAUSE tables of a 
+    plate scanned twice: every source shows up once in each scan, with the 
+    second scan shifted by offset (delta RA * cos(Dec), delta Dec), in arcsec. 
+    Rows are shuffled, so row order does not follow the scans.
+    '''
+    rng = np.random.default_rng(seed)
+    n = 200
+    ra = rng.uniform(10., 11., n)
+    dec = rng.uniform(20., 21., n)
+
+    ra_2 = ra + offset[0] / 3600. / np.cos(np.radians(dec))
+    dec_2 = dec + offset[1] / 3600.
+
+    table = Table()
+    table['source_id'] = np.arange(2 * n)
+    table['ra_icrs'] = np.concatenate((ra, ra_2))
+    table['dec_icrs'] = np.concatenate((dec, dec_2))
+    table[scan_label] = np.concatenate((np.ones(n, dtype=int), np.full(n, 2, dtype=int)))
+    if scan_label == 'scan_id_1':
+        table['scan_id_2'] = table['scan_id_1']
+
+    return table[rng.permutation(2 * n)]
+
+
+@pytest.mark.parametrize('scan_label', ['scan_id_1', 'scan_id'])
+def test_offsets_point_from_first_to_second_scan(scan_label):
+    table = joined_table(scan_label=scan_label)
+
+    groups, offsets = library.find_duplicates(table)
+
+    assert len(groups) == len(table) // 2
+    assert np.allclose(offsets, [1.0, -0.5], atol=1.e-3)
+
+
+def test_offsets_without_scan_id_are_not_oriented():
+    table = joined_table()
+    table.remove_columns(['scan_id_1', 'scan_id_2'])
+
+    _, offsets = library.find_duplicates(table)
+
+    # pairs keep the row order, which was shuffled
+    assert not np.allclose(offsets, [1.0, -0.5], atol=1.e-3)
+
+
+def chain_table():
+    '''
+    Pairs of duplicates, plus 3-member chains a-b-c where a and c are not
+    within the tolerance of each other, in every row order, plus isolated
+    artifacts.
+    '''
+    rng = np.random.default_rng(1)
+    ra, dec = [], []
+
+    def add(positions):
+        for x in positions:
+            ra.append(10. + x[0] / 3600.)
+            dec.append(x[1] / 3600.)
+
+    for k in range(60):
+        center = (k * 100., rng.uniform(0., 1000.))
+        if k % 2 == 0:
+            members = [(0., 0.), (3., 0.)]
+        else:
+            # chain a-b-c, 4 arcsec between neighbors
+            members = [(-4., 0.), (0., 0.), (4., 0.)]
+        members = [members[m] for m in rng.permutation(len(members))]
+        add([(center[0] + x, center[1] + y) for x, y in members])
+
+    add([(k * 100. + 50., rng.uniform(0., 1000.)) for k in range(20)])
+
+    table = Table()
+    table['ra_icrs'] = ra
+    table['dec_icrs'] = dec
+    table['source_id'] = np.arange(len(ra))
+    return table
+
+
+def test_remove_scanner_artifacts_chains():
+    table = chain_table()
+
+    # rows with a later duplicate, as with the old Worker2 loop
+    reference = library.run_match_workers(table, method='loop')
+
+    groups, _ = library.find_duplicates(table)
+    assert sorted([len(g) for g in groups]) == [2] * 30 + [3] * 30
+
+    for kept in [library.remove_scanner_artifacts(table, groups=groups), library.remove_scanner_artifacts(table)]:
+        assert np.array_equal(kept['source_id'], table['source_id'][reference])
+
+    # a chain keeps two rows, or one when its middle member comes first
+    kept = set(library.remove_scanner_artifacts(table)['source_id'])
+    for g in groups:
+        if len(g) == 3:
+            middle = g[np.argsort(table['ra_icrs'][g])[1]]
+            assert len(kept & set(g)) == (1 if middle == g.min() else 2)
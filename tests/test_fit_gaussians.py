@@ -0,0 +1,54 @@
+import warnings
+
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def star_field(seed=0, n=40, size=400, noise=5.):
+    '''
+    Isolated Gaussian stars on a grid, with random FWHM and flux, plus
+    a few stars that are cut by the image edges. Returns the image, and
+    the positions of the interior and of the edge stars.
+    '''
+    from photutils.psf import CircularGaussianPRF
+
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0., noise, (size, size))
+    x, y = np.meshgrid(np.arange(size), np.arange(size))
+
+    positions = np.column_stack(((np.arange(n) % 8) * 45 + 30 + rng.uniform(-0.5, 0.5, n),
+                                 (np.arange(n) // 8) * 70 + 40 + rng.uniform(-0.5, 0.5, n)))
+    fwhm = rng.uniform(2.5, 5., n)
+    flux = 10**rng.uniform(3., 5., n)
+    for (x_0, y_0), f, w in zip(positions, flux, fwhm):
+        data += CircularGaussianPRF(flux=f, x_0=x_0, y_0=y_0, fwhm=w)(x, y)
+
+    edges = np.array([[2.3, 100.2], [size - 2.6, 200.4], [150.3, 1.1], [250.7, size - 3.2], [0.4, 300.5]])
+    for x_0, y_0 in edges:
+        data += CircularGaussianPRF(flux=2.e4, x_0=x_0, y_0=y_0, fwhm=3.5)(x, y)
+
+    return data, positions, edges
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_fit_gaussians_matches_fit_2dgaussian(seed):
+    data, positions, edges = star_field(seed)
+    xypos = np.vstack((positions, edges))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        _, phot = library.fit_fwhm(data, xypos=xypos, fwhm=4., fit_shape=11)
+    reference = phot.results
+
+    result = library.fit_gaussians(data, xypos, 4., 11)
+
+    assert result.colnames == library.fit_columns
+    assert np.allclose(result['fwhm_fit'], reference['fwhm_fit'], rtol=0., atol=1.e-3)
+    assert np.array_equal(result['flags'], reference['flags'])
+
+    # stars cut by the edges are flagged
+    assert np.all(result['flags'][:len(positions)] == 0)
+    assert np.all(result['flags'][len(positions):] & 1)
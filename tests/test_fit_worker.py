@@ -0,0 +1,56 @@
+import pickle
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+from test_fit_gaussians import star_field
+
+
+def star_table(positions):
+    table = Table()
+    table['source_id'] = np.arange(len(positions), dtype=np.int64)
+    table['x_source'] = positions[:, 0]
+    table['y_source'] = positions[:, 1]
+    return table
+
+
+def test_fit_worker_ships_stamps_only():
+    data, positions, edges = star_field()
+    table = star_table(np.vstack((positions, edges)))
+    par = {'fwhm_init': 4., 'fit_shape': 11}
+
+    worker = library.FitWorker('w0', data, table, 0, len(table), par)
+
+    assert worker.data is None
+    assert len(pickle.dumps(worker)) < data.nbytes / 10
+
+
+def test_fit_worker_matches_photutils_mode():
+    data, positions, edges = star_field()
+    table = star_table(np.vstack((positions, edges)))
+
+    def fit(par, nproc):
+        def factory(name, row_start, row_end):
+            return library.FitWorker(name, data, table, row_start, row_end, par)
+        return library.vstack(library.parallel_map(factory, table, nproc=nproc, chunk_size=10))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference = fit({'fwhm_init': 4., 'fit_shape': 11, 'fit_method': 'photutils'}, 1)
+
+    # fitted in worker processes, from the stamps
+    result = fit({'fwhm_init': 4., 'fit_shape': 11}, 2)
+
+    assert np.array_equal(result['source_id'], table['source_id'])
+    assert np.allclose(result['fwhm_fit'], reference['fwhm_fit'], rtol=0., atol=1.e-3)
+    assert np.array_equal(result['flags'], reference['flags'])
+
+    # same as fitting on the full image
+    full = library.fit_gaussians(data, np.vstack((positions, edges)), 4., 11)
+    assert np.array_equal(result['fwhm_fit'], full['fwhm_fit'])
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+
+
+def test_add_flux_ratio_matches_is_false_positive(synthetic_sequence, synthetic_plates):
+    _, images, truth = synthetic_sequence
+
+    par = dict(settings.parameters['default'])
+    par['image1'] = images['101']
+    par['image2'] = images['102']
+
+    plate_1 = library.get_plate_products('101')
+    plate_2 = library.get_plate_products('102')
+    table = library.remove_outsiders(None, plate_2.wcs, plate_1.sources, wcs_table=plate_1.wcs)
+
+    # sources that vanish after plate 101, and some that don't
+    vanishing = truth[truth['plate_id_1'] == 101]
+    index = library.SkyIndex(vanishing['ra'], vanishing['dec'])
+    rows = np.flatnonzero(index.has_match(np.asarray(table['ra_icrs']), np.asarray(table['dec_icrs'])))
+    table = table[np.union1d(rows, np.arange(0, len(table), 40))]
+
+    per_row = [library.is_false_positive(table, row_index, par) for row_index in range(len(table))]
+
+    table_ratio = library.add_flux_ratio(table.copy(), par)
+    batched = [library.is_false_positive(table_ratio, row_index, par) for row_index in range(len(table))]
+
+    assert batched == per_row
+    assert any(per_row) and not all(per_row)
@@ -0,0 +1,98 @@
+import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def write_scans(path, n=4, size=64):
+    file_names = []
+    for k in range(n):
+        file_name = str(path / ('scan_' + str(k) + '.fits'))
+        fits.PrimaryHDU(np.full((size, size), k, dtype=np.float32)).writeto(file_name)
+        file_names.append(file_name)
+    return file_names
+
+
+def test_image_cache_from_threads(tmp_path):
+    file_names = write_scans(tmp_path)
+
+    # room for two scans only, so threads keep evicting each other's entries
+    cache = library.ImageCache(max_bytes=2 * 64 * 64 * 4)
+
+    def read(k):
+        file_name = file_names[k % len(file_names)]
+        return file_name, cache.get(file_name)
+
+    with ThreadPool(8) as pool:
+        results = pool.map(read, range(400))
+
+    # every call got the entry for its own file, and the cache kept its budget
+    assert all([image.file_name == file_name for file_name, image in results])
+    assert len(cache._entries) <= len(file_names)
+    assert len(set(cache._entries)) == len(cache._entries)
+
+    cache.clear()
+    assert len(cache._entries) == 0
+
+
+def test_image_cache_opens_each_file_once(tmp_path, monkeypatch):
+    file_names = write_scans(tmp_path, n=2)
+    opened = Counter()
+
+    class SlowImage(library.CachedImage):
+        # widens the window between lookup and insert
+        def __init__(self, file_name):
+            opened[file_name] += 1
+            time.sleep(0.01)
+            super().__init__(file_name)
+
+    monkeypatch.setattr(library, 'CachedImage', SlowImage)
+    cache = library.ImageCache()
+
+    with ThreadPool(8) as pool:
+        results = pool.map(lambda k: cache.get(file_names[k % 2]), range(64))
+
+    assert opened == Counter(file_names)
+    assert len(set([id(image) for image in results])) == 2
+
+    cache.clear()
+
+
+def test_cached_image_data_mapped_once(tmp_path):
+    file_name = write_scans(tmp_path, n=1)[0]
+    image = library.ImageCache().get(file_name)
+
+    with ThreadPool(8) as pool:
+        arrays = pool.map(lambda _: image.data, range(64))
+
+    assert all([a is arrays[0] for a in arrays])
+    assert np.all(arrays[0] == 0)
+
+
+def test_evicted_entry_still_usable(tmp_path):
+    file_names = write_scans(tmp_path, n=3)
+
+    # room for one scan only
+    cache = library.ImageCache(max_bytes=64 * 64 * 4)
+
+    held = cache.get(file_names[0])
+    assert np.all(held.data == 0)
+
+    # both later reads evict the held entry, then the cache is cleared
+    cache.get(file_names[1]).data
+    cache.get(file_names[2]).data
+    assert file_names[0] not in cache._entries
+    cache.clear()
+
+    # the caller that holds it can still read it
+    assert np.all(held.data == 0)
+    assert held.wcs is not None
+    assert held.header['NAXIS1'] == 64
+
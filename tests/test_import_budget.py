@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+# Heavy modules (matplotlib, cv2, photutils, reproject, earthshadow, and 
+# some of astropy) are imported inside the functions of library that use 
+# them, so importing it (e.g. in pool workers, or in the matching stage) 
+# should stay cheap.
+BUDGET = 2.0
+
+
+def import_time(module, runs=3):
+    '''
+    Measures the time it takes to import a module in a fresh interpreter, 
+    using 'python -X importtime'.
+
+    Parameters:
+
+    module - name of the module to import
+    runs   - number of measurements; the best one is returned
+
+    Returns:
+
+    import time, in seconds, or None if the import failed
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            return None
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            # top-level entry has the module name indented by a single space
+            if len(fields) == 3 and fields[2] == ' ' + module:
+                seconds = int(fields[1]) / 1.e6
+                if best is None or seconds < best:
+                    best = seconds
+    return best
+
+
+def test_library_import_budget():
+    # library reads the telescope parameters through settings
+    pytest.importorskip('library')
+
+    seconds = import_time('library')
+
+    assert seconds is not None, "could not measure import time of library"
+    assert seconds < BUDGET, "import of library takes {:.2f} s - budget is {} s".format(seconds, BUDGET)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+
+
+def pair_parameters(plates):
+    par = dict(settings.parameters['default'])
+    return {plates[k] + ',' + plates[k+1]: par for k in range(len(plates) - 1)}
+
+
+def test_match_sequence_matches_pairwise(synthetic_plates):
+    plates = synthetic_plates
+    parameters = pair_parameters(plates)
+
+    results = library.match_sequence(plates, parameters=parameters)
+
+    for k in range(len(plates) - 1):
+        plate_id, next_plate_id = plates[k], plates[k+1]
+        plate = library.get_plate_products(plate_id)
+        next_plate = library.get_plate_products(next_plate_id)
+        par = parameters[plate_id + ',' + next_plate_id]
+
+        # same steps as find_mismatches.ipynb, one pair at a time
+        table = library.select_sources(plate.sources, par)
+        table = library.remove_outsiders(None, next_plate.wcs, table, wcs_table=plate.wcs)
+        table = library.remove_scanner_artifacts(table)
+        assert len(table) > 0
+        matched, _ = library.cross_match(table, next_plate.sources)
+
+        result = results[plate_id]
+        assert np.array_equal(result['table']['source_id'], table['source_id'])
+        assert np.array_equal(np.flatnonzero(result['present'][:, k+1]), matched)
+
+        # presence in every other plate of the sequence
+        for j, other_plate_id in enumerate(plates):
+            if j == k:
+                continue
+            matched, _ = library.cross_match(table, library.get_plate_products(other_plate_id).sources)
+            assert np.array_equal(np.flatnonzero(result['present'][:, j]), matched)
+
+        assert np.all(result['present'][:, k])
+
+    # the injected sources vanish after the plate they were last seen in
+    assert not np.all(results[plates[0]]['present'][:, 1])
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from astropy.table import Table, MaskedColumn, join
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def source_tables(seed=0, shuffle=False):
+    rng = np.random.default_rng(seed)
+
+    # partial overlap between the two tables' keys
+    keys1 = np.sort(rng.choice(1000, 300, replace=False)) + 10100000000
+    keys2 = np.sort(rng.choice(1000, 400, replace=False)) + 10100000000
+
+    table1 = Table()
+    table1['source_id'] = keys1
+    table1['ra_icrs'] = rng.uniform(0., 1., len(keys1))
+    table1['scan_id'] = rng.integers(1, 3, len(keys1))
+    table1['name'] = ['s' + str(k) for k in keys1]
+
+    table2 = Table()
+    table2['source_id'] = keys2
+    table2['scan_id'] = rng.integers(1, 3, len(keys2))
+    table2['gaiaedr3_id'] = MaskedColumn(rng.integers(0, 10**9, len(keys2)), mask=rng.uniform(size=len(keys2)) < 0.3)
+    table2['flux_max'] = rng.uniform(0., 1.e4, len(keys2))
+
+    if shuffle:
+        table1 = table1[rng.permutation(len(table1))]
+        table2 = table2[rng.permutation(len(table2))]
+
+    return table1, table2
+
+
+def assert_same_table(result, reference):
+    assert result.colnames == reference.colnames
+    assert len(result) == len(reference)
+
+    # astropy's join sorts by key
+    result = result[np.argsort(result['source_id'])]
+    for name in reference.colnames:
+        assert result[name].dtype == reference[name].dtype
+        assert np.array_equal(np.ma.getmaskarray(result[name]), np.ma.getmaskarray(reference[name]))
+        assert np.array_equal(np.asarray(result[name]), np.asarray(reference[name]))
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_merge_join_matches_join(shuffle):
+    table1, table2 = source_tables(shuffle=shuffle)
+
+    assert_same_table(library.merge_join(table1, table2), join(table1, table2, keys='source_id'))
+
+
+def test_merge_join_with_repeated_keys():
+    table1, table2 = source_tables()
+    table2['source_id'][1] = table2['source_id'][0]
+
+    assert_same_table(library.merge_join(table1, table2), join(table1, table2, keys='source_id'))
+
+
+def test_read_sources_matches_join(synthetic_sequence, tmp_path):
+    directory, _, _ = synthetic_sequence
+
+    # same join as in find_mismatches.ipynb
+    table_src = Table.read(directory + '/sources_101.csv', format='ascii.csv')
+    table_calib = Table.read(directory + '/sources_calib_101.csv', format='ascii.csv')
+    reference = join(table_calib, table_src, keys='source_id')
+
+    table = library.read_sources('101', cache=False, datapath=directory)
+    assert_same_table(table, reference)
+
+    # the cached table (written by the first read, and read back by the 
+    # second) has dtypes downcast where that is lossless
+    for _ in range(2):
+        cached = library.read_sources('101', cachepath=str(tmp_path), datapath=directory)
+        assert cached.colnames == reference.colnames
+        for name in reference.colnames:
+            assert np.array_equal(np.ma.getmaskarray(cached[name]), np.ma.getmaskarray(table[name]))
+            assert np.array_equal(np.asarray(cached[name]), np.asarray(table[name]))
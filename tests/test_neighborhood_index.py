@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def old_neighborhood(table_stars, cutout, image_wcs, target_flux_max, flux_range):
+    # selection done by extract_cutout_neighborhood before the index
+    table = library.remove_outsiders(cutout.data, cutout.wcs, table_stars, wcs_table=image_wcs)
+    table = table[table['flux_max'] < (target_flux_max * (1. + flux_range))]
+    return table[table['flux_max'] > (target_flux_max * (1. - flux_range))]
+
+
+@pytest.mark.parametrize('flux_range', [0.1, 0.5, 10.])
+def test_neighborhood_index_matches_remove_outsiders(synthetic_sequence, synthetic_plates, flux_range):
+    _, images, _ = synthetic_sequence
+
+    plate = library.get_plate_products('101')
+    image = library.get_image(images['101'])
+    table_stars = plate.sources
+
+    index = library.NeighborhoodIndex(table_stars, bucket_size=64)
+
+    # targets all over the plate, including its corners and edges
+    targets = table_stars[np.argsort(table_stars['x_source'] + table_stars['y_source'])][::150]
+    assert len(targets) > 10
+
+    found = 0
+
+    for row_index in range(len(targets)):
+        cutout, table_neighborhood = library.extract_cutout_neighborhood(targets, index, image.data, image.wcs,
+                                                                         2. / 60. * u.deg, flux_range, row_index)
+
+        reference = old_neighborhood(table_stars, cutout, image.wcs, targets['flux_max'][row_index], flux_range)
+
+        assert np.array_equal(table_neighborhood['source_id'], reference['source_id'])
+        found += len(reference)
+
+    assert found > len(targets)
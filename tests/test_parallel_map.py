@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from astropy.table import Table, vstack
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+class RowWorker:
+    # picklable worker that doubles its range of a column
+    def __init__(self, name, values, index_init, index_end):
+        self.name = name
+        self.values = values[index_init:index_end]
+
+    def __call__(self):
+        return Table({'value': self.values * 2.})
+
+
+class Factory:
+    def __init__(self, values):
+        self.values = values
+
+    def __call__(self, name, index_init, index_end):
+        return RowWorker(name, self.values, index_init, index_end)
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(19)
+    return Table({'value': rng.normal(size=1001)})
+
+
+def serial(table):
+    # reference: a single worker over the whole table
+    return RowWorker('w0', table['value'].data, 0, len(table))()
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+@pytest.mark.parametrize('chunk_size', [None, 1, 7, 5000])
+def test_parallel_map_matches_serial(table, backend, chunk_size):
+    results = library.parallel_map(Factory(table['value'].data), table, nproc=3,
+                                   chunk_size=chunk_size, backend=backend)
+
+    assert np.array_equal(vstack(results)['value'], serial(table)['value'])
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel_map_open_pool(table, backend):
+    pool_class = library.Pool if backend == 'process' else library.ThreadPool
+
+    with pool_class(2) as pool:
+        for _ in range(2):
+            results = library.parallel_map(Factory(table['value'].data), table, nproc=2,
+                                           chunk_size=50, pool=pool)
+            assert np.array_equal(vstack(results)['value'], serial(table)['value'])
+
+
+@pytest.mark.parametrize('backend', ['serial', 'process'])
+def test_parallel_map_empty_table(backend):
+    empty = Table({'value': np.zeros(0)})
+
+    results = library.parallel_map(Factory(empty['value'].data), empty, nproc=4, backend=backend)
+
+    # one empty worker, so callers always have a result to stack
+    assert len(results) == 1
+    assert len(vstack(results)) == 0
+
+
+def test_parallel_map_unknown_backend(table):
+    with pytest.raises(ValueError):
+        library.parallel_map(Factory(table['value'].data), table, nproc=2, backend='mpi')
@@ -0,0 +1,98 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+pipeline = pytest.importorskip('pipeline')
+
+import settings
+
+
+# pair products written by the stages
+OUTPUTS = ['table_matched', 'table_non_matched', 'table_psf_matched', 'table_psf_nonmatched',
+           'table_candidates', 'cutout_store', 'profile_bank', 'reference_store']
+
+
+def make_context(key, images, directory, monkeypatch):
+    '''
+    RunContext for a pair of synthetic plates, with its products written
+    to a temporary directory.
+    '''
+    monkeypatch.setattr(settings, 'images', dict(getattr(settings, 'images', {})) | images, raising=False)
+
+    ctx = pipeline.RunContext(key, nproc=2)
+    for name in OUTPUTS:
+        # full path names are left as they are by settings.fname
+        ctx.par[name] = os.path.join(directory, ctx.par[name])
+
+    return ctx
+
+
+def notebook_mismatches(ctx):
+    # steps in notebook find_mismatches.ipynb
+    table_1 = library.get_plate_products(ctx.plate_id_1).sources
+    table_2 = library.get_plate_products(ctx.plate_id_2).sources
+
+    table_1copy = library.select_sources(table_1, ctx.par)
+
+    wcs_table = WCS(fits.getheader(ctx.image1))
+    with fits.open(ctx.image2) as f:
+        table_1copy = library.remove_outsiders(f[0].data, WCS(f[0].header), table_1copy, wcs_table=wcs_table)
+
+    groups, _ = library.find_duplicates(table_1copy)
+    table_1copy = library.remove_scanner_artifacts(table_1copy, groups=groups)
+
+    matched, _ = library.cross_match(table_1copy, table_2.copy())
+
+    return library.split_matches(table_1copy, matched, ctx.plate_id_2)
+
+
+def test_find_mismatches_matches_notebook(synthetic_sequence, synthetic_plates, tmp_path, monkeypatch):
+    _, images, _ = synthetic_sequence
+
+    ctx = make_context('101,102', images, str(tmp_path), monkeypatch)
+
+    table_matched, table_non_matched = pipeline.find_mismatches(ctx)
+    reference_matched, reference_non_matched = notebook_mismatches(ctx)
+
+    assert len(table_matched) > 0 and len(table_non_matched) > 0
+
+    for table, reference, name in [(table_matched, reference_matched, 'table_matched'),
+                                   (table_non_matched, reference_non_matched, 'table_non_matched')]:
+        assert np.array_equal(table['source_id'], reference['source_id'])
+        assert np.array_equal(table['next_plate_id'], reference['next_plate_id'])
+
+        # the notebooks downstream read the products back from the files
+        written = Table.read(ctx.path(name), format='fits')
+        assert np.array_equal(written['source_id'], reference['source_id'])
+
+
+def test_run_context(synthetic_sequence, tmp_path, monkeypatch):
+    _, images, _ = synthetic_sequence
+
+    ctx = make_context('101,102', images, str(tmp_path), monkeypatch)
+    ctx.seq_key = 'seq81'
+
+    assert (ctx.plate_id_1, ctx.plate_id_2) == ('101', '102')
+    assert ctx.image1 == images['101'] and ctx.image2 == images['102']
+
+    # notebooks run for the pair find it in the environment, not in dataset.json
+    env = ctx.environment()
+    assert env['FOOTPRINTS_DATASET'] == '101,102'
+    assert env['FOOTPRINTS_SEQUENCE'] == 'seq81'
+
+    # contexts are handed to the processes that run pairs
+    copy = pickle.loads(pickle.dumps(ctx))
+    assert copy.key == ctx.key and copy.par == ctx.par
+
+    # parameters are resolved per pair, and don't leak between pairs
+    other = make_context('102,103', images, str(tmp_path), monkeypatch)
+    other.par['max_fwhm'] = -1.
+    assert ctx.par['max_fwhm'] != other.par['max_fwhm']
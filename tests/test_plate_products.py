@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+
+
+def test_plate_products_shared(synthetic_plates):
+    # both pairs a plate belongs to get the same instance
+    assert library.get_plate_products(102) is library.get_plate_products('102')
+
+    plate = library.get_plate_products('102')
+    assert plate.sources is plate.sources
+    assert plate.wcs is library.get_image(plate.image_file).wcs
+
+
+def test_selected_sources(synthetic_plates):
+    plate = library.get_plate_products('101')
+    par = dict(settings.parameters['default'])
+
+    selected = plate.selected_sources(par)
+    reference = library.select_sources(plate.sources, par)
+
+    assert np.array_equal(selected['source_id'], reference['source_id'])
+
+    # kept for each set of selection parameters
+    assert plate.selected_sources(dict(par)) is selected
+    assert plate.selected_sources(par | {'max_fwhm': 1.e6}) is selected
+
+    other = plate.selected_sources(par | {'elongation': 1.1})
+    assert other is not selected
+    assert np.array_equal(other['source_id'], library.select_sources(plate.sources, par | {'elongation': 1.1})['source_id'])
+
+
+def test_background_reused(synthetic_plates, tmp_path):
+    plate = library.get_plate_products('101')
+
+    data, background = plate.background(nproc=2)
+    assert plate.background() is plate._background
+
+    reference_data, reference_background = library.get_background(plate.image_file, box_size=2000, filter_size=101,
+                                                                  sigma=3., method='tiled', nproc=2,
+                                                                  cachepath=str(tmp_path / 'reference'))
+    assert np.array_equal(data, reference_data)
+    assert np.array_equal(background, reference_background)
+
+    # released products are read back from the on-disk cache
+    plate.release()
+    assert plate._background is None and plate._sources is None
+
+    data_again, _ = plate.background()
+    assert np.array_equal(data_again, data)
+    assert isinstance(data_again, np.memmap)
+
+
+def test_release_plate_products(synthetic_plates):
+    for plate_id in synthetic_plates:
+        library.get_plate_products(plate_id).sources
+
+    plate = library.plate_products['101']
+    library.release_plate_products(101)
+
+    assert '101' not in library.plate_products
+    assert plate._sources is None
+    assert '102' in library.plate_products
+
+    library.release_plate_products()
+    assert len(library.plate_products) == 0
+
+
+def test_reference_fits_reused(synthetic_plates, monkeypatch):
+    plate = library.get_plate_products('101')
+    par = dict(settings.parameters['default'])
+
+    data, _ = plate.background(nproc=2)
+
+    table = plate.selected_sources(par)
+    table = table[~table['gaiaedr3_id'].mask]
+    table.sort('flux_max', reverse=True)
+    table = library.remove_outsiders(data, plate.wcs, table)
+
+    monkeypatch.setattr(library.profiler, 'records', [])
+
+    fits_1, strata_1 = plate.reference_fits(table, par, nproc=2, batch_size=20, min_stars=10)
+    assert len(fits_1) > 0
+    assert os.path.exists(os.path.join(plate.cachepath, settings.get_reference_store('101')))
+
+    # the pair that comes next in the sequence (or a new process) finds
+    # every star in the reference store, and fits none
+    library.release_plate_products()
+    library.profiler.records = []
+
+    plate = library.PlateProducts('101', cachepath=plate.cachepath)
+    fits_2, strata_2 = plate.reference_fits(table, par, nproc=2, batch_size=20, min_stars=10)
+
+    assert [r for r in library.profiler.records if r['step'] == 'reference_batch'] == []
+    assert np.array_equal(fits_1['source_id'], fits_2['source_id'])
+    assert np.allclose(fits_1['fwhm_fit'], fits_2['fwhm_fit'], equal_nan=True)
+    assert np.array_equal(strata_1['n_fitted'], strata_2['n_fitted'])
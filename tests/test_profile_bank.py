@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+
+
+@pytest.fixture
+def plate_data(synthetic_sequence, synthetic_plates, tmp_path):
+    _, images, _ = synthetic_sequence
+    data, _ = library.get_background(images['101'], box_size=100, filter_size=3, nproc=2, cachepath=str(tmp_path))
+    table = library.select_sources(library.get_plate_products('101').sources, settings.parameters['default'])
+    return np.array(data), table
+
+
+def test_profile_bank_matches_radial_profiles(plate_data, tmp_path):
+    data, table = plate_data
+    edge_radii = np.arange(25) / 2.
+
+    bank = library.build_profile_bank(data, table, edge_radii)
+    bank_processes = library.build_profile_bank(data, table, edge_radii, nproc=2)
+
+    xypos = np.column_stack([table['x_source'], table['y_source']])
+    reference = np.array([library.normalize_profile(profile) 
+                          for profile in library.radial_profiles(data, xypos, edge_radii)])
+
+    assert len(bank) == len(table) > 0
+    assert np.array_equal(bank.profiles, reference, equal_nan=True)
+    assert np.array_equal(bank_processes.profiles, reference, equal_nan=True)
+
+    # lookups by source_id, in any order; unknown IDs give NaN rows
+    rows = np.array([5, 0, 3])
+    profiles = bank.get(np.append(table['source_id'][rows], -1))
+    assert np.array_equal(profiles[:3], reference[rows], equal_nan=True)
+    assert np.all(np.isnan(profiles[3]))
+
+    # saved with the pair products, and reused only for the same stars, radii and image
+    file_name = str(tmp_path / 'profile_bank.fits')
+    bank.write(file_name)
+    bank_read = library.read_profile_bank(file_name)
+
+    assert np.array_equal(bank_read.profiles, bank.profiles, equal_nan=True)
+    assert bank_read.matches(table, edge_radii, library.data_fingerprint(data))
+    assert not bank_read.matches(table[1:], edge_radii, library.data_fingerprint(data))
+    assert not bank_read.matches(table, edge_radii[:-1], library.data_fingerprint(data))
+    assert not bank_read.matches(table, edge_radii, library.data_fingerprint(data + 1.))
+
+
+def test_profile_worker_with_bank(plate_data):
+    from astropy import units as u
+
+    data, table = plate_data
+    edge_radii = np.arange(25) / 2.
+    wcs = library.get_image(library.get_plate_products('101').image_file).wcs
+
+    table_match = table[~table['gaiaedr3_id'].mask]
+    table_match.sort('flux_max', reverse=True)
+    index = library.NeighborhoodIndex(table_match)
+    bank = library.build_profile_bank(data, table_match, edge_radii)
+
+    targets = table[::25]
+    targets['x_fit'] = targets['x_source']
+    targets['y_fit'] = targets['y_source']
+
+    cutout_size = 1. / 60. * u.deg
+
+    # the cutout truncates the profiles of some neighbors
+    truncated = 0
+    for row_index in range(len(targets)):
+        cutout, neighborhood = library.extract_cutout_neighborhood(targets, index, data, wcs, cutout_size, 0.1, 
+                                                                   row_index)
+        xypos = library.cutout_positions(neighborhood, cutout)
+        truncated += np.count_nonzero(~library.profile_box_inside(xypos, cutout.data.shape, edge_radii))
+    assert truncated > 0
+
+    def run(profile_bank):
+        worker = library.ProfileWorker('w0', targets, index, data, wcs, cutout_size, edge_radii, 0, len(targets),
+                                       4., 11, profile_bank=profile_bank)
+        return worker()['profile_diff']
+
+    # the bank gives the same results as profiles built over each cutout
+    with_bank = run(bank)
+    assert np.count_nonzero(np.isfinite(with_bank)) > 10
+    np.testing.assert_allclose(with_bank, run(None), rtol=1.e-9, atol=1.e-12, equal_nan=True)
@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+pipeline = pytest.importorskip('pipeline')
+
+
+class BusyWorker:
+    # burns some CPU time, and returns its rows
+    def __init__(self, name, index_init, index_end):
+        self.name = name
+        self.rows = np.arange(index_init, index_end)
+
+    def __call__(self):
+        total = 0.
+        for _ in range(100000):
+            total += 1.
+        return Table({'row': self.rows})
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    # a clean profiler, in place of the process-wide one
+    profiler = library.Profiler()
+    monkeypatch.setattr(library, 'profiler', profiler)
+    monkeypatch.setattr(pipeline, 'profiler', profiler)
+    return profiler
+
+
+def test_step_records(profiler):
+    with profiler.labelled(pair='101,102'):
+        with profiler.step('select', rows_in=10) as record:
+            record['rows_out'] = 4
+
+    record = profiler.records[0]
+    assert record['step'] == 'select' and record['level'] == 'step'
+    assert record['pair'] == '101,102'
+    assert (record['rows_in'], record['rows_out']) == (10, 4)
+    assert record['wall'] >= 0. and record['cpu'] >= 0. and record['peak_rss'] > 0.
+    assert record['pid'] == os.getpid()
+
+    # labels don't outlive their context
+    with profiler.step('other'):
+        pass
+    assert 'pair' not in profiler.records[1]
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_worker_records(profiler, backend):
+    with profiler.step('busy', rows_in=100) as record:
+        results = library.parallel_map(BusyWorker, 100, nproc=2, chunk_size=25, backend=backend)
+
+    workers = [r for r in profiler.records if r['level'] == 'worker']
+    assert len(workers) == len(results) == 4
+    assert sorted([r['worker'] for r in workers]) == ['w0', 'w1', 'w2', 'w3']
+    assert all([r['step'] == 'BusyWorker' and r['rows_in'] == 25 and r['rows_out'] == 25 for r in workers])
+
+    # the step's CPU time includes its workers, in threads or in pool processes,
+    # and the CPU time of threads is not counted twice
+    worker_cpu = sum([r['cpu'] for r in workers])
+    assert record['cpu'] >= 0.9 * worker_cpu
+    if backend == 'process':
+        assert all([r['pid'] != os.getpid() for r in workers])
+        assert profiler.child_cpu == pytest.approx(worker_cpu)
+    else:
+        assert profiler.child_cpu == 0.
+
+
+def test_recording_is_scoped(profiler):
+    with profiler.step('sequence', level='stage') as outer:
+        with profiler.recording() as records:
+            assert profiler.child_cpu == 0.
+            library.parallel_map(BusyWorker, 100, nproc=2, chunk_size=50)
+            inner_cpu = profiler.child_cpu
+
+        # a second run (e.g. the next pair in a reused process) starts clean
+        with profiler.recording() as more_records:
+            assert profiler.child_cpu == 0.
+
+    assert len(records) == 2 and more_records == []
+    assert [r['step'] for r in profiler.records] == ['sequence']
+    assert profiler.child_cpu == pytest.approx(inner_cpu)
+    assert outer['cpu'] >= inner_cpu
+
+
+def test_profile_report(profiler, tmp_path, monkeypatch):
+    records = [{'pair': '101,102', 'level': 'stage', 'step': 'find_mismatches', 'wall': 1., 'cpu': 2., 
+                'peak_rss': 100., 'start': 1.},
+               {'pair': '101,102', 'level': 'stage', 'step': 'psf_analysis', 'wall': 3., 'cpu': 5., 
+                'peak_rss': 300., 'start': 2.},
+               {'pair': '101,102', 'level': 'worker', 'step': 'FitWorker', 'wall': 1., 'cpu': 1., 
+                'peak_rss': 400., 'start': 2.5},
+               {'pair': '102,103', 'level': 'stage', 'step': 'psf_analysis', 'wall': 4., 'cpu': 4., 
+                'peak_rss': 200., 'start': 0.5},
+               {'level': 'stage', 'step': 'prepare_plates', 'wall': 0.5, 'cpu': 0.5, 'peak_rss': 50., 
+                'start': 0.}]
+
+    summary = pipeline.profile_summary(records)
+
+    assert summary.colnames == ['pair', 'find_mismatches', 'psf_analysis', 'prepare_plates', 'wall', 
+                                'process_cpu', 'peak_rss']
+    assert list(summary['pair']) == ['101,102', '102,103', 'sequence']
+    assert list(summary['psf_analysis']) == [3., 4., 0.]
+    assert list(summary['wall']) == [4., 4., 0.5]
+    assert list(summary['process_cpu']) == [7., 4., 0.5]
+    assert list(summary['peak_rss']) == [400., 200., 50.]
+
+    monkeypatch.setattr(pipeline, 'RESULTS', str(tmp_path))
+    pipeline.write_profile_report('seq81', records)
+
+    base_name = os.path.join(str(tmp_path), 'profile_' + pipeline.tel_suffix + '_seq81')
+    with open(base_name + '.json') as json_file:
+        report = json.load(json_file)
+    assert [r['start'] for r in report['records']] == sorted([r['start'] for r in records])
+
+    assert len(Table.read(base_name + '.csv', format='ascii.csv')) == len(records)
+    assert len(Table.read(base_name + '_summary.csv', format='ascii.csv')) == 3
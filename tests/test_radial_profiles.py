@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def test_radial_profiles_match_radial_profile():
+    from photutils.profiles import RadialProfile
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(100., 10., (80, 90))
+    data[30:33, 40:42] = np.nan
+
+    edge_radii = np.arange(25) / 2.
+
+    # positions inside, on pixel centers and corners, next to masked pixels, 
+    # near and beyond the edges, and off the image
+    xypos = np.array([[45.3, 40.7], [44.5, 40.5], [45., 40.], [40.1, 31.2], [2.2, 3.7], [88.6, 78.9], 
+                      [-4., 40.], [-15., -15.]])
+
+    profiles = library.radial_profiles(data, xypos, edge_radii)
+    assert profiles.shape == (len(xypos), len(edge_radii) - 1)
+
+    for row, xycen in enumerate(xypos):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            reference = RadialProfile(data, xycen, edge_radii).profile
+
+        assert np.array_equal(np.isnan(profiles[row]), np.isnan(reference))
+        assert np.allclose(profiles[row], reference, rtol=0., atol=1.e-9, equal_nan=True)
+
+
+def test_circle_overlaps_match_photutils():
+    from photutils.geometry import circular_overlap_grid
+
+    rng = np.random.default_rng(1)
+
+    # pixel centers, edges and corners, and arbitrary offsets
+    for dx, dy in [(0., 0.), (0.5, 0.5), (0.5, 0.), *rng.uniform(-0.5, 0.5, (20, 2))]:
+        edges = np.arange(-14.5, 15.) - np.array([[dx], [dy]])
+        for radius in [0., 0.3, 0.5, 0.7071, 1., 2.5, 7.25, 12., 20.]:
+            corners = library.circle_corner_area(edges[0][None, :], edges[1][:, None], radius)
+            weights = corners[1:, 1:] - corners[1:, :-1] - corners[:-1, 1:] + corners[:-1, :-1]
+
+            reference = np.zeros_like(weights)
+            if radius > 0.:
+                reference = circular_overlap_grid(edges[0][0], edges[0][-1], edges[1][0], edges[1][-1], 
+                                                  29, 29, radius, 1, 1)
+
+            assert np.allclose(weights, reference, rtol=0., atol=1.e-10)
+
+
+def test_radial_profiles_in_chunks():
+    from photutils.profiles import RadialProfile
+
+    rng = np.random.default_rng(2)
+    data = rng.normal(100., 10., (120, 120))
+    edge_radii = np.arange(25) / 2.
+
+    # more positions than are done at once
+    xypos = rng.uniform(-5., 125., (150, 2))
+
+    profiles = library.radial_profiles(data, xypos, edge_radii)
+
+    for row in [0, 63, 64, 65, 127, 128, 149]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            reference = RadialProfile(data, xypos[row], edge_radii).profile
+
+        assert np.allclose(profiles[row], reference, rtol=0., atol=1.e-9, equal_nan=True)
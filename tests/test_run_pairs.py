@@ -0,0 +1,139 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+pipeline = pytest.importorskip('pipeline')
+
+from test_pipeline_runner import make_context
+
+
+class FakeContext:
+    # what run_pairs needs from a RunContext
+    def __init__(self, key, nproc=2, nbytes=1):
+        self.key = key
+        self.nproc = nproc
+        self.nbytes = nbytes
+
+    def memory_estimate(self):
+        return self.nbytes
+
+
+def fake_run_pair_profiled(ctx, tables=None, html=False, force=False, release_all=False):
+    # stands for run_pair_profiled in the pool processes (which are forked)
+    if ctx.key == 'fail':
+        raise RuntimeError("pair failed")
+
+    start = time.time()
+    time.sleep(0.3)
+    return (ctx.key, tables), [{'pair': ctx.key, 'start': start, 'end': time.time(), 'pid': os.getpid()}]
+
+
+def max_running(records):
+    # largest number of pairs that ran at the same time
+    events = sorted([(r['start'], 1) for r in records] + [(r['end'], -1) for r in records])
+    return max(np.cumsum([e[1] for e in events]))
+
+
+@pytest.fixture
+def fake_pairs(monkeypatch):
+    monkeypatch.setattr(pipeline, 'run_pair_profiled', fake_run_pair_profiled)
+    monkeypatch.setattr(pipeline.profiler, 'records', [])
+
+
+def test_run_pairs_cpu_budget(fake_pairs):
+    contexts = [FakeContext(str(i), nproc=2) for i in range(5)]
+
+    results = pipeline.run_pairs(contexts, {'3': 'tables'}, cpus=4, memory=100)
+
+    # results in the order of the contexts, whatever order pairs finished in
+    assert results == [('0', None), ('1', None), ('2', None), ('3', 'tables'), ('4', None)]
+
+    records = pipeline.profiler.records
+    assert sorted([r['pair'] for r in records]) == ['0', '1', '2', '3', '4']
+    assert max_running(records) == 2
+    assert all([r['pid'] != os.getpid() for r in records])
+
+
+def test_run_pairs_memory_budget(fake_pairs):
+    contexts = [FakeContext(str(i), nproc=1, nbytes=60) for i in range(3)]
+
+    results = pipeline.run_pairs(contexts, cpus=4, memory=100)
+
+    assert [r[0] for r in results] == ['0', '1', '2']
+    assert max_running(pipeline.profiler.records) == 1
+
+
+def test_run_pairs_oversized_pair(fake_pairs):
+    # a pair that doesn't fit the budget still runs, on its own
+    contexts = [FakeContext('0', nproc=1, nbytes=1), FakeContext('1', nproc=1, nbytes=500),
+                FakeContext('2', nproc=1, nbytes=1)]
+
+    results = pipeline.run_pairs(contexts, cpus=4, memory=100)
+
+    assert [r[0] for r in results] == ['0', '1', '2']
+
+    records = {r['pair']: r for r in pipeline.profiler.records}
+    for key in ['0', '2']:
+        assert records[key]['end'] <= records['1']['start'] or records[key]['start'] >= records['1']['end']
+
+
+def test_run_pairs_failed_pair(fake_pairs):
+    contexts = [FakeContext('0'), FakeContext('fail'), FakeContext('2')]
+
+    results = pipeline.run_pairs(contexts, cpus=8, memory=100)
+
+    assert results == [('0', None), None, ('2', None)]
+
+
+def test_run_pairs_serial(fake_pairs):
+    # with no room for two pairs, they run one after the other in this process
+    contexts = [FakeContext('0', nproc=4), FakeContext('1', nproc=4)]
+
+    results = pipeline.run_pairs(contexts, cpus=2, memory=100)
+
+    assert results == [('0', None), ('1', None)]
+    assert [c.nproc for c in contexts] == [2, 2]
+    assert all([r['pid'] == os.getpid() for r in pipeline.profiler.records])
+
+
+def test_memory_estimate_counts_cached_scans(synthetic_sequence, tmp_path, monkeypatch):
+    _, images, _ = synthetic_sequence
+
+    ctx = make_context('101,102', images, str(tmp_path), monkeypatch)
+
+    header = fits.getheader(images['101'])
+    npix = header['NAXIS1'] * header['NAXIS2']
+    scans = sum([fits.getdata(images[plate_id]).nbytes for plate_id in ['101', '102']])
+
+    assert ctx.memory_estimate() == npix * (3 * 8 + 2) + scans
+
+    # no more than the image cache can hold
+    monkeypatch.setattr(library.image_cache, 'max_bytes', scans // 4)
+    assert ctx.memory_estimate() == npix * (3 * 8 + 2) + scans // 4
+
+
+def test_run_pair_profiled_releases_scans(synthetic_sequence, tmp_path, monkeypatch):
+    _, images, _ = synthetic_sequence
+
+    ctx = make_context('101,102', images, str(tmp_path), monkeypatch)
+
+    def run_pair(ctx, tables=None, html=False, force=False):
+        library.get_image(ctx.image1).data
+        library.get_image(ctx.image2).data
+        return 'candidates'
+
+    monkeypatch.setattr(pipeline, 'run_pair', run_pair)
+
+    # the process that runs the whole sequence keeps its scans...
+    assert pipeline.run_pair_profiled(ctx)[0] == 'candidates'
+    assert library.image_cache.nbytes > 0
+
+    # ...but processes that run pairs concurrently are reused between pairs
+    assert pipeline.run_pair_profiled(ctx, release_all=True)[0] == 'candidates'
+    assert library.image_cache.nbytes == 0
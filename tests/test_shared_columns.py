@@ -0,0 +1,41 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+from test_cross_match import pair_tables
+
+
+def test_shared_columns_round_trip():
+    table = Table({'source_id': np.arange(10, dtype=np.int64), 'ra_icrs': np.linspace(0., 1., 10),
+                   'flag': np.arange(10) % 2 == 0})
+
+    with library.SharedColumns(table, ['source_id', 'ra_icrs', 'flag']) as shared:
+        # what a worker process gets
+        attached = pickle.loads(pickle.dumps(shared))
+
+        assert len(attached) == len(table)
+        assert attached.colnames == ['source_id', 'ra_icrs', 'flag']
+        for name in attached.colnames:
+            assert attached[name].dtype == table[name].dtype
+            assert np.array_equal(attached[name], table[name])
+
+        attached.close()
+
+
+@pytest.mark.parametrize('with_table2', [True, False])
+def test_match_workers_in_processes(with_table2):
+    table1, table2 = pair_tables()
+    if not with_table2:
+        table2 = None
+
+    serial = library.run_match_workers(table1, table2, nproc=1, method='loop')
+    shared = library.run_match_workers(table1, table2, nproc=2, method='loop', chunk_size=50)
+
+    assert len(serial) > 0
+    assert sorted(shared) == sorted(serial)
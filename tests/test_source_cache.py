@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.table import Table, MaskedColumn
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def sources_table(n, offset=0.):
+    table = Table()
+    table['source_id'] = np.arange(n, dtype=np.int64) + 10100000000
+    table['ra_icrs'] = np.linspace(10., 11., n) + offset
+    table['flag'] = MaskedColumn(np.arange(n), mask=np.arange(n) % 3 == 0)
+    return table
+
+
+def is_memory_mapped(column):
+    array = column.data.data if hasattr(column, 'mask') else column.data
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def test_source_cache_round_trip(tmp_path):
+    table = sources_table(100)
+    library.write_source_cache(table, 101, [[1, 2.], [3, 4.]], None, cachepath=str(tmp_path))
+
+    cached = library.read_source_cache(101, [[1, 2.], [3, 4.]], None, cachepath=str(tmp_path))
+
+    assert cached.colnames == table.colnames
+    assert np.array_equal(cached['source_id'], table['source_id'])
+    assert np.allclose(cached['ra_icrs'], table['ra_icrs'])
+    assert np.array_equal(cached['flag'].mask, table['flag'].mask)
+
+    # out of date
+    assert library.read_source_cache(101, [[1, 2.], [3, 5.]], None, cachepath=str(tmp_path)) is None
+
+
+def test_source_cache_rewrite_keeps_open_maps(tmp_path):
+    cachepath = str(tmp_path)
+    old = sources_table(100)
+    library.write_source_cache(old, 101, [[1, 2.]], None, cachepath=cachepath)
+    first = library.read_source_cache(101, [[1, 2.]], None, cachepath=cachepath)
+    assert all([is_memory_mapped(first[name]) for name in first.colnames])
+
+    # rewritten with a different length and values, while the first read is mapped
+    new = sources_table(150, offset=1.)
+    library.write_source_cache(new, 101, [[1, 3.]], None, cachepath=cachepath)
+
+    assert len(first) == 100
+    assert np.allclose(first['ra_icrs'], old['ra_icrs'])
+    assert np.array_equal(first['source_id'], old['source_id'])
+
+    second = library.read_source_cache(101, [[1, 3.]], None, cachepath=cachepath)
+    assert len(second) == 150
+    assert np.allclose(second['ra_icrs'], new['ra_icrs'])
+
+    # no temporary or old directories are left behind
+    assert os.listdir(cachepath) == [os.path.basename(library.source_cache_dir(101, cachepath=cachepath))]
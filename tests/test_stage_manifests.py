@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+pipeline = pytest.importorskip('pipeline')
+
+from test_pipeline_runner import make_context
+
+
+class Stage:
+    '''
+    A stage that copies its input file to its output file, reading one
+    parameter on the way. Counts how many times it actually ran.
+    '''
+    def __init__(self, ctx, input_file, output_file):
+        self.ctx = ctx
+        self.input_file = input_file
+        self.output_file = output_file
+        self.runs = 0
+
+    def function(self):
+        self.runs += 1
+        with open(self.input_file) as f:
+            text = f.read()
+        with open(self.output_file, 'w') as f:
+            f.write(text + str(self.ctx.par['max_fwhm']))
+        return 'ran'
+
+    def load(self):
+        return 'loaded'
+
+    def __call__(self, force=False):
+        return pipeline.run_stage('test_stage', 'pair', [self.ctx], [self.input_file], [self.output_file],
+                                  self.function, self.load, force=force)
+
+
+@pytest.fixture
+def stage(synthetic_sequence, tmp_path, monkeypatch):
+    _, images, _ = synthetic_sequence
+
+    # manifests and checksums stay in the temporary directory
+    monkeypatch.setattr(pipeline, 'MANIFESTPATH', str(tmp_path / 'manifests'))
+    monkeypatch.setattr(pipeline, 'file_checksum',
+                        lambda file_name: library.file_checksum(file_name, cachepath=str(tmp_path / 'cache')))
+    monkeypatch.setattr(pipeline.profiler, 'records', [])
+
+    ctx = make_context('101,102', images, str(tmp_path), monkeypatch)
+
+    input_file = str(tmp_path / 'input.txt')
+    with open(input_file, 'w') as f:
+        f.write('input')
+
+    return Stage(ctx, input_file, str(tmp_path / 'output.txt'))
+
+
+def test_stage_skipped_when_unchanged(stage):
+    assert stage() == 'ran'
+    assert stage() == 'loaded'
+    assert stage() == 'loaded'
+    assert stage.runs == 1
+
+    # skipped stages are in the profiling report, marked as such
+    assert [r['skipped'] for r in pipeline.profiler.records] == [False, True, True]
+
+    # the manifest holds only the parameters the stage read
+    manifest = pipeline.read_manifest('test_stage_pair')
+    assert list(manifest['parameters']['101,102'].keys()) == ['max_fwhm']
+
+
+def test_stage_rerun_when_input_changes(stage):
+    stage()
+
+    with open(stage.input_file, 'w') as f:
+        f.write('changed input')
+
+    assert stage() == 'ran'
+    assert stage() == 'loaded'
+
+
+def test_stage_rerun_when_used_parameter_changes(stage):
+    stage()
+
+    stage.ctx.par['min_fwhm'] = 0.5
+    assert stage() == 'loaded'
+
+    stage.ctx.par['max_fwhm'] = 20.
+    assert stage() == 'ran'
+    assert stage() == 'loaded'
+
+
+def test_stage_rerun_when_output_changes(stage):
+    stage()
+
+    with open(stage.output_file, 'a') as f:
+        f.write('edited')
+    assert stage() == 'ran'
+
+    os.remove(stage.output_file)
+    assert stage() == 'ran'
+    assert stage() == 'loaded'
+
+
+def test_stage_rerun_when_forced_or_stale(stage, monkeypatch):
+    stage()
+
+    assert stage(force=True) == 'ran'
+
+    monkeypatch.setattr(pipeline, 'manifest_version', pipeline.manifest_version + 1)
+    assert stage() == 'ran'
+    assert stage() == 'loaded'
+
+    # a different list of inputs is a different stage
+    stage.input_file, other = stage.output_file + '.in', stage.input_file
+    os.rename(other, stage.input_file)
+    assert stage() == 'ran'
+
+    assert stage.runs == 4
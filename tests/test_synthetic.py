@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+settings = pytest.importorskip('settings')
+benchmark = pytest.importorskip('benchmark')
+
+from synthetic import write_sequence
+
+
+TOLERANCE = 5. / 3600.
+
+
+def read_plate(directory, images, plate_id):
+    table = library.read_sources(plate_id, cache=False, datapath=directory)
+    with fits.open(images[plate_id]) as f:
+        return table, f[0].data.copy(), WCS(f[0].header)
+
+
+def test_sequence_is_reproducible(tmp_path):
+    outputs = []
+    for name, seed in [('a', 3), ('b', 3), ('c', 4)]:
+        directory = str(tmp_path / name)
+        images, truth = write_sequence(directory, plate_ids=[201, 202], size=300, n_vanishing=3, seed=seed)
+        outputs.append((fits.getdata(os.path.join(directory, images['201'])),
+                        Table.read(os.path.join(directory, 'sources_calib_202.csv'), format='ascii.csv'), truth))
+
+    (scan_a, table_a, truth_a), (scan_b, table_b, truth_b), (scan_c, _, _) = outputs
+
+    assert np.array_equal(scan_a, scan_b)
+    assert np.array_equal(table_a['ra_icrs'], table_b['ra_icrs'])
+    assert np.array_equal(truth_a['ra'], truth_b['ra'])
+    assert not np.array_equal(scan_a, scan_c)
+
+
+def test_source_tables_match_scans(synthetic_sequence):
+    directory, images, _ = synthetic_sequence
+
+    for plate_id in images:
+        table, scan, wcs = read_plate(directory, images, plate_id)
+
+        assert scan.dtype == np.uint16
+
+        # positions in both tables agree through the scan's WCS
+        ra, dec = wcs.pixel_to_world_values(table['x_source'], table['y_source'])
+        offset = np.hypot((ra - table['ra_icrs']) * np.cos(np.radians(dec)), dec - table['dec_icrs']) * 3600.
+        assert np.max(offset) < 1.5
+
+        # real sources show up in both scans, artifacts in one only
+        scan_1 = table[table['scan_id_1'] == 1]
+        scan_2 = table[table['scan_id_1'] == 2]
+        index = library.SkyIndex.from_table(scan_2)
+        found = index.has_match(np.asarray(scan_1['ra_icrs']), np.asarray(scan_1['dec_icrs']), tolerance=TOLERANCE)
+        assert 0.98 < np.mean(found) < 1.
+
+        # stars are dark in the inverted scan
+        bright = table[(table['flux_max'] > 5000.) & (table['flag_rim'] == 0)]
+        x = np.round(bright['x_source']).astype(int)
+        y = np.round(bright['y_source']).astype(int)
+        assert np.all(scan[y, x] < np.median(scan) - 2000.)
+
+
+def test_vanishing_sources(synthetic_sequence):
+    directory, images, truth = synthetic_sequence
+
+    assert len(truth) == 2 * 10
+    assert np.all(truth['gaia'] == False)
+
+    for plate_id_1, next_plate_id in [(101, 102), (102, 103)]:
+        vanishing = truth[truth['plate_id_1'] == plate_id_1]
+        assert np.all(vanishing['next_plate_id'] == next_plate_id)
+
+        table_1, scan_1, wcs_1 = read_plate(directory, images, str(plate_id_1))
+        table_2, scan_2, wcs_2 = read_plate(directory, images, str(next_plate_id))
+
+        ra, dec = np.asarray(vanishing['ra']), np.asarray(vanishing['dec'])
+
+        # listed in the plate where they are last seen, gone from the next one
+        assert np.all(library.SkyIndex.from_table(table_1).has_match(ra, dec, tolerance=TOLERANCE))
+        assert not np.any(library.SkyIndex.from_table(table_2).has_match(ra, dec, tolerance=TOLERANCE))
+
+        # and the same in the scans: a dark spot, then just background
+        for wcs, scan, present in [(wcs_1, scan_1, True), (wcs_2, scan_2, False)]:
+            x, y = wcs.world_to_pixel_values(ra, dec)
+            x = np.round(x).astype(int)
+            y = np.round(y).astype(int)
+            depth = np.array([np.median(scan[j-10:j+11, i-10:i+11]) - scan[j, i] for i, j in zip(x, y)])
+            if present:
+                assert np.all(depth > 1000.)
+            else:
+                assert np.all(depth < 200.)
+
+
+def test_benchmark_recall(tmp_path):
+    par = dict(settings.parameters['default'])
+
+    results, recalls = benchmark.benchmark_pair(str(tmp_path), 600, par, nproc=1, repeat=1, n_vanishing=5,
+                                                match_rows=200, fit_rows=50, profile_rows=10)
+
+    assert sorted([r['benchmark'] for r in results]) == sorted(['remove_outsiders', 'Worker', 'Worker2', 
+                                                                'background', 'FitWorker', 'ProfileWorker'])
+    assert all([r['time'] > 0. and r['size'] == 600 for r in results])
+
+    # every injected source survives the matching
+    assert recalls['non_matched'] == 1.
+    assert all([0. <= recalls[level] <= 1. for level in benchmark.recall_levels])
+
+
+def history_entry(times, recall, host='host', nproc=2):
+    return {'host': host, 'nproc': nproc, 'settings': {'density': 2000.},
+            'results': [{'benchmark': name, 'size': 1000, 'rows': 10, 'time': t} for name, t in times.items()],
+            'recall': {'1000': {level: recall for level in benchmark.recall_levels}}}
+
+
+def test_compare_with_history():
+    history = [history_entry({'FitWorker': 1.0, 'background': 2.0}, 0.9) for _ in range(3)]
+    history += [history_entry({'FitWorker': 0.1, 'background': 0.1}, 1.0, host='other')]
+
+    timings, recalls, regression = benchmark.compare(history_entry({'FitWorker': 1.1, 'background': 2.0}, 0.9),
+                                                     history)
+    assert not regression
+    assert list(timings['baseline']) == [1.0, 2.0]
+
+    timings, recalls, regression = benchmark.compare(history_entry({'FitWorker': 1.5, 'background': 2.0}, 0.9),
+                                                     history)
+    assert regression
+    assert list(timings['flag']) == ['SLOWER', '']
+
+    timings, recalls, regression = benchmark.compare(history_entry({'FitWorker': 1.0, 'background': 2.0}, 0.8),
+                                                     history)
+    assert regression
+    assert np.all(recalls['flag'] == 'LOST')
+
+    # nothing to compare with, in a new setting
+    timings, recalls, regression = benchmark.compare(history_entry({'FitWorker': 9.0}, 0.1, nproc=8), history)
+    assert not regression
+    assert np.all(np.isnan(timings['baseline']))
@@ -0,0 +1,56 @@
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+# library reads the telescope parameters through settings
+library = pytest.importorskip('library')
+
+
+def test_temporary_names_unique(tmp_path):
+    file_name = str(tmp_path / 'table.fits')
+
+    with ThreadPool(8) as pool:
+        names = pool.map(lambda _: library.temporary_name(file_name), range(200))
+
+    assert len(set(names)) == len(names)
+    assert all([os.path.dirname(name) == str(tmp_path) for name in names])
+
+
+def test_checksums_from_threads(tmp_path):
+    # threads that memoize checksums in the same file never share a temporary file
+    file_names = []
+    for k in range(64):
+        file_name = str(tmp_path / ('file_' + str(k)))
+        with open(file_name, 'wb') as f:
+            f.write(os.urandom(1024 * (k + 1)))
+        file_names.append(file_name)
+
+    cachepath = str(tmp_path / 'cache')
+
+    with ThreadPool(16) as pool:
+        checksums = pool.map(lambda name: library.file_checksum(name, cachepath=cachepath), file_names * 4)
+
+    assert checksums[:64] == checksums[64:128] == checksums[128:192] == checksums[192:]
+
+    with open(os.path.join(cachepath, 'checksums.json')) as json_file:
+        json.load(json_file)
+    assert os.listdir(cachepath) == ['checksums.json']
+
+
+def test_profile_bank_written_from_threads(tmp_path):
+    file_name = str(tmp_path / 'profile_bank.fits')
+    banks = [library.ProfileBank(np.arange(100) + k, np.full((100, 24), float(k)), np.arange(25) / 2., data_key='k')
+             for k in range(16)]
+
+    with ThreadPool(16) as pool:
+        pool.map(lambda bank: bank.write(file_name), banks)
+
+    # the file is whole, and from one of the writers
+    bank = library.read_profile_bank(file_name)
+    k = int(bank.profiles[0, 0])
+    assert np.array_equal(bank.source_id, banks[k].source_id)
+    assert np.all(bank.profiles == k)
+    assert os.listdir(str(tmp_path)) == ['profile_bank.fits']